@@ -0,0 +1,142 @@
+from typing import Dict, List, Tuple, Union
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+from .keys import parse_value
+from .vector_scan import column_numbers
+
+AGGREGATES = ('count', 'sum', 'min', 'max', 'avg')
+
+# amount of fields, sum, lowest and highest value of a group
+State = List[Union[int, float, None]]
+
+
+class Aggregation:
+    '''
+    Hash aggregation of registers given a chunk at a time, as structured
+    records (see vector_scan.record_dtype). Every chunk is reduced with
+    vectorized operations to one partial state per group, merged into the
+    states kept by group, the only thing kept between chunks.
+    functions are pairs of aggregate and column number (None for count
+    of registers). Fields that are NULL (numbers that cannot be parsed,
+    empty texts) are ignored, as on SQL.
+    '''
+
+    def __init__(self, functions: List[Tuple[str, Union[int, None]]],
+                 column_types: List[str], group_columns: List[int] = ()) -> None:
+        for function, column in functions:
+            if function not in AGGREGATES:
+                raise ValueError(f'Unknown aggregate {function}, '
+                                 f'use one of {", ".join(AGGREGATES)}.')
+            if function == 'count':
+                continue
+            if column is None or \
+                    column_types[column] not in ('INTEGER', 'FLOAT'):
+                raise ValueError(f'The aggregate {function} needs an '
+                                 f'INTEGER or FLOAT column.')
+        self.functions = functions
+        self.column_types = column_types
+        self.group_columns = list(group_columns)
+        self.states: Dict[Tuple, List[State]] = {}
+
+    def _group_values(self, key: Tuple[bytes, ...]) -> Tuple:
+        return tuple(parse_value(field.decode('utf-8', errors='replace'),
+                                 self.column_types[column])
+                     for field, column in zip(key, self.group_columns))
+
+    def _reduce(self, records: np.ndarray, column: Union[int, None],
+                groups: np.ndarray, amount: int) -> Tuple:
+        '''
+        Amount of fields, sum, lowest and highest value of column on each
+        of the amount groups (None for the ones that are not needed),
+        given the group of every record.
+        '''
+        if column is None:
+            return np.bincount(groups, minlength=amount), None, None, None
+        column_type = self.column_types[column]
+        fields = records[f'c{column}']
+        if column_type not in ('INTEGER', 'FLOAT'):
+            valid = np.char.strip(fields, b' ') != b''
+            return np.bincount(groups[valid], minlength=amount), \
+                None, None, None
+        numbers, valid = column_numbers(fields, column_type)
+        numbers, groups = numbers[valid], groups[valid]
+        if column_type == 'INTEGER':
+            numbers = numbers.astype(np.int64)
+        counts = np.bincount(groups, minlength=amount)
+        if amount == 1:
+            if not len(numbers):
+                return counts, None, None, None
+            return counts, numbers.sum(keepdims=True), \
+                numbers.min(keepdims=True), numbers.max(keepdims=True)
+        sums = np.zeros(amount, dtype=numbers.dtype)
+        np.add.at(sums, groups, numbers)
+        lowest = np.full(amount, np.iinfo(np.int64).max
+                         if column_type == 'INTEGER' else np.inf,
+                         dtype=numbers.dtype)
+        np.minimum.at(lowest, groups, numbers)
+        highest = np.full(amount, np.iinfo(np.int64).min
+                          if column_type == 'INTEGER' else -np.inf,
+                          dtype=numbers.dtype)
+        np.maximum.at(highest, groups, numbers)
+        return counts, sums, lowest, highest
+
+    def add(self, records: np.ndarray) -> None:
+        if not len(records):
+            return
+        if self.group_columns:
+            fields = repack_fields(
+                records[[f'c{column}' for column in self.group_columns]])
+            # the group columns side by side, as one text, sort faster
+            # than the fields themselves
+            _, first, groups = np.unique(
+                fields.view(f'S{fields.dtype.itemsize}'),
+                return_index=True, return_inverse=True)
+            groups = groups.ravel()
+            # texts of the same value may differ (e.g. '7.0' and '7.00'),
+            # so their states are merged by value
+            group_values = [self._group_values(key)
+                            for key in fields[first].tolist()]
+        else:
+            groups = np.zeros(len(records), dtype=np.intp)
+            group_values = [()]
+        partials = [self._reduce(records, column, groups, len(group_values))
+                    for _, column in self.functions]
+        for position, group in enumerate(group_values):
+            states = self.states.setdefault(
+                group, [[0, 0, None, None] for _ in self.functions])
+            for state, (counts, sums, lowest, highest) in zip(states, partials):
+                amount = int(counts[position])
+                if not amount:
+                    continue
+                state[0] += amount
+                if sums is None:
+                    continue
+                low, high = lowest[position].item(), highest[position].item()
+                state[1] += sums[position].item()
+                state[2] = low if state[2] is None else min(state[2], low)
+                state[3] = high if state[3] is None else max(state[3], high)
+
+    def _result(self, function: str, state: State) -> Union[int, float, None]:
+        amount, total, low, high = state
+        if function == 'count':
+            return amount
+        if not amount:
+            return None
+        if function == 'sum':
+            return total
+        if function == 'avg':
+            return total / amount
+        return low if function == 'min' else high
+
+    def results(self) -> List[Tuple]:
+        '''
+        One row per group: the values of the group columns followed by
+        the aggregates. Without group columns there is always one row.
+        '''
+        states = self.states
+        if not self.group_columns and not states:
+            states = {(): [[0, 0, None, None] for _ in self.functions]}
+        return [group + tuple(self._result(function, state) for
+                              (function, _), state in zip(self.functions,
+                                                          group_states))
+                for group, group_states in states.items()]
@@ -0,0 +1,252 @@
+import struct
+from bisect import bisect_left, bisect_right, insort
+from typing import BinaryIO, Iterator, List, Tuple
+from .configs import BTREE_FILL_FACTOR, BTREE_MIN_ENTRIES
+
+MAGIC = b'BPTR'
+# magic, node size, key length, root node, amount of nodes, height
+META_FORMAT = '>4sIHIII'
+META_COLUMN_LENGTH = 64
+# is leaf, amount of entries, next leaf (leaves) or first child (inner nodes)
+NODE_HEADER_FORMAT = '>BHi'
+NODE_HEADER_SIZE = struct.calcsize(NODE_HEADER_FORMAT)
+NO_NODE = -1
+
+# an entry is the key of the column together with the location of the
+# register, so repeated keys are still unique and ordered
+Entry = Tuple[bytes, int]
+
+
+class _Node:
+    def __init__(self, is_leaf: bool, entries: List[Entry] = None,
+                 children: List[int] = None, next_leaf: int = NO_NODE) -> None:
+        self.is_leaf = is_leaf
+        self.entries = entries or []
+        self.children = children or []
+        self.next_leaf = next_leaf
+
+
+def node_size_for(block_size: int, key_length: int) -> int:
+    '''
+    Smallest multiple of the block size holding BTREE_MIN_ENTRIES
+    entries, so every node is made of whole blocks.
+    '''
+    needed = NODE_HEADER_SIZE + BTREE_MIN_ENTRIES*(key_length + 13)
+    block_size = max(block_size, 1)
+    return -(-needed // block_size) * block_size
+
+
+class BPlusTree:
+    '''
+    Disk resident B+tree mapping the key of a column (see keys.encode_key)
+    to the location of the registers. Every node has the same size, a
+    multiple of the block size of the table, and node n is stored at
+    n*node_size (node 0 is the meta page). Leaves are chained in key
+    order, so ranges are read by walking the leaves.
+    Deleted entries are simply removed from their leaf; nodes are not
+    merged back.
+    '''
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        self._read_meta()
+
+    @staticmethod
+    def create(f: BinaryIO, column: str, key_length: int,
+               node_size: int) -> None:
+        tree = BPlusTree.__new__(BPlusTree)
+        tree.f = f
+        tree.column = column
+        tree.node_size = node_size
+        tree.key_length = key_length
+        tree.root, tree.nodes, tree.height = 1, 2, 1
+        tree._set_capacities()
+        tree._write_meta()
+        tree._write_node(1, _Node(True))
+
+    @staticmethod
+    def read_column(f: BinaryIO) -> str:
+        f.seek(struct.calcsize(META_FORMAT))
+        return f.read(META_COLUMN_LENGTH).decode('utf-8').strip(' ')
+
+    def _set_capacities(self) -> None:
+        self.leaf_capacity = (self.node_size - NODE_HEADER_SIZE) // \
+            (1 + self.key_length + 8)
+        self.inner_capacity = (self.node_size - NODE_HEADER_SIZE) // \
+            (1 + self.key_length + 8 + 4)
+
+    def _read_meta(self) -> None:
+        self.f.seek(0)
+        magic, self.node_size, self.key_length, self.root, self.nodes, \
+            self.height = struct.unpack(
+                META_FORMAT, self.f.read(struct.calcsize(META_FORMAT)))
+        if magic != MAGIC:
+            raise ValueError('File is not a B+tree index.')
+        self.column = self.read_column(self.f)
+        self._set_capacities()
+
+    def _write_meta(self) -> None:
+        meta = struct.pack(META_FORMAT, MAGIC, self.node_size, self.key_length,
+                           self.root, self.nodes, self.height)
+        column_bytes = self.column.encode('utf-8')[:META_COLUMN_LENGTH]
+        meta += column_bytes + b' '*(META_COLUMN_LENGTH - len(column_bytes))
+        self.f.seek(0)
+        self.f.write(meta + b'\x00'*(self.node_size - len(meta)))
+
+    def _read_node(self, number: int) -> _Node:
+        self.f.seek(number*self.node_size)
+        data = self.f.read(self.node_size)
+        is_leaf, amount, link = struct.unpack(NODE_HEADER_FORMAT,
+                                              data[:NODE_HEADER_SIZE])
+        position = NODE_HEADER_SIZE
+        entries, children = [], []
+        if not is_leaf:
+            children.append(link)
+        for _ in range(amount):
+            length = data[position]
+            key = data[position + 1:position + 1 + length]
+            position += 1 + self.key_length
+            location = struct.unpack('>Q', data[position:position + 8])[0]
+            position += 8
+            entries.append((key, location))
+            if not is_leaf:
+                children.append(struct.unpack(
+                    '>I', data[position:position + 4])[0])
+                position += 4
+        if is_leaf:
+            return _Node(True, entries, next_leaf=link)
+        return _Node(False, entries, children)
+
+    def _write_node(self, number: int, node: _Node) -> None:
+        link = node.next_leaf if node.is_leaf else node.children[0]
+        data = [struct.pack(NODE_HEADER_FORMAT, int(node.is_leaf),
+                            len(node.entries), link)]
+        for idx, (key, location) in enumerate(node.entries):
+            data.append(bytes([len(key)]) + key +
+                        b'\x00'*(self.key_length - len(key)) +
+                        struct.pack('>Q', location))
+            if not node.is_leaf:
+                data.append(struct.pack('>I', node.children[idx + 1]))
+        data = b''.join(data)
+        self.f.seek(number*self.node_size)
+        self.f.write(data + b'\x00'*(self.node_size - len(data)))
+
+    def _new_node(self) -> int:
+        self.nodes += 1
+        return self.nodes - 1
+
+    def _find_leaf(self, entry: Entry) -> Tuple[int, List[Tuple[int, _Node]]]:
+        '''
+        Leaf where entry belongs, along with the inner nodes on the way.
+        '''
+        number, path = self.root, []
+        node = self._read_node(number)
+        while not node.is_leaf:
+            path.append((number, node))
+            number = node.children[bisect_right(node.entries, entry)]
+            node = self._read_node(number)
+        path.append((number, node))
+        return number, path
+
+    def insert(self, key: bytes, location: int) -> None:
+        entry = (key[:self.key_length], location)
+        _, path = self._find_leaf(entry)
+        number, node = path.pop()
+        insort(node.entries, entry)
+        while True:
+            capacity = self.leaf_capacity if node.is_leaf else self.inner_capacity
+            if len(node.entries) <= capacity:
+                self._write_node(number, node)
+                break
+            separator, new_number = self._split(number, node)
+            if not path:
+                # root was split, the tree grows one level
+                root = _Node(False, [separator], [number, new_number])
+                self.root = self._new_node()
+                self._write_node(self.root, root)
+                self.height += 1
+                break
+            number, node = path.pop()
+            position = bisect_right(node.entries, separator)
+            node.entries.insert(position, separator)
+            node.children.insert(position + 1, new_number)
+        self._write_meta()
+
+    def _split(self, number: int, node: _Node) -> Tuple[Entry, int]:
+        middle = len(node.entries) // 2
+        new_number = self._new_node()
+        if node.is_leaf:
+            right = _Node(True, node.entries[middle:], next_leaf=node.next_leaf)
+            node.entries = node.entries[:middle]
+            node.next_leaf = new_number
+            separator = right.entries[0]
+        else:
+            separator = node.entries[middle]
+            right = _Node(False, node.entries[middle + 1:],
+                          node.children[middle + 1:])
+            node.entries = node.entries[:middle]
+            node.children = node.children[:middle + 1]
+        self._write_node(number, node)
+        self._write_node(new_number, right)
+        return separator, new_number
+
+    def delete(self, key: bytes, location: int) -> bool:
+        entry = (key[:self.key_length], location)
+        number, path = self._find_leaf(entry)
+        node = path[-1][1]
+        position = bisect_left(node.entries, entry)
+        if position < len(node.entries) and node.entries[position] == entry:
+            del node.entries[position]
+            self._write_node(number, node)
+            return True
+        return False
+
+    def search(self, low: bytes, high: bytes) -> Iterator[Entry]:
+        '''
+        Every entry whose key is between low and high, in key order.
+        '''
+        low, high = low[:self.key_length], high[:self.key_length]
+        number, _ = self._find_leaf((low, 0))
+        while number != NO_NODE:
+            node = self._read_node(number)
+            for key, location in node.entries:
+                if key > high:
+                    return
+                if key >= low:
+                    yield key, location
+            number = node.next_leaf
+
+    def bulk_load(self, entries: List[Entry]) -> None:
+        '''
+        Replaces the content of the tree by the entries, building it
+        bottom up. Leaves are filled up to BTREE_FILL_FACTOR.
+        '''
+        entries = sorted((key[:self.key_length], location)
+                         for key, location in entries)
+        self.nodes = 1
+        per_leaf = max(int(self.leaf_capacity*BTREE_FILL_FACTOR), 1)
+        level = []
+        chunks = [entries[idx:idx + per_leaf]
+                  for idx in range(0, len(entries), per_leaf)] or [[]]
+        first_leaf = self.nodes
+        for idx, chunk in enumerate(chunks):
+            next_leaf = first_leaf + idx + 1 if idx + 1 < len(chunks) else NO_NODE
+            number = self._new_node()
+            self._write_node(number, _Node(True, chunk, next_leaf=next_leaf))
+            level.append((chunk[0] if chunk else None, number))
+        self.height = 1
+        per_inner = max(int(self.inner_capacity*BTREE_FILL_FACTOR), 2)
+        while len(level) > 1:
+            upper = []
+            for idx in range(0, len(level), per_inner + 1):
+                group = level[idx:idx + per_inner + 1]
+                number = self._new_node()
+                self._write_node(number, _Node(
+                    False, [first for first, _ in group[1:]],
+                    [child for _, child in group]))
+                upper.append((group[0][0], number))
+            level = upper
+            self.height += 1
+        self.root = level[0][1]
+        self._write_meta()
+        self.f.truncate(self.nodes*self.node_size)
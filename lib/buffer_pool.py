@@ -0,0 +1,334 @@
+import os
+from collections import OrderedDict
+from typing import BinaryIO, Dict, List, Tuple
+from .configs import DEFAULT_PAGE_SIZE
+from .wal import WriteAheadLog
+
+
+class _FileState:
+    def __init__(self, handle: BinaryIO, base: int, page_size: int) -> None:
+        self.handle = handle
+        self.base = base
+        self.page_size = page_size
+        self.size = os.fstat(handle.fileno()).st_size
+        self.truncated = False
+
+
+class BufferPool:
+    '''
+    Page cache shared by every file of a session.
+    A file is split in pages: page -1 holds everything before 'base'
+    (the header) and page k holds the bytes
+    [base + k*page_size, base + (k+1)*page_size), so with
+    page_size = blocking_factor * register size a page is one block
+    of records.
+    Pages are evicted in least recently used order once 'max_bytes'
+    is exceeded. Changed pages are only written back on eviction or
+    on flush, and neighbouring dirty pages are written at once.
+    With a write ahead log (see wal.WriteAheadLog), every flush commits
+    all the changed pages as one transaction, and pages changed are
+    only written in place once committed: the ones evicted before
+    are kept on the log meanwhile. rollback throws the changes away
+    instead.
+    '''
+
+    def __init__(self, max_bytes: int, wal: WriteAheadLog = None) -> None:
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._files: Dict[str, _FileState] = {}
+        self._pages: 'OrderedDict[Tuple[str, int], bytearray]' = OrderedDict()
+        self._dirty = set()
+        self.wal = wal
+        # position and length on the log of the pages evicted
+        # before being committed
+        self._spilled: Dict[Tuple[str, int], Tuple[int, int]] = {}
+        # end of the log when the first of them was evicted
+        self._log_start = None
+
+    def attach(self, path: str, handle: BinaryIO, base: int = 0,
+               page_size: int = DEFAULT_PAGE_SIZE) -> None:
+        self._files[path] = _FileState(handle, base, max(page_size, 1))
+
+    def is_attached(self, path: str) -> bool:
+        return path in self._files
+
+    def set_layout(self, path: str, base: int, page_size: int) -> None:
+        '''
+        Changes how a file is split in pages. The cached pages of the
+        file are written back and dropped if the layout changed.
+        '''
+        state = self._files[path]
+        page_size = max(page_size, 1)
+        if state.base == base and state.page_size == page_size:
+            return
+        self.flush(path)
+        self._drop_pages(path)
+        state.base, state.page_size = base, page_size
+
+    def detach(self, path: str) -> BinaryIO:
+        '''
+        Writes back and forgets every page of path. Returns its handle.
+        '''
+        self.flush(path)
+        self._drop_pages(path)
+        return self._files.pop(path).handle
+
+    def size(self, path: str) -> int:
+        return self._files[path].size
+
+    def _drop_pages(self, path: str) -> None:
+        for key in [key for key in self._pages if key[0] == path]:
+            self.used_bytes -= len(self._pages.pop(key))
+            self._dirty.discard(key)
+        for key in [key for key in self._spilled if key[0] == path]:
+            del self._spilled[key]
+
+    def _page_range(self, state: _FileState, page_no: int) -> Tuple[int, int]:
+        if page_no == -1:
+            return 0, state.base
+        start = state.base + page_no*state.page_size
+        return start, start + state.page_size
+
+    def _page_of(self, state: _FileState, offset: int) -> int:
+        if offset < state.base:
+            return -1
+        return (offset - state.base) // state.page_size
+
+    def _get_page(self, path: str, page_no: int) -> bytearray:
+        key = (path, page_no)
+        page = self._pages.get(key)
+        if page is not None:
+            self.hits += 1
+            self._pages.move_to_end(key)
+            return page
+        self.misses += 1
+        state = self._files[path]
+        start, end = self._page_range(state, page_no)
+        self._make_room(end - start)
+        spilled = self._spilled.pop(key, None)
+        if spilled is not None:
+            page = bytearray(self.wal.read(*spilled))
+            self._dirty.add(key)
+        elif start < state.size:
+            state.handle.seek(start)
+            page = bytearray(state.handle.read(min(end, state.size) - start))
+        else:
+            page = bytearray()
+        self._pages[key] = page
+        self.used_bytes += len(page)
+        return page
+
+    def _make_room(self, amount: int) -> None:
+        while self._pages and self.used_bytes + amount > self.max_bytes:
+            key, page = self._pages.popitem(last=False)
+            if key in self._dirty:
+                if self.wal is not None:
+                    if self._log_start is None:
+                        self._log_start = self.wal.end()
+                    start, _ = self._page_range(self._files[key[0]], key[1])
+                    self._spilled[key] = \
+                        self.wal.append_page(key[0], start, page), len(page)
+                else:
+                    self._write_pages(key[0], [(key[1], page)])
+                self._dirty.discard(key)
+            self.used_bytes -= len(page)
+
+    def read(self, path: str, offset: int, amount: int = -1) -> bytes:
+        state = self._files[path]
+        end = state.size if amount < 0 else min(offset + amount, state.size)
+        result = []
+        while offset < end:
+            page_no = self._page_of(state, offset)
+            start, page_end = self._page_range(state, page_no)
+            page = self._get_page(path, page_no)
+            stop = min(end, page_end)
+            result.append(bytes(page[offset - start:stop - start]))
+            offset = stop
+        return b''.join(result)
+
+    def write(self, path: str, offset: int, data: bytes) -> None:
+        state = self._files[path]
+        if offset > state.size:
+            # same behaviour as a regular file: the gap is zero filled
+            data = b'\x00'*(offset - state.size) + bytes(data)
+            offset = state.size
+        position = 0
+        while position < len(data):
+            page_no = self._page_of(state, offset)
+            start, page_end = self._page_range(state, page_no)
+            page = self._get_page(path, page_no)
+            chunk = data[position:position + page_end - offset]
+            before = len(page)
+            page[offset - start:offset - start + len(chunk)] = chunk
+            self.used_bytes += len(page) - before
+            self._dirty.add((path, page_no))
+            offset += len(chunk)
+            position += len(chunk)
+        state.size = max(state.size, offset)
+
+    def truncate(self, path: str, size: int) -> None:
+        state = self._files[path]
+        for key in [key for key in self._pages if key[0] == path]:
+            start, _ = self._page_range(state, key[1])
+            page = self._pages[key]
+            if start >= size:
+                self.used_bytes -= len(self._pages.pop(key))
+                self._dirty.discard(key)
+            elif start + len(page) > size:
+                self.used_bytes -= start + len(page) - size
+                del page[size - start:]
+        for key in [key for key in self._spilled if key[0] == path]:
+            if self._page_range(state, key[1])[0] >= size:
+                del self._spilled[key]
+        state.size = min(state.size, size)
+        state.truncated = True
+
+    def _write_pages(self, path: str, pages: List[Tuple[int, bytearray]]) -> None:
+        '''
+        Writes the given pages of path, joining neighbouring ones
+        in a single write.
+        '''
+        state = self._files[path]
+        pages = sorted(pages, key=lambda x: x[0])
+        idx = 0
+        while idx < len(pages):
+            start, _ = self._page_range(state, pages[idx][0])
+            chunk = [pages[idx][1]]
+            end = start + len(pages[idx][1])
+            idx += 1
+            while idx < len(pages) and \
+                    self._page_range(state, pages[idx][0])[0] == end:
+                chunk.append(pages[idx][1])
+                end += len(pages[idx][1])
+                idx += 1
+            state.handle.seek(start)
+            state.handle.write(b''.join(chunk))
+
+    def flush(self, path: str = None) -> None:
+        if self.wal is not None:
+            # the pages of other files belong to the same transaction,
+            # so they are committed too, but only if path has changes
+            if path is None or self._has_changes(path):
+                self.commit()
+            return
+        paths = [path] if path is not None else list(self._files)
+        for file_path in paths:
+            keys = [key for key in self._dirty if key[0] == file_path]
+            if keys:
+                self._write_pages(file_path,
+                                  [(key[1], self._pages[key]) for key in keys])
+                self._dirty.difference_update(keys)
+            state = self._files[file_path]
+            if state.truncated:
+                state.handle.truncate(state.size)
+                state.truncated = False
+            state.handle.flush()
+
+    def _has_changes(self, path: str) -> bool:
+        return self._files[path].truncated or \
+            any(key[0] == path for key in self._dirty) or \
+            any(key[0] == path for key in self._spilled)
+
+    def commit(self) -> None:
+        '''
+        Appends every page changed since the last commit to the log,
+        as one transaction, and only then writes them in place.
+        '''
+        truncated = [(path, state.size) for path, state in self._files.items()
+                     if state.truncated]
+        if not self._dirty and not self._spilled and not truncated:
+            return
+        self.wal.commit([(key[0], self._page_range(self._files[key[0]],
+                                                   key[1])[0],
+                          bytes(self._pages[key])) for key in self._dirty],
+                        truncated)
+        for (path, page_no), spilled in self._spilled.items():
+            state = self._files[path]
+            state.handle.seek(self._page_range(state, page_no)[0])
+            state.handle.write(self.wal.read(*spilled))
+        self._spilled = {}
+        self._log_start = None
+        paths = set(key[0] for key in self._dirty)
+        for path in paths:
+            self._write_pages(path, [(key[1], self._pages[key])
+                                     for key in self._dirty if key[0] == path])
+        self._dirty = set()
+        for path, size in truncated:
+            state = self._files[path]
+            state.handle.truncate(size)
+            state.truncated = False
+        if self.wal.is_full():
+            self.wal.checkpoint()
+
+    def rollback(self) -> None:
+        '''
+        Throws away every page changed since the last commit without
+        writing it, e.g. when an operation failed halfway, and removes
+        the ones evicted meanwhile from the log. Without a log, the pages
+        evicted were written in place already and stay there.
+        '''
+        for key in self._dirty:
+            self.used_bytes -= len(self._pages.pop(key))
+        self._dirty = set()
+        self._spilled = {}
+        if self._log_start is not None:
+            self.wal.discard(self._log_start)
+            self._log_start = None
+        for path, state in self._files.items():
+            if state.truncated:
+                # the pages cut by the truncation are read again
+                self._drop_pages(path)
+                state.truncated = False
+            state.size = os.fstat(state.handle.fileno()).st_size
+
+    def invalidate(self, path: str) -> None:
+        '''
+        Drops the cached pages of path without writing them back,
+        used when the file was changed by someone else.
+        '''
+        self._drop_pages(path)
+        state = self._files[path]
+        state.size = os.fstat(state.handle.fileno()).st_size
+
+
+class PagedFile:
+    '''
+    File like view (seek, tell, read, write) of a file whose bytes are
+    served by a BufferPool.
+    '''
+
+    def __init__(self, pool: BufferPool, path: str) -> None:
+        self.pool = pool
+        self.path = path
+        self.position = 0
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.pool.size(self.path)
+        self.position = offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, amount: int = -1) -> bytes:
+        result = self.pool.read(self.path, self.position, amount)
+        self.position += len(result)
+        return result
+
+    def write(self, data: bytes) -> int:
+        self.pool.write(self.path, self.position, data)
+        self.position += len(data)
+        return len(data)
+
+    def truncate(self, size: int = None) -> int:
+        size = self.position if size is None else size
+        self.pool.truncate(self.path, size)
+        return size
+
+    def flush(self) -> None:
+        self.pool.flush(self.path)
@@ -0,0 +1,121 @@
+import json
+import os
+import shutil
+from typing import Dict, List, Union
+from .heap_fixed import FixedHeap
+from .ordered_file import OrderedFile
+from .table_lock import TableLock
+
+Table = Union[FixedHeap, OrderedFile]
+
+
+class Catalog:
+    '''
+    Directory holding several tables, each one on its own subdirectory
+    (directory/<table_name>/<table_name>.txt, with its sidecar files next
+    to it), so tables never share a file and can be merged or compacted
+    at the same time, on threads or processes.
+    The tables are listed on directory/catalog.json with what is needed
+    to open them again: blocking factor, fields and, for an OrderedFile,
+    its sort column. The list is changed by one process at a time.
+    '''
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'catalog.json')
+        self._lock = TableLock(os.path.join(directory, 'catalog.lock'),
+                               os.path.join(directory, 'catalog.gate'))
+
+    def _load(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(file=self.path, mode='r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save(self, tables: Dict[str, Dict]) -> None:
+        # written aside first, so the list is never read half written
+        temp_path = self.path + '.tmp'
+        with open(file=temp_path, mode='w', encoding='utf-8') as f:
+            json.dump(tables, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def tables(self) -> List[str]:
+        with self._lock.hold(shared=True):
+            return sorted(self._load())
+
+    def table_path(self, table_name: str) -> str:
+        if not table_name or table_name in ('.', '..') or \
+                any(sep and sep in table_name for sep in (os.sep, os.altsep)):
+            raise ValueError(f'Invalid table name {table_name}.')
+        return os.path.join(self.directory, table_name, f'{table_name}.txt')
+
+    def _build(self, table_name: str, entry: Dict, session: bool,
+               options: Dict) -> Table:
+        args = [self.table_path(table_name), table_name,
+                entry['blocking_factor'], entry['fields']]
+        if entry['sort_column'] is None:
+            cls = FixedHeap
+        else:
+            cls = OrderedFile
+            args.append(entry['sort_column'])
+        return cls.open(*args, **options) if session else cls(*args, **options)
+
+    def create_table(self, table_name: str, blocking_factor: int,
+                     fields_info: Dict, sort_column: str = None,
+                     **options) -> Table:
+        '''
+        Adds a table to the catalog and creates its files: an OrderedFile
+        if sort_column is given, a FixedHeap otherwise. options are given
+        to the constructor of the table (e.g. buffer_pool_size).
+        '''
+        path = self.table_path(table_name)
+        with self._lock.hold():
+            tables = self._load()
+            if table_name in tables:
+                raise ValueError(f'The table {table_name} already exists.')
+            entry = {'blocking_factor': blocking_factor,
+                     'fields': fields_info, 'sort_column': sort_column}
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            table = self._build(table_name, entry, False, options)
+            if isinstance(table, OrderedFile):
+                table.create_register_files()
+            else:
+                table.create_register_file()
+            tables[table_name] = entry
+            self._save(tables)
+        return table
+
+    def _entry(self, table_name: str) -> Dict:
+        with self._lock.hold(shared=True):
+            entry = self._load().get(table_name)
+        if entry is None:
+            raise ValueError(f'The table {table_name} does not exist.')
+        return entry
+
+    def table(self, table_name: str, **options) -> Table:
+        '''
+        The table table_name of the catalog. options are given to its
+        constructor (e.g. background_compaction=True).
+        '''
+        return self._build(table_name, self._entry(table_name), False,
+                           options)
+
+    def open(self, table_name: str, **options) -> Table:
+        '''
+        Same as table, opened for a session (see FixedHeap.open).
+        '''
+        return self._build(table_name, self._entry(table_name), True,
+                           options)
+
+    def drop_table(self, table_name: str) -> None:
+        '''
+        Removes the table from the catalog, along with all of its files.
+        '''
+        path = self.table_path(table_name)
+        with self._lock.hold():
+            tables = self._load()
+            if tables.pop(table_name, None) is None:
+                raise ValueError(f'The table {table_name} does not exist.')
+            self._save(tables)
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
@@ -12,11 +12,34 @@ POINTERS_INDEX = {
     'first_register': 3
 }
 EXTENSION_TABLE_THRESHOLD = 4  # when to merge extension table
+LSM_TIER_RUNS = 4  # runs of the same tier merged into one run of the next tier
+BACKGROUND_COMPACTION = False  # compactions of OrderedFile runs done by a background thread
+COMPACTION_BACKLOG_RUNS = 16  # runs waiting for a background compaction before inserts block
+LOCATION_OFFSET_BITS = 40  # low bits of an index location, holding the position on the file
 MAX_HEADER_COLUMNS = 200
 MAX_SPACE_POINTERS = 64
 MAX_REGISTERS_LENGTH = 16
-MAX_SIZE_EXTENSION_TABLE = 3  # 999 registers inserted at once at max
+MAX_SIZE_EXTENSION_TABLE = 16  # digits of the counter of registers on the extension file
 TIMESTAMP_LENGTH = 19
 NEXT_AVALIABLE_LENGTH = 16
 FIRST_REGISTER_LENGTH = 16
 AMOUNT_POINTERS_CHARACTERS = 8  # 2xtotal de variaveis 'LENGTH'
+BUFFER_POOL_SIZE = 4 * 1024 * 1024  # bytes of pages kept in memory per session
+DEFAULT_PAGE_SIZE = 4096  # page size of files without a known block size
+HASH_INDEX_PAGE_SIZE = 4096
+HASH_INDEX_INITIAL_BUCKETS = 4
+HASH_INDEX_MAX_LOAD = 0.75  # fraction of the bucket pages in use before a split
+BTREE_MIN_ENTRIES = 8  # nodes get as many blocks as needed to hold this many keys
+BTREE_FILL_FACTOR = 0.9  # fraction of a node filled when an index is built
+ZONE_MAP_BLOOM_BITS_PER_KEY = 10  # bits of the Bloom filters of a zone map per register of a block
+ZONE_MAP_BLOOM_HASHES = 3  # bits set by each key on a Bloom filter
+FREE_MAP_SEARCH_BYTES = 4096  # bytes of the free space map read at a time when looking for free slots
+CSV_CHUNK_REGISTERS = 50000  # registers parsed and written at once when loading a csv
+LOAD_WRITE_BUFFER = 1024 * 1024  # bytes buffered by writes of whole files
+PARALLEL_LOAD_RANGE_BYTES = 2 * 1024 * 1024  # csv bytes encoded by each task of a parallel load
+SCAN_WORKERS = None  # processes of a full scan (one per core, if None)
+PARALLEL_SCAN_MIN_BYTES = 64 * 1024 * 1024  # smaller record areas are scanned by a single process
+QUERY_CHUNK_REGISTERS = 65536  # registers scanned at once by a query, before its rows are yielded
+VACUUM_CHUNK_REGISTERS = 65536  # registers read and copied at once by a vacuum
+WRITE_AHEAD_LOG = False  # tables keep a write ahead log of their pages (see wal.WriteAheadLog)
+WAL_CHECKPOINT_BYTES = 16 * 1024 * 1024  # size of the log before the files are synced and it starts over
@@ -0,0 +1,173 @@
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import time
+from typing import Iterable, Iterator, List, Tuple, Union
+from .configs import CSV_CHUNK_REGISTERS, PARALLEL_LOAD_RANGE_BYTES
+from .keys import encode_key
+
+# size of every column before the sort column, its size and its type
+SortColumn = Tuple[int, int, str]
+
+
+def encode_row(fields: List[str], column_sizes: List[int]) -> Union[bytes, None]:
+    '''
+    Pads each field of a csv row with spaces to the size of its column.
+    Returns None if the row does not have one field per column or if
+    a field is larger than its column.
+    '''
+    if len(fields) != len(column_sizes):
+        return None
+    text = ''.join(field.ljust(size) for field, size in zip(fields, column_sizes))
+    data = text.encode('utf-8')
+    if len(data) == len(text) == sum(column_sizes):
+        # only one byte characters and every field fits on its column
+        return data
+    encoded = []
+    for field, size in zip(fields, column_sizes):
+        data = field.encode('utf-8')
+        if len(data) > size:
+            return None
+        encoded.append(data + b' '*(size - len(data)))
+    return b''.join(encoded)
+
+
+def encode_rows(rows: Iterable[List[str]], column_sizes: List[int],
+                separator: str = ',', prefix: bytes = b'') -> Iterator[bytes]:
+    '''
+    Encodes the rows read from a csv file as registers, with prefix
+    (e.g. the logical byte) before each one. Rows that do not fit on
+    the columns are skipped.
+    '''
+    for fields in rows:
+        if not fields:
+            continue
+        register = encode_row(fields, column_sizes)
+        if register is None:
+            logging.warning(
+                f'The register {separator.join(fields)} cannot be added'
+                f' because it does not fit on the columns of the table.')
+            continue
+        yield prefix + register
+
+
+def read_csv_chunks(file_path: str, column_sizes: List[int],
+                    separator: str = ',', max_lines: int = None,
+                    prefix: bytes = b'',
+                    chunk_size: int = CSV_CHUNK_REGISTERS) -> Iterator[List[bytes]]:
+    '''
+    Reads a csv file (with a header line) and yields its rows encoded as
+    registers (see encode_rows), chunk_size registers at a time, so only
+    one chunk is kept in memory.
+    max_lines: maximum of registers to read (all of them, if None)
+    '''
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, delimiter=separator)
+        # skip header
+        next(reader, None)
+        chunk, loaded = [], 0
+        for register in encode_rows(reader, column_sizes, separator, prefix):
+            if max_lines is not None and loaded == max_lines:
+                break
+            chunk.append(register)
+            loaded += 1
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def sort_registers(registers: List[bytes],
+                   sort_column: SortColumn) -> List[bytes]:
+    size_till_column, column_size, column_type = sort_column
+    end = size_till_column + column_size
+    return sorted(registers, key=lambda register: encode_key(
+        register[size_till_column:end].decode(), column_type))
+
+
+def split_csv_ranges(file_path: str,
+                     range_size: int = PARALLEL_LOAD_RANGE_BYTES) \
+        -> List[Tuple[int, int]]:
+    '''
+    Splits the rows of a csv file (after its header line) into ranges
+    of about range_size bytes, each one ending on a line break.
+    Quoted fields holding line breaks are not supported.
+    '''
+    ranges = []
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + range_size, size))
+            # move on to the end of the line
+            f.readline()
+            ranges.append((start, f.tell()))
+            start = f.tell()
+    return ranges
+
+
+def encode_csv_range(task: Tuple) -> bytes:
+    '''
+    Work done by each process of a parallel load: encodes the rows of
+    the csv file between two positions (see split_csv_ranges) and
+    returns the registers, sorted by sort column if one is given.
+    '''
+    file_path, start, end, separator, column_sizes, prefix, sort_column = task
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+    reader = csv.reader(io.StringIO(text, newline=''), delimiter=separator)
+    registers = list(encode_rows(reader, column_sizes, separator, prefix))
+    if sort_column is not None:
+        registers = sort_registers(registers, sort_column)
+    return b''.join(registers)
+
+
+def encode_csv_parallel(file_path: str, column_sizes: List[int],
+                        separator: str = ',', prefix: bytes = b'',
+                        sort_column: SortColumn = None,
+                        workers: int = None) -> Iterator[bytes]:
+    '''
+    Encodes a csv file (with a header line) with a pool of worker
+    processes, one range of PARALLEL_LOAD_RANGE_BYTES per task. Yields
+    the registers of each range in the order of the file, so a single
+    writer can append them. At most two ranges per worker are kept
+    in memory.
+    workers: amount of processes (one per core, if None)
+    '''
+    tasks = [(file_path, start, end, separator, column_sizes, prefix,
+              sort_column) for start, end in split_csv_ranges(file_path)]
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        yield from map(encode_csv_range, tasks)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        for idx in range(0, len(tasks), 2*workers):
+            yield from pool.imap(encode_csv_range, tasks[idx:idx + 2*workers])
+
+
+class LoadProgress:
+    '''
+    Counts the registers and bytes loaded since start, to log throughput.
+    '''
+
+    def __init__(self, register_size: int) -> None:
+        self.register_size = register_size
+        self.registers = 0
+        self.started = time.perf_counter()
+
+    def add(self, amount: int, log_info: bool = True) -> None:
+        self.registers += amount
+        if log_info:
+            logging.info(f'{self.registers} registers loaded '
+                         f'({self.throughput()}).')
+
+    def throughput(self) -> str:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        megabytes = self.registers*self.register_size / (1024*1024)
+        return f'{self.registers/elapsed:.0f} registers/s, ' \
+            f'{megabytes/elapsed:.2f} MB/s'
@@ -0,0 +1,87 @@
+import struct
+from typing import BinaryIO, Iterable, List
+import numpy as np
+from .configs import FREE_MAP_SEARCH_BYTES
+
+MAGIC = b'FMAP'
+# magic and amount of slots summarized
+META_FORMAT = '>4sQ'
+META_SIZE = struct.calcsize(META_FORMAT)
+
+
+class FreeMap:
+    '''
+    Free slots of a heap file, kept in a sidecar file as a bitmap: bit n
+    (most significant bits first) is set if slot n of the record area is
+    free. Slots after the last summarized one are all in use, so
+    registers appended to the file do not change it.
+    '''
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        f.seek(0)
+        magic, self.slots = struct.unpack(META_FORMAT, f.read(META_SIZE))
+        if magic != MAGIC:
+            raise ValueError('The file is not a free space map.')
+        self.bits = np.frombuffer(f.read(-(-self.slots // 8)),
+                                  dtype=np.uint8).copy()
+
+    @staticmethod
+    def create(f: BinaryIO, free_slots: Iterable[int]) -> 'FreeMap':
+        free_slots = np.asarray(sorted(free_slots), dtype=np.int64)
+        slots = int(free_slots[-1]) + 1 if len(free_slots) else 0
+        bits = np.zeros(slots, dtype=bool)
+        bits[free_slots] = True
+        f.seek(0)
+        f.write(struct.pack(META_FORMAT, MAGIC, slots) +
+                np.packbits(bits).tobytes())
+        return FreeMap(f)
+
+    def free_slots(self) -> np.ndarray:
+        '''
+        Every free slot, in order.
+        '''
+        return np.flatnonzero(np.unpackbits(self.bits)[:self.slots])
+
+    def find(self, amount: int, after: int = -1) -> List[int]:
+        '''
+        Lowest amount free slots after slot after (or less, if there are
+        not enough), searching FREE_MAP_SEARCH_BYTES bytes at a time.
+        '''
+        found = []
+        position = (after + 1) // 8
+        while len(found) < amount and position < len(self.bits):
+            window = self.bits[position:position + FREE_MAP_SEARCH_BYTES]
+            slots = np.flatnonzero(np.unpackbits(window)) + position*8
+            slots = slots[(slots > after) & (slots < self.slots)]
+            found += slots[:amount - len(found)].tolist()
+            position += FREE_MAP_SEARCH_BYTES
+        return found
+
+    def set(self, slots: List[int], free: bool) -> None:
+        '''
+        Marks slots as free (or in use) and writes the bytes changed.
+        '''
+        if not len(slots):
+            return
+        slots = np.asarray(slots, dtype=np.int64)
+        highest = int(slots.max())
+        if free and highest >= self.slots:
+            self.slots = highest + 1
+            grown = -(-self.slots // 8) - len(self.bits)
+            self.bits = np.concatenate([self.bits,
+                                        np.zeros(grown, dtype=np.uint8)])
+            self.f.seek(0)
+            self.f.write(struct.pack(META_FORMAT, MAGIC, self.slots))
+        slots = slots[slots < self.slots]
+        if not len(slots):
+            return
+        masks = np.left_shift(1, 7 - slots % 8).astype(np.uint8)
+        positions = slots // 8
+        if free:
+            np.bitwise_or.at(self.bits, positions, masks)
+        else:
+            np.bitwise_and.at(self.bits, positions, ~masks)
+        low, high = int(positions.min()), int(positions.max())
+        self.f.seek(META_SIZE + low)
+        self.f.write(self.bits[low:high + 1].tobytes())
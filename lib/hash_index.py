@@ -0,0 +1,252 @@
+import struct
+import zlib
+from typing import BinaryIO, Iterator, List, Tuple
+from .configs import HASH_INDEX_INITIAL_BUCKETS, HASH_INDEX_MAX_LOAD
+
+MAGIC = b'LHIX'
+# magic, page size, key length, initial buckets, level, next split,
+# amount of entries, pages on overflow file, first free overflow page
+META_FORMAT = '>4sIHIIIQIi'
+META_COLUMN_LENGTH = 64
+# amount of entries on the page, next overflow page (-1 if none)
+PAGE_HEADER_FORMAT = '>Hi'
+PAGE_HEADER_SIZE = struct.calcsize(PAGE_HEADER_FORMAT)
+NO_PAGE = -1
+
+
+class HashIndex:
+    '''
+    Persistent linear hashing index, mapping the key of a column
+    (see keys.encode_key) to the position of the register on the db file.
+    The index file holds a meta page followed by one page per bucket:
+    bucket b is page b + 1. Entries that do not fit on the page of their
+    bucket go to a chain of pages on the overflow file.
+    Buckets are split one at a time, in order, whenever the amount of
+    entries per bucket goes over HASH_INDEX_MAX_LOAD of a page.
+    '''
+
+    def __init__(self, index_file: BinaryIO, overflow_file: BinaryIO) -> None:
+        self.index_file = index_file
+        self.overflow_file = overflow_file
+        self._read_meta()
+
+    @staticmethod
+    def create(index_file: BinaryIO, column: str, key_length: int,
+               page_size: int) -> None:
+        '''
+        Writes the meta page and the empty buckets of a new index.
+        '''
+        meta = struct.pack(META_FORMAT, MAGIC, page_size, key_length,
+                           HASH_INDEX_INITIAL_BUCKETS, 0, 0, 0, 0, NO_PAGE)
+        column_bytes = column.encode('utf-8')[:META_COLUMN_LENGTH]
+        meta += column_bytes + b' '*(META_COLUMN_LENGTH - len(column_bytes))
+        index_file.seek(0)
+        index_file.write(meta + b'\x00'*(page_size - len(meta)))
+        for _ in range(HASH_INDEX_INITIAL_BUCKETS):
+            index_file.write(HashIndex._empty_page(page_size))
+        index_file.truncate()
+
+    @staticmethod
+    def read_column(index_file: BinaryIO) -> str:
+        index_file.seek(struct.calcsize(META_FORMAT))
+        return index_file.read(META_COLUMN_LENGTH).decode('utf-8').strip(' ')
+
+    @staticmethod
+    def _empty_page(page_size: int) -> bytes:
+        header = struct.pack(PAGE_HEADER_FORMAT, 0, NO_PAGE)
+        return header + b'\x00'*(page_size - PAGE_HEADER_SIZE)
+
+    def _read_meta(self) -> None:
+        self.index_file.seek(0)
+        meta = self.index_file.read(struct.calcsize(META_FORMAT))
+        magic, self.page_size, self.key_length, self.initial_buckets, \
+            self.level, self.next_split, self.amount, self.overflow_pages, \
+            self.free_overflow = struct.unpack(META_FORMAT, meta)
+        if magic != MAGIC:
+            raise ValueError('File is not a hash index.')
+        self.column = self.read_column(self.index_file)
+        self.slot_size = 1 + self.key_length + 8
+        self.slots_per_page = (self.page_size - PAGE_HEADER_SIZE) // self.slot_size
+
+    def _write_meta(self) -> None:
+        self.index_file.seek(0)
+        self.index_file.write(struct.pack(
+            META_FORMAT, MAGIC, self.page_size, self.key_length,
+            self.initial_buckets, self.level, self.next_split, self.amount,
+            self.overflow_pages, self.free_overflow))
+
+    @property
+    def buckets(self) -> int:
+        return self.initial_buckets * 2**self.level + self.next_split
+
+    def _bucket_of(self, key: bytes) -> int:
+        hashed = zlib.crc32(key)
+        bucket = hashed % (self.initial_buckets * 2**self.level)
+        if bucket < self.next_split:
+            # already split on this level
+            bucket = hashed % (self.initial_buckets * 2**(self.level + 1))
+        return bucket
+
+    # a page is addressed by (True, bucket) on the index file
+    # or by (False, page number) on the overflow file
+    def _page_file(self, primary: bool, number: int) -> Tuple[BinaryIO, int]:
+        if primary:
+            return self.index_file, (number + 1)*self.page_size
+        return self.overflow_file, number*self.page_size
+
+    def _read_page(self, primary: bool,
+                   number: int) -> Tuple[List[Tuple[bytes, int]], int]:
+        f, position = self._page_file(primary, number)
+        f.seek(position)
+        page = f.read(self.page_size)
+        amount, next_page = struct.unpack(PAGE_HEADER_FORMAT,
+                                          page[:PAGE_HEADER_SIZE])
+        entries = []
+        for idx in range(amount):
+            start = PAGE_HEADER_SIZE + idx*self.slot_size
+            length = page[start]
+            key = page[start + 1:start + 1 + length]
+            offset = struct.unpack(
+                '>Q', page[start + 1 + self.key_length:start + self.slot_size])[0]
+            entries.append((key, offset))
+        return entries, next_page
+
+    def _write_page(self, primary: bool, number: int,
+                    entries: List[Tuple[bytes, int]], next_page: int) -> None:
+        f, position = self._page_file(primary, number)
+        data = [struct.pack(PAGE_HEADER_FORMAT, len(entries), next_page)]
+        for key, offset in entries:
+            data.append(bytes([len(key)]) + key +
+                        b'\x00'*(self.key_length - len(key)) +
+                        struct.pack('>Q', offset))
+        data = b''.join(data)
+        f.seek(position)
+        f.write(data + b'\x00'*(self.page_size - len(data)))
+
+    def _chain(self, bucket: int) -> Iterator[Tuple[bool, int, List, int]]:
+        '''
+        Yields every page of the chain of a bucket.
+        '''
+        primary, number = True, bucket
+        while number != NO_PAGE:
+            entries, next_page = self._read_page(primary, number)
+            yield primary, number, entries, next_page
+            primary, number = False, next_page
+
+    def _new_overflow_page(self) -> int:
+        if self.free_overflow != NO_PAGE:
+            number = self.free_overflow
+            _, self.free_overflow = self._read_page(False, number)
+        else:
+            number = self.overflow_pages
+            self.overflow_pages += 1
+        return number
+
+    def _free_overflow_page(self, number: int) -> None:
+        self._write_page(False, number, [], self.free_overflow)
+        self.free_overflow = number
+
+    def lookup(self, key: bytes) -> List[int]:
+        '''
+        Positions of every register whose key is key.
+        '''
+        return [offset for _, _, entries, _ in self._chain(self._bucket_of(key))
+                for entry_key, offset in entries if entry_key == key]
+
+    def insert(self, key: bytes, offset: int) -> None:
+        self._insert_on_bucket(self._bucket_of(key), key, offset)
+        self.amount += 1
+        if self.amount > HASH_INDEX_MAX_LOAD*self.slots_per_page*self.buckets:
+            self._split()
+        self._write_meta()
+
+    def _insert_on_bucket(self, bucket: int, key: bytes, offset: int) -> None:
+        for primary, number, entries, next_page in self._chain(bucket):
+            if len(entries) < self.slots_per_page:
+                entries.append((key, offset))
+                self._write_page(primary, number, entries, next_page)
+                return
+            if next_page == NO_PAGE:
+                # chain is full, link a new overflow page at its end
+                new_page = self._new_overflow_page()
+                self._write_page(False, new_page, [(key, offset)], NO_PAGE)
+                self._write_page(primary, number, entries, new_page)
+                return
+
+    def delete(self, key: bytes, offset: int) -> bool:
+        for primary, number, entries, next_page in \
+                self._chain(self._bucket_of(key)):
+            if (key, offset) in entries:
+                entries.remove((key, offset))
+                self._write_page(primary, number, entries, next_page)
+                self.amount -= 1
+                self._write_meta()
+                return True
+        return False
+
+    def _split(self) -> None:
+        '''
+        Splits the next bucket in order, moving about half of its entries
+        to a new bucket at the end of the index file.
+        '''
+        old_bucket = self.next_split
+        entries, overflow = [], []
+        for primary, number, page_entries, _ in self._chain(old_bucket):
+            entries += page_entries
+            if not primary:
+                overflow.append(number)
+        for number in overflow:
+            self._free_overflow_page(number)
+        self._write_page(True, old_bucket, [], NO_PAGE)
+        new_bucket = self.buckets
+        self._write_page(True, new_bucket, [], NO_PAGE)
+        self.next_split += 1
+        if self.next_split == self.initial_buckets * 2**self.level:
+            self.level += 1
+            self.next_split = 0
+        for key, offset in entries:
+            self._insert_on_bucket(self._bucket_of(key), key, offset)
+
+    def _insert_many_on_bucket(self, bucket: int,
+                               new_entries: List[Tuple[bytes, int]]) -> None:
+        '''
+        Same as _insert_on_bucket for several entries, writing each
+        page of the chain at most once.
+        '''
+        last = None
+        for primary, number, entries, next_page in self._chain(bucket):
+            room = self.slots_per_page - len(entries)
+            if room > 0:
+                entries += new_entries[:room]
+                new_entries = new_entries[room:]
+                # the last page is written below, if it gets a next one
+                if not new_entries or next_page != NO_PAGE:
+                    self._write_page(primary, number, entries, next_page)
+            if not new_entries:
+                return
+            last = primary, number, entries
+        # chain is full, link new overflow pages at its end
+        primary, number, entries = last
+        while new_entries:
+            new_page = self._new_overflow_page()
+            self._write_page(primary, number, entries, new_page)
+            primary, number = False, new_page
+            entries = new_entries[:self.slots_per_page]
+            new_entries = new_entries[self.slots_per_page:]
+        self._write_page(primary, number, entries, NO_PAGE)
+
+    def bulk_insert(self, entries: List[Tuple[bytes, int]]) -> None:
+        if not entries:
+            return
+        # buckets are split first, as if every entry was inserted
+        # already, so each bucket is then written once
+        self.amount += len(entries)
+        while self.amount > \
+                HASH_INDEX_MAX_LOAD*self.slots_per_page*self.buckets:
+            self._split()
+        buckets = {}
+        for key, offset in entries:
+            buckets.setdefault(self._bucket_of(key), []).append((key, offset))
+        for bucket, bucket_entries in buckets.items():
+            self._insert_many_on_bucket(bucket, bucket_entries)
+        self._write_meta()
@@ -0,0 +1,129 @@
+import os
+from datetime import datetime
+from typing import BinaryIO, Dict, List, Tuple
+from .configs import (
+    FIELDS,
+    MAX_HEADER_COLUMNS,
+    MAX_SPACE_POINTERS,
+    POINTERS_INDEX,
+    TIMESTAMP_LENGTH,
+)
+
+
+def file_signature(file_name: str) -> Tuple[int, int]:
+    '''
+    Size and modification time of a file, used to notice writes
+    made by other processes.
+    '''
+    stat = os.stat(file_name)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class TableHeader:
+    '''
+    Parsed, in-memory copy of the header of a db file.
+    The column map ('0:14;1:2;...') and the pointers string ('a-b;c-d;...')
+    are parsed only once. Values from the pointer fields (amount, timestamp,
+    first_empty and first_register) are kept in memory, changed there
+    by the writes and only written back to the file on flush. The
+    creation timestamp is kept too, so rewrites of the file preserve it.
+    The size and modification time of the file are remembered, so writes
+    made by another process are noticed and the header is loaded again.
+    '''
+
+    def __init__(self, file_name: str) -> None:
+        self.file_name = file_name
+        self.column_sizes: List[int] = []
+        self.column_offsets: List[int] = []
+        self.register_size = 0
+        self.pointers: Dict[str, Tuple[int, int]] = {}
+        self.values: Dict[str, str] = {}
+        self.dirty = set()
+        self.created_at = None
+        self._signature = None
+
+    def load(self, f: BinaryIO) -> None:
+        '''
+        Reads and parses the header from the already opened file f.
+        '''
+        f.seek(0)
+        raw = f.read(MAX_HEADER_COLUMNS + MAX_SPACE_POINTERS).decode()
+        columns = raw[:MAX_HEADER_COLUMNS].strip().split(';')[:-1]
+        self.column_sizes = [int(pair.split(':')[1]) for pair in columns]
+        self.column_offsets = [sum(self.column_sizes[:idx])
+                               for idx in range(len(self.column_sizes))]
+        self.register_size = sum(self.column_sizes)
+        pointers = raw[MAX_HEADER_COLUMNS:].split(';')
+        self.pointers = {}
+        for field, idx in POINTERS_INDEX.items():
+            start, end = pointers[idx].split('-')
+            self.pointers[field] = (int(start), int(end))
+        self.values = {}
+        for field, (start, end) in self.pointers.items():
+            f.seek(start)
+            self.values[field] = f.read(end - start).decode().strip(' ')
+        # the creation timestamp comes right after the amount field
+        f.seek(self.pointers['amount'][1] + len(FIELDS['timestamp_creation']))
+        self.created_at = f.read(TIMESTAMP_LENGTH).decode()
+        self.dirty = set()
+        self.mark_synced()
+
+    def mark_synced(self) -> None:
+        '''
+        Remembers the current state of the file as the one we know about.
+        '''
+        self._signature = file_signature(self.file_name)
+
+    def is_stale(self) -> bool:
+        '''
+        True if the file was changed by someone else since the last
+        load or flush. Pending changes are never thrown away.
+        '''
+        if self.dirty:
+            return False
+        try:
+            return file_signature(self.file_name) != self._signature
+        except FileNotFoundError:
+            return True
+
+    @property
+    def records_start(self) -> int:
+        '''
+        Position of the first byte after the header, where the first
+        block of registers starts.
+        '''
+        return self.pointers['first_register'][1] + 1
+
+    def get(self, field: str) -> str:
+        return self.values[field]
+
+    def set(self, field: str, value: str) -> None:
+        self.values[field] = value
+        self.dirty.add(field)
+
+    def add_amount(self, amount: int) -> None:
+        self.set('amount', str(int(self.values['amount']) + amount))
+
+    def touch(self) -> None:
+        self.set('timestamp', datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
+
+    def column_info(self, column_idx: int) -> Tuple[int, int, int]:
+        '''
+        Returns the size of the column, the size of every column before it
+        and the size of the full register.
+        '''
+        return self.column_sizes[column_idx], self.column_offsets[column_idx], \
+            self.register_size
+
+    def flush(self, f: BinaryIO) -> None:
+        '''
+        Writes every changed field back to the opened file f.
+        '''
+        for field in sorted(self.dirty, key=lambda x: self.pointers[x][0]):
+            start, end = self.pointers[field]
+            value = self.values[field]
+            f.seek(start)
+            f.write(bytearray(value + ' '*(end - start - len(value)), 'utf8'))
+        self.dirty = set()
+        f.flush()
+        self.mark_synced()
@@ -1,26 +1,68 @@
+import io
 import logging
 import os
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Any, Dict, List, Tuple, Union
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    Union
+)
 import numpy as np
 import pandas as pd
 from itertools import islice
+from .aggregate import Aggregation
+from .btree import BPlusTree, node_size_for
+from .csv_loader import LoadProgress, encode_csv_parallel, read_csv_chunks
+from .free_map import FreeMap
+from .hash_index import HashIndex
+from .header import TableHeader
+from .session import TableSession, read_operation, table_operation
+from .table_lock import TableLock
+from .vacuum import Vacuum
+from .wal import WriteAheadLog, replay_log
+from .vector_scan import (
+    iter_scan_file,
+    iter_select_records,
+    record_dtype,
+    records_to_columns,
+    scan_file
+)
+from .zone_map import ZoneMap, build_zone_map, register_keys
+from .keys import (
+    encode_key,
+    key_bounds,
+    key_length,
+    key_matcher,
+    register_parser,
+    search_keys
+)
 from .helpers import (
-    check_between,
-    read_and_decode,
     adjust_digit_counts,
-    convert_list_to_str
+    convert_list_to_str,
+    iter_registers,
+    replace_file,
+    spill_registers
 )
 from .configs import (
     AMOUNT_POINTERS_CHARACTERS,
+    BUFFER_POOL_SIZE,
     FIELDS,
     FIRST_REGISTER_LENGTH,
+    HASH_INDEX_PAGE_SIZE,
     MAX_HEADER_COLUMNS,
     MAX_REGISTERS_LENGTH,
-    MAX_SPACE_POINTERS,
     NEXT_AVALIABLE_LENGTH,
-    POINTERS_INDEX,
+    QUERY_CHUNK_REGISTERS,
+    SCAN_WORKERS,
     TIMESTAMP_LENGTH,
+    WRITE_AHEAD_LOG,
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -33,7 +75,9 @@ class FixedHeap:
         table_name: str,
         blocking_factor: int,
         fields_info: Dict,
-        # need to calculate position
+        buffer_pool_size: int = BUFFER_POOL_SIZE,
+        scan_workers: int = SCAN_WORKERS,
+        write_ahead_log: bool = WRITE_AHEAD_LOG,
     ) -> None:
         '''
         table_name: maximum of 32 characters (will be truncated)
@@ -45,6 +89,13 @@ class FixedHeap:
                 'size': 'max_size_of_field', (e.g.: 32)
             }
         }
+        buffer_pool_size: bytes of blocks kept in memory while the table is used
+        scan_workers: processes used by full scans of large files
+        (one per core, if None)
+        write_ahead_log: log the pages written by each operation before
+        writing them in place, so a crash never leaves an operation half
+        done (see wal.WriteAheadLog). Once a table has a log, it is used
+        by every process, with or without write_ahead_log
         '''
         self.file_name = file_name
         self.table_name = table_name
@@ -54,6 +105,22 @@ class FixedHeap:
         self.register_types = [col['type'] for col in fields_info.values()]
         self.register_sizes = [int(col['size'])
                                for col in fields_info.values()]
+        self.buffer_pool_size = buffer_pool_size
+        self.scan_workers = scan_workers
+        self.write_ahead_log = write_ahead_log
+        self._header = None
+        self._session = None
+        self._hash_index = None
+        self._btree_indexes = None
+        self._zone_map = None
+        self._free_map = None
+        self._vacuum = None
+        self._wal = None
+        self._table_lock = TableLock(self._sidecar_path('lock'),
+                                     self._sidecar_path('gate'))
+        # generation of the table left by the last operation (see TableLock)
+        self._generation = None
+        self._free_map_in_memory = False
 
     def _check_file(self) -> bool:
         if os.path.exists(self.file_name):
@@ -67,8 +134,8 @@ class FixedHeap:
         with open(file=self.file_name, mode='w+b') as f:
             f.write(bytearray(header_text, 'utf-8'))
 
-    def _build_header_string(self) -> str:
-        pointers, text = self._build_text_and_positions()
+    def _build_header_string(self, created_at: str = None) -> str:
+        pointers, text = self._build_text_and_positions(created_at)
         # calculate the final position for each value
         spaces = [MAX_REGISTERS_LENGTH, TIMESTAMP_LENGTH,
                   NEXT_AVALIABLE_LENGTH, FIRST_REGISTER_LENGTH]
@@ -119,15 +186,18 @@ class FixedHeap:
             create_table_str += f'{column} {col_type}({size}),\n'
         return create_table_str
 
-    def _build_text_and_positions(self) -> List[Union[List, str]]:
+    def _build_text_and_positions(
+            self, created_at: str = None) -> List[Union[List, str]]:
         current_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        # rewrites of an existing file keep the time it was created
+        created_at = created_at or current_time
         final_text = ''
         final_text += FIELDS['table_name'] + self.table_name + \
             FIELDS['blocking_factor'] + str(self.blocking_factor) + \
             FIELDS['total_registers']
         amount_pointer = len(final_text)
         final_text += '0' + ' '*(MAX_REGISTERS_LENGTH - 1) + \
-            FIELDS['timestamp_creation'] + current_time + \
+            FIELDS['timestamp_creation'] + created_at + \
             FIELDS['timestamp_update']
         timestamp_pointer = len(final_text)
         final_text += current_time + '\n\n' + self._build_create_table() + \
@@ -139,129 +209,271 @@ class FixedHeap:
                     first_space_pointer, first_register_pointer]
         return [pointers, final_text]
 
+    @classmethod
+    def open(cls, *args, **kwargs) -> 'FixedHeap':
+        '''
+        Opens the table for a session: its files stay open until close()
+        is called, instead of being opened by every operation.
+        Accepts the same arguments as the constructor. Can be used as:
+        with FixedHeap.open(file_name, ...) as table:
+            table.single_insert(...)
+        '''
+        table = cls(*args, **kwargs)
+        table._start_session()
+        return table
+
+    def close(self) -> None:
+        self._close_session()
+        self._table_lock.close()
+
+    def _close_session(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        self._hash_index = None
+        self._btree_indexes = None
+        self._zone_map = None
+        self._free_map = None
+
+    def __enter__(self) -> 'FixedHeap':
+        if self._session is None:
+            self._start_session()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _start_session(self) -> None:
+        self._session = TableSession(self.buffer_pool_size, self._wal)
+        if self._header is not None:
+            self._set_layouts()
+
+    def _drop_log(self) -> None:
+        '''
+        Empties the write ahead log, if the table keeps one, so none of
+        its pages is written over a new file.
+        '''
+        if self._wal is None:
+            self._open_log()
+        if self._wal is not None:
+            self._wal.checkpoint()
+
+    def _open_log(self) -> None:
+        '''
+        Opens the write ahead log, if the table keeps one. The log belongs
+        to the table: once a process opens it with write_ahead_log, every
+        process writing the table logs its pages as well, otherwise a page
+        written without the log could be overwritten by an older one
+        replayed from it. What a crash left on the log is replayed first.
+        The log is only ever emptied, never removed, as other processes
+        may be appending to it.
+        '''
+        path = self._sidecar_path('wal')
+        if not self.write_ahead_log and not os.path.exists(path):
+            return
+        with self._table_lock.hold():
+            if os.path.exists(path):
+                replay_log(path)
+            self._wal = WriteAheadLog(path)
+        if self._session is not None:
+            self._session.pool.wal = self._wal
+
+    @contextmanager
+    def _operation(self, shared: bool = False) -> Iterator[TableSession]:
+        '''
+        Wraps a public operation. Without an open session, a temporary one
+        is used, so each file is opened at most once per operation.
+        The lock of the table is held meanwhile, shared if the operation
+        only reads (see table_lock.TableLock).
+        '''
+        generation = self._table_lock.acquire(shared)
+        try:
+            if self._wal is None and self._table_lock.depth == 1:
+                self._open_log()
+                # the lock may have been taken exclusively meanwhile
+                generation = self._table_lock.generation
+            temporary = self._session is None
+            if temporary:
+                self._start_session()
+            session = self._session
+            if session.depth == 0:
+                self._refresh_header(generation != self._generation)
+            session.depth += 1
+            try:
+                yield session
+                if session.depth == 1:
+                    # the header is committed along with the pages changed
+                    self._flush_header()
+                    session.flush()
+            except Exception:
+                if session.depth == 1:
+                    # nothing of a failed operation is committed
+                    session.rollback()
+                    self._forget_indexes(replaced=False)
+                # pending header changes cannot be trusted anymore
+                self._header = None
+                self._free_map = None
+                raise
+            finally:
+                session.depth -= 1
+                if temporary:
+                    self._close_session()
+        finally:
+            self._generation = self._table_lock.release()
+
+    @contextmanager
+    def _open_file(self, path: str) -> Iterator[BinaryIO]:
+        '''
+        Gives the handle kept by the session for path.
+        '''
+        yield self._session.handle(path)
+
+    def _get_header(self) -> TableHeader:
+        if self._header is None:
+            self._header = TableHeader(self.file_name)
+            self._load_header()
+        return self._header
+
+    def _load_header(self) -> None:
+        with self._open_file(self.file_name) as f:
+            self._header.load(f)
+        self._set_layouts()
+
+    def _set_layouts(self) -> None:
+        # one page of the buffer pool is one block of registers
+        block_size = self.blocking_factor * self._header.register_size
+        self._session.set_layout(self.file_name, self._header.records_start,
+                                 block_size)
+
+    def _refresh_header(self, changed: bool = False) -> None:
+        '''
+        Called at the beginning of every operation. Loads the header again
+        only if the file was modified by someone else (or changed, the
+        generation of the table moved).
+        '''
+        if self._header is not None and (changed or self._header.is_stale()):
+            # the buffer of the handle may hold old data as well
+            self._session.forget(self.file_name, replaced=False)
+            self._load_header()
+            # the indexes were probably changed along with the file
+            self._forget_indexes(replaced=False)
+            self._drop_vacuum()
+
+    def _flush_header(self) -> None:
+        '''
+        Called at the end of every operation. Writes the changed header
+        fields at once.
+        '''
+        header = self._get_header()
+        with self._open_file(self.file_name) as f:
+            header.flush(f)
+
     def _update_desired_fields(self, fields: List[str], amounts: List[int]) -> None:
+        header = self._get_header()
         for field, amount in zip(fields, amounts):
-            start, end = self._get_start_and_end_field(field=field)
-            curr_value = self._get_desired_value(start, end)
-            with open(file=self.file_name, mode='r+b') as f:
-                f.seek(int(start))
-                if field == 'timestamp':
-                    date = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                    f.write(bytearray(date, 'utf8'))
-                elif field == 'amount':
-                    f.write(bytearray(str(int(curr_value)+amount), 'utf8'))
-                else:
-                    str_amount = str(amount)
-                    f.write(bytearray(
-                        str_amount + ' ' *
-                            (FIRST_REGISTER_LENGTH - len(str_amount)),
-                            'utf8'))
-
-    def _get_desired_value(self, start, end) -> str:
-        return read_and_decode(self.file_name, int(start), int(end))
-
-    def _get_start_and_end_field(self, field: str) -> List[str]:
-        pointers_string = read_and_decode(
-            self.file_name, MAX_HEADER_COLUMNS, MAX_SPACE_POINTERS + MAX_HEADER_COLUMNS)
-        field_range = pointers_string.split(';')[POINTERS_INDEX[field]]
-        start, end = field_range.split('-')
-        return start, end
+            if field == 'timestamp':
+                header.touch()
+            elif field == 'amount':
+                header.add_amount(amount)
+            else:
+                header.set(field, str(amount))
 
     def _get_value_from_field(self, field: str) -> str:
         '''
         Get value from a desired field of the header of the db file.
         '''
-        start, end = self._get_start_and_end_field(field)
-        return self._get_desired_value(start, end)
+        return self._get_header().get(field)
 
     def create_register_file(self) -> None:
         logging.info('Creating database file...')
-        self._make_header()
+        with self._table_lock.hold():
+            if not self._check_file():
+                # maps and log left by a table whose file was removed
+                for extension in ('zmap', 'fmap'):
+                    if os.path.exists(self._sidecar_path(extension)):
+                        os.remove(self._sidecar_path(extension))
+                self._drop_log()
+            self._make_header()
         logging.info('Database file created!')
 
-    def _find_avaliable_spot(self) -> int:
-        start, end = self._get_start_and_end_field(field='first_empty')
-        curr_value = self._get_desired_value(start, end)
-        return int(curr_value)
-
-    def _write_on_end(self, records: List, log_info: bool = False) -> None:
+    def _write_on_end(self, records: List, log_info: bool = False) -> int:
         registers, amount = records
-        with open(file=self.file_name, mode='r+b') as f:
-            f.seek(-1, 2)
+        with self._open_file(self.file_name) as f:
+            start = f.seek(-1, 2)
             for register in registers:
                 f.write(register)
         if log_info:
             logging.info(f'{amount} register(s) added!')
+        return start
 
-    def _write_on_free_spot(self, record: str, free_spot: int,
-                            log_info: bool = True) -> None:
-        next_free = 0
-        first_register = int(self._get_value_from_field('first_register'))
-        register_size = len(record) - 1  # space at the end
-        # dont need to write the space
-        result = bytearray(record[:-1], 'utf-8')
-        with open(file=self.file_name, mode='r+b') as f:
-            f.seek(free_spot, 0)
-            next_free = int(f.read(register_size).decode().strip(' '))
-            f.seek(-register_size, 1)
-            f.write(result)
-        # check if we need to update the first_register pointer
-        if first_register > free_spot:
-            self._update_desired_fields(
-                fields=['first_register'], amounts=[free_spot])
-        self._update_desired_fields(
-            fields=['first_empty'], amounts=[next_free])
-        if log_info:
-            logging.info('Register added!')
+    def _write_on_free_spots(self, registers: List[bytes],
+                             offsets: List[int]) -> None:
+        '''
+        Writes registers on the free slots at offsets (see _claim_slots),
+        consecutive slots with a single write, so each block is written
+        at most once.
+        '''
+        register_size = self._get_size_of_register()
+        with self._open_file(self.file_name) as f:
+            idx = 0
+            while idx < len(offsets):
+                end = idx + 1
+                while end < len(offsets) and \
+                        offsets[end] == offsets[end - 1] + register_size:
+                    end += 1
+                f.seek(offsets[idx])
+                f.write(b''.join(registers[idx:end]))
+                idx = end
 
+    @table_operation
     def single_insert(self, *args) -> int:
         result = ''
         for info in args:
             result += str(info)
         # this space will be consumed for the next write
         result += ' '
-        avaliable_spot = self._find_avaliable_spot()
         byte_result = bytearray(result, 'utf-8')
+        free_spots = self._claim_slots(1)
         # no free spot, append on the end
-        if avaliable_spot == -1:
-            self._write_on_end([[byte_result], 1], True)
+        if not free_spots:
+            avaliable_spot = self._write_on_end([[byte_result], 1], True)
         else:
-            self._write_on_free_spot(result, avaliable_spot)
+            avaliable_spot = free_spots[0]
+            # dont need to write the space
+            self._write_on_free_spots([byte_result[:-1]], free_spots)
+            logging.info('Register added!')
+        self._index_registers([(result, avaliable_spot)])
         self._update_desired_fields(
             fields=['amount', 'timestamp'], amounts=[1, 1])
         return 1
 
+    @table_operation
     def bulk_insert(self, registers: List[List]) -> int:
-        free_space = True
-        curr_index = 0
         total_registers = len(registers)
-        while free_space:
-            for _, register_info in enumerate(registers):
-                register = ''.join([str(item) for item in register_info])
-                # this space will be consumed for the next write
-                register += ' '
-                avaliable_spot = self._find_avaliable_spot()
-                if avaliable_spot == -1:
-                    free_space = False
-                    # write rest on the end
-                    break
-                # if we have avaliable spot, write on it
-                self._write_on_free_spot(register, avaliable_spot, False)
-                curr_index += 1
-        if curr_index < total_registers:
-            remaining = registers[curr_index:]
-            write_list = [bytearray(convert_list_to_str(
-                item), encoding='utf-8') for item in remaining[:-1]]
-            # last item needs to have a space at the end, thats why we dont go
-            # until the end on the line above
-            write_list.append(bytearray(convert_list_to_str(
-                remaining[-1]) + ' ', encoding='utf-8'))
-            self._write_on_end([write_list, total_registers-curr_index])
+        if not total_registers:
+            return 1
+        encoded = [bytearray(convert_list_to_str(item), encoding='utf-8')
+                   for item in registers]
+        # all the free slots needed are claimed at once
+        free_spots = self._claim_slots(total_registers)
+        self._write_on_free_spots(encoded[:len(free_spots)], free_spots)
+        written = [(register.decode(), offset)
+                   for register, offset in zip(encoded, free_spots)]
+        remaining = encoded[len(free_spots):]
+        if remaining:
+            # last item needs to have a space at the end
+            remaining[-1] = remaining[-1] + b' '
+            start = self._write_on_end([remaining, len(remaining)])
+            register_size = self._get_size_of_register()
+            written += [(register.decode(), start + idx*register_size)
+                        for idx, register in enumerate(remaining)]
+        self._index_registers(written)
         self._update_desired_fields(
             fields=['amount', 'timestamp'], amounts=[total_registers, 1])
         logging.info(f'{total_registers} register(s) added!')
         return 1
 
+    @read_operation
     def single_select(self, pk_col: str, pk_value: Any) -> None:
         result, _ = self._scan_till_key(pk_col, pk_value)
         if result == '':
@@ -272,9 +484,7 @@ class FixedHeap:
             print(pretty_result)
 
     def _format_select_result(self, register: str) -> pd.DataFrame:
-        result = read_and_decode(
-            self.file_name, 0, MAX_HEADER_COLUMNS).split(';')[:-1]
-        sizes = [int(i.split(':')[1]) for i in result]
+        sizes = list(self._get_header().column_sizes)
         it = iter(register)
         sliced = [list(islice(it, 0, i)) for i in sizes]
         data = {name: [''.join(item)]
@@ -283,9 +493,7 @@ class FixedHeap:
 
     def _format_multiple_results(self, registers: str) \
             -> pd.DataFrame:
-        result = read_and_decode(
-            self.file_name, 0, MAX_HEADER_COLUMNS).split(';')[:-1]
-        sizes = [int(i.split(':')[1]) for i in result]
+        sizes = list(self._get_header().column_sizes)
         # consider the break line character as a column
         sizes.append(1)
         total_sizes = sum(sizes)
@@ -309,29 +517,20 @@ class FixedHeap:
         If it exists, returns the register string.
         Returns blank string otherwise.
         '''
-        pk_value = str(pk_value)
-        column_size, size_till_column, total_size = self._get_column_and_total_value(
-            pk_col)
-        initial_pos = self._get_value_from_field('first_register')
-        amount = int(self._get_value_from_field('amount'))
-        cont, pointer = 0, 0
-        result = ''
-        with open(file=self.file_name, mode='r+b') as f:
-            f.seek(int(initial_pos) + size_till_column)
-            while cont <= amount:
-                # read specific column to check for equality
-                temp_result = f.read(column_size).decode().strip(' ')
-                if temp_result == pk_value:
-                    if not silenced:
-                        logging.info('Register found!')
-                    # if found, read full register
-                    f.seek(-(size_till_column + column_size), 1)
-                    result = f.read(total_size).decode().strip(' ')
-                    break
-                cont += 1
-                f.seek(total_size - column_size, 1)
-            pointer += f.tell() - total_size
-        return result, pointer
+        index = self._get_hash_index()
+        tree = self._get_btree_indexes().get(pk_col)
+        if index is not None and index.column == pk_col:
+            # no need to scan, the index knows where the register is
+            found = self._lookup_hash_index(index, [pk_value])
+        elif tree is not None:
+            found = self._lookup_btree(tree, [pk_value])
+        else:
+            found = self._vector_scan(pk_col, [pk_value])
+        if not found:
+            return '', 0
+        if not silenced:
+            logging.info('Register found!')
+        return found[0]
 
     def _scan_file_for_values(self, target_col: str, values: List[Any],
                               all_between: bool = False,
@@ -342,36 +541,73 @@ class FixedHeap:
         If it exists, returns the register strings.
         Returns blank string otherwise.
         '''
-        values = [str(val) for val in values]
-        column_size, size_till_column, total_size = \
-            self._get_column_and_total_value(target_col)
-        initial_pos = self._get_value_from_field('first_register')
-        amount = int(self._get_value_from_field('amount'))
+        index = self._get_hash_index()
+        tree = self._get_btree_indexes().get(target_col)
+        if index is not None and index.column == target_col and not all_between:
+            found = self._lookup_hash_index(index, values)
+        elif tree is not None:
+            found = self._lookup_btree(tree, values, all_between)
+        else:
+            found = self._vector_scan(target_col, values, all_between)
+        if found and not silenced:
+            logging.info('Register found!')
+        pointer = found[-1][1] if found else 0
+        return ''.join(register + '\n' for register, _ in found), \
+            pointer, len(found)
+
+    def _vector_scan(self, target_col: str, values: List[Any],
+                     all_between: bool = False) -> List[Tuple[str, int]]:
+        '''
+        Registers (text and position) matching values on target_col,
+        found by one vectorized pass over the mapped db file
+        (see vector_scan.scan_file), skipping the deleted ones and the
+        blocks ruled out by the zone map, if any.
+        '''
         column_type = self._get_column_type(target_col)
-        cont, pointer, total_found = 0, 0, 0
-        final_result = ''
-        with open(file=self.file_name, mode='r+b') as f:
-            f.seek(int(initial_pos) + size_till_column)
-            while cont <= amount:
-                # read specific column to check for equality
-                result = f.read(column_size).decode().strip(' ')
-                if result == '':
-                    break
-                if result in values or \
-                        (check_between(result, values, column_type) and all_between):
-                    if not silenced:
-                        logging.info('Register found!')
-                    # if found, read full register
-                    f.seek(-(size_till_column + column_size), 1)
-                    final_result += f.read(total_size).decode().strip(' ') + '\n'
-                    total_found += 1
-                    cont += 1
-                    f.seek(size_till_column, 1)
-                    continue
-                cont += 1
-                f.seek(total_size - column_size, 1)
-            pointer += f.tell() - total_size
-        return final_result, pointer, total_found
+        column_idx = self.column_names.index(target_col)
+        header = self._get_header()
+        start, block_registers, blocks, deleted_rows = \
+            self._scan_area(target_col, values, all_between)
+        found = scan_file(self.file_name, start, None, header.column_sizes,
+                          column_idx, column_type, values, all_between,
+                          deleted_rows, workers=self.scan_workers,
+                          block_registers=block_registers, blocks=blocks)
+        return [(register.strip(' '), start + row*header.register_size)
+                for row, register in found]
+
+    def _scan_area(self, target_col: str, values: List[Any],
+                   all_between: bool = False) \
+            -> Tuple[int, int, Union[List[int], None], List[int]]:
+        '''
+        Where a scan for values on target_col starts, the registers of a
+        block, the blocks that may hold the values (None if there is no
+        zone map) and the rows of the deleted registers.
+        '''
+        column_type = self._get_column_type(target_col)
+        column_idx = self.column_names.index(target_col)
+        header = self._get_header()
+        start = int(self._get_value_from_field('first_register'))
+        register_size = header.register_size
+        # the mapped file must have every pending write
+        self._session.sync(self.file_name)
+        block_registers, blocks = self.blocking_factor, None
+        zone_map = self._get_zone_map()
+        if zone_map is not None:
+            # blocks are counted from the first slot, the ones before
+            # first_register are all on the list of deleted registers
+            start = header.records_start
+            block_registers = zone_map.block_registers
+            if all_between:
+                ranges = [key_bounds(values, column_type)]
+            else:
+                ranges = [(key, key) for key in
+                          search_keys(values, column_type)]
+            amount = (os.path.getsize(self.file_name) - start) // register_size
+            blocks = zone_map.candidate_blocks(
+                column_idx, ranges, -(-amount // block_registers))
+        deleted_rows = [(spot - start) // register_size
+                        for spot in self._free_spots() if spot >= start]
+        return start, block_registers, blocks, deleted_rows
 
     def _get_column_type(self, target_col: str) -> str:
         result = ''
@@ -384,6 +620,7 @@ class FixedHeap:
             raise ValueError
         return result
 
+    @read_operation
     def select_all(self, target_col: str,
                    values: List[Any], all_between: bool = False) -> None:
         records, _, total_found = self._scan_file_for_values(
@@ -393,95 +630,817 @@ class FixedHeap:
         final = self._format_multiple_results(records)
         print(final.head(total_found))
 
+    @table_operation
     def single_delete(self, pk_col: str, pk_value: str) -> None:
-        # find pointer to start of register and get total register size
+        # find pointer to start of register
         result, pointer = self._scan_till_key(pk_col, pk_value, True)
-        register_size = self._get_size_of_register()
         # check if register exists
         if result == '':
             logging.info(f'Register with value {pk_value} on column {pk_col}'
                          f' does not exists.')
             return
-        # get current empty spot
-        current_empty = int(self._get_value_from_field('first_empty'))
+        self._delete_registers([pointer])
+        logging.info('Record deleted!')
+
+    @table_operation
+    def bulk_delete(self, column: str, values: List[Any],
+                    all_between: bool = False) -> int:
+        '''
+        Deletes every register matching values on column (or between the
+        lowest and highest of them, if all_between), found by a single
+        scan (or index lookup). Returns the amount of registers deleted.
+        '''
+        found = self._lookup_indexes(column, values, all_between)
+        if found is None:
+            found = self._vector_scan(column, values, all_between)
+        self._delete_registers([offset for _, offset in found])
+        logging.info(f'{len(found)} records deleted!')
+        return len(found)
+
+    @table_operation
+    def delete_where(self, predicate: Callable[[Dict[str, np.ndarray]],
+                                               np.ndarray]) -> int:
+        '''
+        Deletes every register for which predicate holds. predicate gets
+        the typed arrays of every column of a chunk of registers (see
+        to_numpy) and gives a mask of the ones to delete, e.g.:
+        delete_where(lambda rows: (rows['year'] < 2000) & (rows['score'] > 8))
+        The file is scanned once. Returns the amount of registers deleted.
+        '''
+        columns = list(range(len(self.column_names)))
+        offsets = []
+        for positions, records in self._iter_records(None, ()):
+            chunk = dict(zip(self.column_names, records_to_columns(
+                records, self.register_types, columns)))
+            mask = np.asarray(predicate(chunk), dtype=bool)
+            offsets += positions[mask].tolist()
+        self._delete_registers(offsets)
+        logging.info(f'{len(offsets)} records deleted!')
+        return len(offsets)
+
+    def _delete_registers(self, offsets: List[int]) -> None:
+        '''
+        Chains the registers at offsets into the list of deleted
+        registers, kept sorted by position, and updates the header.
+        '''
+        if not offsets:
+            return
+        offsets = sorted(set(offsets))
+        header = self._get_header()
+        register_size = header.register_size
+        self._unindex_registers(offsets)
+        slots = [(offset - header.records_start) // register_size
+                 for offset in offsets]
+        free_map = self._get_free_map()
+        free_map.set(slots, True)
+        if self._vacuum is not None:
+            self._vacuum.note_changes(slots)
+        # the free slots before each deleted one now point to it
+        free = free_map.free_slots()
+        positions = np.searchsorted(free, slots)
+        previous = set(free[positions[positions > 0] - 1].tolist())
         # write blank spaces and pointer to next deleted record (if exists)
-        with open(file=self.file_name, mode='r+b') as f:
-            f.seek(pointer)
-            if current_empty == -1:
-                f.write(bytearray('-1' + ' '*(register_size-2), 'utf-8'))
-                self._update_desired_fields(fields=['first_empty'],
-                                            amounts=[pointer])
-            else:
-                to_write = str(current_empty)
-                f.write(bytearray(to_write + ' ' *
-                        (register_size - len(to_write)), 'utf-8'))
-                self._update_desired_fields(fields=['first_empty'],
-                                            amounts=[pointer])
-        # update remaining header fields
+        self._link_free_slots(previous | set(slots))
         self._update_desired_fields(fields=['amount', 'timestamp'],
-                                    amounts=[-1, 0])
-        # check if we removed the very first register. If so, we need to update
-        # the value on 'first register' pointer
-        current_empty = int(self._get_value_from_field('first_empty'))
-        current_first_register = int(
-            self._get_value_from_field('first_register'))
-        if current_empty == current_first_register:
+                                    amounts=[-len(offsets), 0])
+        # check if we removed the very first registers. If so, we need to
+        # update the value on 'first register' pointer
+        first_register = int(self._get_value_from_field('first_register'))
+        deleted = set(offsets)
+        if first_register in deleted:
+            while first_register in deleted:
+                first_register += register_size
             self._update_desired_fields(fields=['first_register'],
-                                        amounts=[current_first_register+register_size])
-        logging.info('Record deleted!')
+                                        amounts=[first_register])
+
+    def query(self, target_col: str = None, values: List[Any] = (),
+              all_between: bool = False, columns: List[str] = None,
+              limit: int = None) -> Iterator[Tuple]:
+        '''
+        Lazy version of select_all: yields the registers matching values
+        on target_col (every register, if target_col is not given) as
+        tuples with the values (see keys.parse_value) of columns (every
+        one, if not given). The reading stops after limit rows.
+        The rows are a snapshot of the table: every one is read while the
+        lock of the table is held, and the lock is released before the
+        first one is given, so an iterator left open does not keep other
+        processes from writing, and what they write is not seen by it.
+        Results bigger than QUERY_CHUNK_REGISTERS rows are kept on a
+        temporary file (see helpers.spill_registers), so they are read
+        with constant memory.
+        '''
+        if limit is not None and limit <= 0:
+            return
+        with self._operation(shared=True):
+            columns = self.column_names if columns is None else columns
+            for column in columns:
+                # complains about unknown columns
+                self._get_column_type(column)
+            header = self._get_header()
+            parse = register_parser(
+                header.column_sizes, self.register_types,
+                [self.column_names.index(column) for column in columns])
+            registers = spill_registers(
+                self._query_registers(target_col, values, all_between),
+                header.register_size,
+                os.path.dirname(os.path.abspath(self.file_name)), limit)
+        yield from map(parse, registers)
+
+    def _query_registers(self, target_col: str, values: List[Any],
+                         all_between: bool = False) -> Iterator[bytes]:
+        '''
+        Registers matching values on target_col (every register, if
+        target_col is None), skipping the deleted ones, in the order they
+        are on the file. The lookups of the indexes are not lazy, only
+        the registers found are read lazily.
+        '''
+        header = self._get_header()
+        register_size = header.register_size
+        if target_col is None:
+            free_spots = set(self._free_spots())
+            with self._open_file(self.file_name) as f:
+                amount = (f.seek(0, 2) - header.records_start) // register_size
+                for row, register in enumerate(iter_registers(
+                        f, header.records_start, amount, register_size,
+                        QUERY_CHUNK_REGISTERS)):
+                    if header.records_start + row*register_size not in free_spots:
+                        yield register
+            return
+        found = self._lookup_indexes(target_col, values, all_between)
+        if found is not None:
+            with self._open_file(self.file_name) as f:
+                for _, offset in found:
+                    f.seek(offset)
+                    yield f.read(register_size)
+            return
+        start, block_registers, blocks, deleted_rows = \
+            self._scan_area(target_col, values, all_between)
+        for _, register in iter_scan_file(
+                self.file_name, start, None, header.column_sizes,
+                self.column_names.index(target_col),
+                self._get_column_type(target_col), values, all_between,
+                deleted_rows, block_registers=block_registers, blocks=blocks):
+            yield register.encode('utf-8')
+
+    @read_operation
+    def to_numpy(self, target_col: str = None, values: List[Any] = (),
+                 all_between: bool = False,
+                 columns: List[str] = None) -> Dict[str, np.ndarray]:
+        '''
+        Registers matching values on target_col (every register, if
+        target_col is not given) as one typed array for each of columns
+        (every one, if not given), see vector_scan.records_to_columns.
+        The registers are copied at once from the mapped file and
+        converted column by column, without a python object per field.
+        '''
+        columns = self.column_names if columns is None else columns
+        for column in columns:
+            # complains about unknown columns
+            self._get_column_type(column)
+        records = np.concatenate(
+            [np.zeros(0, dtype=record_dtype(self._get_header().column_sizes))] +
+            [records for _, records in
+             self._iter_records(target_col, values, all_between)])
+        return dict(zip(columns, records_to_columns(
+            records, self.register_types,
+            [self.column_names.index(column) for column in columns])))
+
+    def to_dataframe(self, target_col: str = None, values: List[Any] = (),
+                     all_between: bool = False,
+                     columns: List[str] = None) -> pd.DataFrame:
+        '''
+        Same as to_numpy, as a DataFrame built on the arrays.
+        '''
+        return pd.DataFrame(self.to_numpy(target_col, values, all_between,
+                                          columns))
+
+    @read_operation
+    def aggregate(self, functions: List[Tuple[str, str]],
+                  group_by: List[str] = (), target_col: str = None,
+                  values: List[Any] = (),
+                  all_between: bool = False) -> List[Tuple]:
+        '''
+        Computes aggregates (count, sum, min, max or avg, see
+        aggregate.Aggregation) of the registers matching values on
+        target_col (every register, if target_col is not given),
+        grouped by the columns group_by, while they are scanned. e.g.:
+        aggregate([('count', '*'), ('avg', 'score')], group_by=['year'])
+        Returns one tuple per group: its values on group_by followed
+        by the aggregates.
+        '''
+        for column in list(group_by) + [column for _, column in functions
+                                        if column != '*']:
+            # complains about unknown columns
+            self._get_column_type(column)
+        aggregation = Aggregation(
+            [(function.lower(), None if column == '*'
+              else self.column_names.index(column))
+             for function, column in functions],
+            self.register_types,
+            [self.column_names.index(column) for column in group_by])
+        for _, records in self._iter_records(target_col, values, all_between):
+            aggregation.add(records)
+        return aggregation.results()
+
+    def _iter_records(self, target_col: str, values: List[Any],
+                      all_between: bool = False) \
+            -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        '''
+        Registers matching values on target_col (every register, if
+        target_col is None) as chunks of positions and structured records,
+        in the order they are on the file (see
+        vector_scan.iter_select_records).
+        '''
+        header = self._get_header()
+        start = header.records_start
+        register_size = header.register_size
+        # the mapped file must have every pending write
+        self._session.sync(self.file_name)
+        found = None if target_col is None else \
+            self._lookup_indexes(target_col, values, all_between)
+        if target_col is None:
+            chunks = iter_select_records(
+                self.file_name, start, None, header.column_sizes,
+                deleted_rows=[(spot - start) // register_size
+                              for spot in self._free_spots()])
+        elif found is not None:
+            chunks = iter_select_records(
+                self.file_name, start, None, header.column_sizes,
+                rows=[(offset - start) // register_size for _, offset in found])
+        else:
+            start, block_registers, blocks, deleted_rows = \
+                self._scan_area(target_col, values, all_between)
+            chunks = iter_select_records(
+                self.file_name, start, None, header.column_sizes,
+                self.column_names.index(target_col),
+                self._get_column_type(target_col), values, all_between,
+                deleted_rows, block_registers=block_registers, blocks=blocks)
+        for rows, records in chunks:
+            yield start + rows*register_size, records
+
+    def _lookup_indexes(self, target_col: str, values: List[Any],
+                        all_between: bool = False) \
+            -> Union[List[Tuple[str, int]], None]:
+        '''
+        Registers (text and position) matching values on target_col,
+        found by an index of the column, or None if it has none.
+        '''
+        index = self._get_hash_index()
+        tree = self._get_btree_indexes().get(target_col)
+        if index is not None and index.column == target_col and not all_between:
+            return self._lookup_hash_index(index, values)
+        if tree is not None:
+            return self._lookup_btree(tree, values, all_between)
+        return None
 
     def _get_size_of_register(self) -> int:
-        result = read_and_decode(
-            self.file_name, 0, MAX_HEADER_COLUMNS).split(';')[:-1]
-        return sum([int(i.split(':')[1]) for i in result])
+        return self._get_header().register_size
 
     def _get_column_and_total_value(self, column: str) -> Tuple[int, int, int]:
-        header_str = read_and_decode(self.file_name, 0, MAX_HEADER_COLUMNS)
-        pairs = header_str.strip().split(';')[:-1]
         try:
-            desired_col_pair = pairs[self.column_names.index(column)]
+            column_idx = self.column_names.index(column)
         except ValueError:
             logging.error(f'Column {column} does not exists on db file.')
             raise
-        column_idx, column_size = desired_col_pair.split(':')
-        total_size_till_column = sum([int(value.split(':')[1])
-                                      for value in pairs[:int(column_idx)]])
-        total_register_size = sum([int(value.split(':')[1])
-                                  for value in pairs])
-        return int(column_size), total_size_till_column, total_register_size
+        return self._get_header().column_info(column_idx)
 
-    def populate_from_csv_file(self, file_path: str, separator: str = ',',
-                               max_lines: int = 1000) -> None:
-        total_lines = 0
-        final_text = ''
+    def _sidecar_path(self, extension: str) -> str:
+        '''
+        Path of a file kept next to the db file, e.g. its indexes.
+        '''
+        return os.path.splitext(self.file_name)[0] + '.' + extension
+
+    def _free_spots(self) -> List[int]:
+        '''
+        Positions of the deleted registers, in order (see _get_free_map).
+        '''
+        header = self._get_header()
+        return (self._get_free_map().free_slots()*header.register_size +
+                header.records_start).tolist()
+
+    def _free_list(self) -> List[int]:
+        '''
+        Follows the list of deleted registers, starting on first_empty.
+        '''
+        spots = []
+        current = int(self._get_value_from_field('first_empty'))
         register_size = self._get_size_of_register()
-        logging.info(f'Loading data from file {file_path}')
-        with open(file_path, 'r+', encoding='utf-8') as f:
-            for line in f:
-                if total_lines == max_lines + 1:
-                    # max line per iteration reached
-                    break
-                # skip header
-                if total_lines == 0:
-                    total_lines += 1
-                    continue
-                text = ''.join(line[:-1].split(separator))
-                # this register has some character that does not belong
-                # to regular 127 ASCII table, so it exceeds the
-                # register max size, cannot add to database
-                if len(text.encode("utf-8")) > register_size:
-                    logging.warning(
-                        f'The register {text} cannot be added because'
-                        f' it uses a character that does not belongs to ASCII 127.')
+        with self._open_file(self.file_name) as f:
+            while current != -1:
+                spots.append(current)
+                f.seek(current)
+                current = int(f.read(register_size).decode().strip(' '))
+        return spots
+
+    def _get_free_map(self) -> FreeMap:
+        '''
+        Bitmap of the free slots (see free_map.FreeMap), kept next to the
+        list of deleted registers, which is always sorted by position.
+        Built from the list if it is missing or was not kept up to date
+        by the last writer of the file.
+        '''
+        if self._free_map_in_memory and not self._table_lock.shared:
+            # built by a reader, the map is kept on its file by writers
+            self._free_map = None
+            self._free_map_in_memory = False
+        if self._free_map is None:
+            path = self._sidecar_path('fmap')
+            header = self._get_header()
+            first_empty = int(self._get_value_from_field('first_empty'))
+            if os.path.exists(path):
+                with self._open_file(path) as f:
+                    self._free_map = FreeMap(f)
+                lowest = self._free_map.find(1)
+                if (lowest[0]*header.register_size + header.records_start
+                        if lowest else -1) != first_empty:
+                    self._free_map = None
+            if self._free_map is None:
+                spots = self._free_list()
+                slots = [(spot - header.records_start) // header.register_size
+                         for spot in spots]
+                if self._table_lock.shared:
+                    # other processes may be reading the file of the map
+                    self._free_map = FreeMap.create(io.BytesIO(), slots)
+                    self._free_map_in_memory = True
+                    return self._free_map
+                self._session.forget(path)
+                with open(file=path, mode='wb'):
+                    pass
+                with self._open_file(path) as f:
+                    self._free_map = FreeMap.create(f, slots)
+                if spots != sorted(spots):
+                    # older files keep the most recently deleted first
+                    self._link_free_slots(self._free_map.free_slots())
+        return self._free_map
+
+    def _link_free_slots(self, slots: Iterable[int]) -> None:
+        '''
+        Writes on each of the free slots the position of the next free
+        one (-1 for the last), and the lowest on first_empty.
+        '''
+        header = self._get_header()
+        register_size = header.register_size
+        free = self._get_free_map().free_slots()
+        with self._open_file(self.file_name) as f:
+            for slot in sorted(slots):
+                idx = int(np.searchsorted(free, slot))
+                pointer = str(int(free[idx + 1])*register_size +
+                              header.records_start
+                              if idx + 1 < len(free) else -1)
+                f.seek(slot*register_size + header.records_start)
+                f.write(bytearray(pointer + ' '*(register_size - len(pointer)),
+                                  'utf-8'))
+        self._update_desired_fields(
+            fields=['first_empty'],
+            amounts=[int(free[0])*register_size + header.records_start
+                     if len(free) else -1])
+
+    def _claim_slots(self, amount: int) -> List[int]:
+        '''
+        Takes up to amount free slots, the lowest ones, and gives their
+        positions. They are the first ones of the list of deleted
+        registers, so only first_empty changes.
+        '''
+        header = self._get_header()
+        free_map = self._get_free_map()
+        slots = free_map.find(amount)
+        if not slots:
+            return []
+        free_map.set(slots, False)
+        if self._vacuum is not None:
+            self._vacuum.note_changes(slots)
+        following = free_map.find(1, slots[-1])
+        offsets = [slot*header.register_size + header.records_start
+                   for slot in slots]
+        self._update_desired_fields(
+            fields=['first_empty'],
+            amounts=[following[0]*header.register_size + header.records_start
+                     if following else -1])
+        # check if we need to update the first_register pointer
+        if int(self._get_value_from_field('first_register')) > offsets[0]:
+            self._update_desired_fields(
+                fields=['first_register'], amounts=[offsets[0]])
+        return offsets
+
+    def _get_hash_index(self) -> Union[HashIndex, None]:
+        '''
+        Hash index of the table, if one was created.
+        '''
+        if self._hash_index is None:
+            index_path = self._sidecar_path('hidx')
+            if not os.path.exists(index_path):
+                return None
+            overflow_path = self._sidecar_path('hovf')
+            self._session.set_layout(index_path, 0, HASH_INDEX_PAGE_SIZE)
+            self._session.set_layout(overflow_path, 0, HASH_INDEX_PAGE_SIZE)
+            with self._open_file(index_path) as index_f, \
+                    self._open_file(overflow_path) as overflow_f:
+                self._hash_index = HashIndex(index_f, overflow_f)
+        return self._hash_index
+
+    def _index_key(self, index: Union[HashIndex, BPlusTree],
+                   register: str) -> bytes:
+        column_size, size_till_column, _ = \
+            self._get_column_and_total_value(index.column)
+        value = register[size_till_column:size_till_column + column_size]
+        return encode_key(value, self._get_column_type(index.column))[
+            :index.key_length]
+
+    def _btree_path(self, column: str) -> str:
+        return self._sidecar_path(column + '.bidx')
+
+    def _get_btree_indexes(self) -> Dict[str, BPlusTree]:
+        '''
+        B+tree indexes of the table, by column.
+        '''
+        if self._btree_indexes is None:
+            self._btree_indexes = {}
+            for column in self.column_names:
+                path = self._btree_path(column)
+                if not os.path.exists(path):
                     continue
-                final_text += ''.join(line[:-1].split(separator))
-                total_lines += 1
-            final_text += ' '
-        # write the registers
-        with open(file=self.file_name, mode='r+b') as f:
-            f.seek(-1, 2)
-            f.write(bytearray(final_text, 'utf-8'))
+                with self._open_file(path) as f:
+                    tree = BPlusTree(f)
+                # one page of the buffer pool is one node
+                self._session.set_layout(path, 0, tree.node_size)
+                self._btree_indexes[column] = tree
+        return self._btree_indexes
+
+    def _forget_indexes(self, replaced: bool = True) -> None:
+        paths = [self._sidecar_path(extension)
+                 for extension in ('hidx', 'hovf', 'zmap', 'fmap')]
+        paths += [self._btree_path(column) for column in self.column_names]
+        for path in paths:
+            self._session.forget(path, replaced)
+        self._hash_index = None
+        self._btree_indexes = None
+        self._zone_map = None
+        self._free_map = None
+
+    def _get_zone_map(self) -> Union[ZoneMap, None]:
+        '''
+        Zone map of the table, if one was created.
+        '''
+        if self._zone_map is None:
+            path = self._sidecar_path('zmap')
+            if not os.path.exists(path):
+                return None
+            with self._open_file(path) as f:
+                self._zone_map = ZoneMap(f)
+        return self._zone_map
+
+    def _index_registers(self, registers: List[Tuple[str, int]]) -> None:
+        '''
+        Adds the written registers (text and position) to the indexes
+        and to the zone map.
+        '''
+        index = self._get_hash_index()
+        if index is not None:
+            index.bulk_insert([(self._index_key(index, register), offset)
+                               for register, offset in registers])
+        for tree in self._get_btree_indexes().values():
+            for register, offset in registers:
+                tree.insert(self._index_key(tree, register), offset)
+        zone_map = self._get_zone_map()
+        if zone_map is not None:
+            header = self._get_header()
+            zone_map.add(((offset - header.records_start) // header.register_size,
+                          register_keys(register.encode('utf-8'),
+                                        header.column_sizes, self.register_types))
+                         for register, offset in registers)
+
+    def _unindex_registers(self, offsets: List[int]) -> None:
+        '''
+        Removes the registers at offsets from the indexes. Must be
+        called before the registers are overwritten.
+        '''
+        index = self._get_hash_index()
+        trees = list(self._get_btree_indexes().values())
+        if index is None and not trees:
+            return
+        register_size = self._get_size_of_register()
+        with self._open_file(self.file_name) as f:
+            for offset in offsets:
+                f.seek(offset)
+                register = f.read(register_size).decode()
+                if index is not None:
+                    index.delete(self._index_key(index, register), offset)
+                for tree in trees:
+                    tree.delete(self._index_key(tree, register), offset)
+
+    def _lookup_hash_index(self, index: HashIndex,
+                           values: List[Any]) -> List[Tuple[str, int]]:
+        '''
+        Registers (text and position) whose indexed column is one of
+        values, in the order they are on the file.
+        '''
+        column_type = self._get_column_type(index.column)
+        column_size, size_till_column, register_size = \
+            self._get_column_and_total_value(index.column)
+        keys = search_keys(values, column_type)
+        offsets = set()
+        for key in keys:
+            offsets.update(index.lookup(key[:index.key_length]))
+        found = []
+        with self._open_file(self.file_name) as f:
+            for offset in sorted(offsets):
+                f.seek(offset)
+                register = f.read(register_size).decode()
+                # the index may keep only a prefix of long keys
+                value = register[size_till_column:size_till_column + column_size]
+                if encode_key(value, column_type) in keys:
+                    found.append((register.strip(' '), offset))
+        return found
+
+    def _lookup_btree(self, tree: BPlusTree, values: List[Any],
+                      all_between: bool = False) -> List[Tuple[str, int]]:
+        '''
+        Registers (text and position) whose indexed column is one of values
+        (or between the lowest and highest of them, if all_between),
+        in the order they are on the file.
+        '''
+        column_type = self._get_column_type(tree.column)
+        column_size, size_till_column, register_size = \
+            self._get_column_and_total_value(tree.column)
+        if all_between:
+            ranges = [key_bounds(values, column_type)]
+        else:
+            ranges = [(key, key) for key in
+                      search_keys(values, column_type)]
+        offsets = set()
+        for low, high in ranges:
+            offsets.update(offset for _, offset in tree.search(low, high))
+        matches = key_matcher(values, column_type, all_between)
+        found = []
+        with self._open_file(self.file_name) as f:
+            for offset in sorted(offsets):
+                f.seek(offset)
+                register = f.read(register_size).decode()
+                # the index may keep only a prefix of long keys
+                if matches(register[size_till_column:
+                                    size_till_column + column_size]):
+                    found.append((register.strip(' '), offset))
+        return found
+
+    def _live_registers(self) -> List[Tuple[str, int]]:
+        '''
+        Every register (text and position) on the file, skipping
+        the deleted ones.
+        '''
+        register_size = self._get_size_of_register()
+        free_spots = set(self._free_spots())
+        start = self._get_header().records_start
+        registers = []
+        with self._open_file(self.file_name) as f:
+            end = f.seek(0, 2) - 1
+            f.seek(start)
+            for offset in range(start, end - register_size + 1, register_size):
+                register = f.read(register_size).decode()
+                if offset not in free_spots:
+                    registers.append((register, offset))
+        return registers
+
+    @table_operation
+    def create_hash_index(self, column: str) -> None:
+        '''
+        Creates a persistent hash index on column (usually the primary key),
+        used by single_select, single_delete and select_all
+        (when not all_between) on that column instead of a full scan.
+        It is kept up to date by every insert and delete.
+        '''
+        column_type = self._get_column_type(column)
+        column_size, _, _ = self._get_column_and_total_value(column)
+        index_path = self._sidecar_path('hidx')
+        overflow_path = self._sidecar_path('hovf')
+        for path in (index_path, overflow_path):
+            self._session.forget(path)
+            with open(file=path, mode='w+b') as f:
+                if path == index_path:
+                    HashIndex.create(f, column,
+                                     min(key_length(column_type, column_size), 255),
+                                     HASH_INDEX_PAGE_SIZE)
+        self._hash_index = None
+        index = self._get_hash_index()
+        entries = self._live_registers()
+        index.bulk_insert([(self._index_key(index, register), offset)
+                           for register, offset in entries])
+        logging.info(f'Hash index created on column {column} '
+                     f'with {len(entries)} registers.')
+
+    @table_operation
+    def create_index(self, column: str) -> None:
+        '''
+        Creates a persistent B+tree index on any column, used by
+        single_select, single_delete and select_all on that column
+        (both for lists of values and for ranges) instead of a full scan.
+        It is kept up to date by every insert and delete.
+        '''
+        column_type = self._get_column_type(column)
+        column_size, _, register_size = self._get_column_and_total_value(column)
+        index_key_length = min(key_length(column_type, column_size), 255)
+        path = self._btree_path(column)
+        self._session.forget(path)
+        with open(file=path, mode='w+b') as f:
+            BPlusTree.create(f, column, index_key_length, node_size_for(
+                self.blocking_factor*register_size, index_key_length))
+        self._btree_indexes = None
+        tree = self._get_btree_indexes()[column]
+        entries = self._live_registers()
+        tree.bulk_load([(self._index_key(tree, register), offset)
+                        for register, offset in entries])
+        logging.info(f'Index created on column {column} '
+                     f'with {len(entries)} registers.')
+
+    @table_operation
+    def create_zone_maps(self, bloom_columns: List[str] = ()) -> None:
+        '''
+        Creates a zone map (see zone_map.ZoneMap): the lowest and highest
+        value of each column on each block, plus a Bloom filter of the
+        values of bloom_columns (useful for columns searched by equality).
+        Full scans skip the blocks that cannot hold the values searched.
+        It is kept up to date by every insert.
+        '''
+        header = self._get_header()
+        start = header.records_start
+        path = self._sidecar_path('zmap')
+        self._session.sync(self.file_name)
+        self._session.forget(path)
+        self._zone_map = None
+        amount = (os.path.getsize(self.file_name) - start) // header.register_size
+        with open(file=path, mode='w+b') as f:
+            zone_map = build_zone_map(
+                f, self.file_name, start, amount, header.column_sizes,
+                self.register_types, self.blocking_factor,
+                [self.column_names.index(column) for column in bloom_columns],
+                [(spot - start) // header.register_size
+                 for spot in self._free_spots()])
+        logging.info(f'Zone map created with {zone_map.blocks} blocks.')
+
+    @table_operation
+    def vacuum(self, blocks: int = None) -> Union[int, None]:
+        '''
+        Rewrites the table into a dense file, without the slots left by
+        deleted registers. Copies blocks blocks per call (all of them, if
+        None), so it can be spread over maintenance windows, e.g.:
+        while table.vacuum(blocks=1000) is None: ...
+        The table can be used normally between two calls. Once every
+        block is copied, the new file is put in place of the current one
+        and the indexes are built again. Returns the bytes reclaimed
+        then, or None while there are blocks left.
+        '''
+        header = self._get_header()
+        # the file is read straight from the disk
+        self._session.sync(self.file_name)
+        if self._vacuum is None:
+            # the copy is kept between operations, one per process
+            self._vacuum = Vacuum(
+                self._sidecar_path(f'vacuum.{os.getpid()}'),
+                bytearray(self._build_header_string(header.created_at)[:-1],
+                          'utf-8'),
+                header.register_size, self.blocking_factor)
+        vacuum = self._vacuum
+        rows = (os.path.getsize(self.file_name) - 1 - header.records_start) \
+            // header.register_size
+        try:
+            done = vacuum.copy_blocks(self.file_name, header.records_start,
+                                      rows, blocks,
+                                      self._get_free_map().free_slots())
+            logging.info(f'Vacuum copied {vacuum.next_row} '
+                         f'of {rows} registers.')
+            if not done:
+                return None
+            return self._commit_vacuum()
+        except Exception:
+            self._drop_vacuum()
+            raise
+
+    def _commit_vacuum(self) -> int:
+        '''
+        Puts the copy made by vacuum in place of the file, after copying
+        the registers written on slots already passed and filling the
+        slots of the ones deleted meanwhile.
+        '''
+        vacuum = self._vacuum
+        header = self._get_header()
+        register_size = header.register_size
+        free = set(self._get_free_map().free_slots().tolist())
+        written = []
+        with self._open_file(self.file_name) as f:
+            for slot in sorted(vacuum.changed - free):
+                f.seek(header.records_start + slot*register_size)
+                written.append(f.read(register_size))
+        vacuum.fill_holes(vacuum.stale_positions(), written)
+        vacuum.finish()
+        size = os.path.getsize(self.file_name)
+        self._session.forget(self.file_name)
+        replace_file(vacuum.path, self.file_name)
+        self._vacuum = None
+        # the cached header belongs to the replaced file
+        self._header = None
+        self._update_desired_fields(['timestamp', 'amount'],
+                                    [1, vacuum.amount])
+        # every register moved, so the maps and indexes are built again
+        self._rebuild_indexes()
+        reclaimed = size - os.path.getsize(self.file_name)
+        logging.info(f'Vacuum reclaimed {reclaimed} bytes.')
+        return reclaimed
+
+    def _drop_vacuum(self) -> None:
+        '''
+        Throws away the vacuum in progress, e.g. when the file was
+        changed by someone else. The next call starts it again.
+        '''
+        if self._vacuum is not None:
+            if os.path.exists(self._vacuum.path):
+                os.remove(self._vacuum.path)
+            self._vacuum = None
+
+    def _rebuild_indexes(self) -> None:
+        '''
+        Builds the free space map, the indexes and the zone map of the
+        table again, e.g. after vacuum moved the registers.
+        '''
+        index = self._get_hash_index()
+        columns = list(self._get_btree_indexes())
+        zone_map = self._get_zone_map()
+        self._forget_indexes()
+        path = self._sidecar_path('fmap')
+        if os.path.exists(path):
+            os.remove(path)
+        if index is not None:
+            self.create_hash_index(index.column)
+        for column in columns:
+            self.create_index(column)
+        if zone_map is not None:
+            self.create_zone_maps([self.column_names[idx]
+                                   for idx in zone_map.bloom_columns()])
+
+    @table_operation
+    def populate_from_csv_file(self, file_path: str, separator: str = ',',
+                               max_lines: int = None) -> None:
+        '''
+        Appends the rows of a csv file (with a header line) to the table,
+        reading, encoding and writing CSV_CHUNK_REGISTERS rows at a time.
+        Fields are padded with spaces to the size of their columns.
+        max_lines: maximum of registers to load (all of them, if None)
+        '''
+        header = self._get_header()
+        progress = LoadProgress(header.register_size)
+        logging.info(f'Loading data from file {file_path}')
+        for chunk in read_csv_chunks(file_path, header.column_sizes,
+                                     separator, max_lines):
+            self._append_registers(b''.join(chunk))
+            self._update_desired_fields(
+                fields=['amount', 'timestamp'], amounts=[len(chunk), 1])
+            # the header is written once per chunk, so an interrupted
+            # load still leaves a consistent file behind
+            self._flush_header()
+            progress.add(len(chunk))
         logging.info(
-            f'Populated database with {total_lines - 1} records from {file_path}!')
+            f'Populated database with {progress.registers} records '
+            f'from {file_path} ({progress.throughput()})!')
+
+    @table_operation
+    def parallel_load(self, file_path: str, separator: str = ',',
+                      workers: int = None) -> None:
+        '''
+        Same as populate_from_csv_file, but the csv is split in ranges of
+        lines that are encoded by a pool of worker processes, while this
+        process appends them to the table in order. The amount of
+        registers on the header is updated once, at the end.
+        workers: amount of processes (one per core, if None)
+        '''
+        header = self._get_header()
+        progress = LoadProgress(header.register_size)
+        logging.info(f'Loading data from file {file_path} in parallel')
+        for data in encode_csv_parallel(file_path, header.column_sizes,
+                                        separator, workers=workers):
+            if data:
+                self._append_registers(data)
+                progress.add(len(data) // header.register_size)
         self._update_desired_fields(
-            fields=['amount', 'timestamp'], amounts=[total_lines - 1, 1])
+            fields=['amount', 'timestamp'], amounts=[progress.registers, 1])
+        logging.info(
+            f'Populated database with {progress.registers} records '
+            f'from {file_path} ({progress.throughput()})!')
+
+    def _append_registers(self, data: bytes) -> None:
+        '''
+        Appends encoded registers at the end of the file and indexes them.
+        The pages are written right away, so loads bigger than the buffer
+        pool are written with large writes. With a write ahead log they
+        are left to the commit at the end of the load instead, so the
+        whole load is one transaction, along with the header.
+        '''
+        register_size = self._get_size_of_register()
+        with self._open_file(self.file_name) as f:
+            start = f.seek(-1, 2)
+            # this space will be consumed for the next write
+            f.write(data + b' ')
+        if self._get_hash_index() is not None or self._get_btree_indexes() \
+                or self._get_zone_map() is not None:
+            self._index_registers(
+                [(data[idx:idx + register_size].decode(), start + idx)
+                 for idx in range(0, len(data), register_size)])
+        if self._wal is None:
+            self._session.flush()
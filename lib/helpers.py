@@ -1,4 +1,9 @@
-from typing import Any, Dict, List
+import os
+import tempfile
+from itertools import islice
+from typing import Any, BinaryIO, Dict, Iterator, List
+from .configs import QUERY_CHUNK_REGISTERS
+from .keys import encode_key, key_bounds
 
 
 def read_and_decode(file_name: str, start: str,
@@ -35,9 +40,8 @@ def convert_list_to_str(input_list: List[int]) -> str:
 
 
 def check_between(result: str, values: List[Any], column_type: str) -> bool:
-    if column_type == 'FLOAT':
-        values, result = [float(i) for i in values], float(result)
-    return (result <= max(values)) and (result >= min(values))
+    low, high = key_bounds(values, column_type)
+    return low <= encode_key(result, column_type) <= high
 
 
 def build_db_fields_from_csv(csv_file_path: str, separator: str = ',',
@@ -72,3 +76,76 @@ def build_db_fields_from_csv(csv_file_path: str, separator: str = ',',
         logical_byte = {'logical_byte': {'type': 'CHAR', 'size': 1}}
         return {**logical_byte, **names}
     return names
+
+
+def iter_registers(f: BinaryIO, start: int, amount: int, register_size: int,
+                   block_registers: int = 4096) -> Iterator[bytes]:
+    '''
+    Yields the amount registers starting at position start of the opened
+    file f, reading block_registers registers at a time. The position is
+    kept here, so f may be used by someone else between two registers.
+    '''
+    while amount > 0:
+        f.seek(start)
+        block = f.read(min(amount, block_registers)*register_size)
+        if len(block) < register_size:
+            break
+        for idx in range(0, len(block) - register_size + 1, register_size):
+            yield block[idx:idx + register_size]
+        read = len(block) // register_size
+        start += read*register_size
+        amount -= read
+
+
+def spill_registers(registers: Iterator[bytes], register_size: int,
+                    directory: str, limit: int = None) -> Iterator[bytes]:
+    '''
+    Reads the first limit registers (all of them, if None) right away and
+    gives an iterator over them, still good after the files they came
+    from are changed. Up to QUERY_CHUNK_REGISTERS registers are kept in
+    memory, more are written to an anonymous temporary file in directory
+    and read back QUERY_CHUNK_REGISTERS at a time.
+    '''
+    registers = iter(registers) if limit is None else islice(registers, limit)
+    chunk = list(islice(registers, QUERY_CHUNK_REGISTERS))
+    if len(chunk) < QUERY_CHUNK_REGISTERS:
+        return iter(chunk)
+    f = tempfile.TemporaryFile(dir=directory)
+    amount = 0
+    while chunk:
+        f.write(b''.join(chunk))
+        amount += len(chunk)
+        chunk = list(islice(registers, QUERY_CHUNK_REGISTERS))
+    return _spilled_registers(f, amount, register_size)
+
+
+def _spilled_registers(f: BinaryIO, amount: int,
+                       register_size: int) -> Iterator[bytes]:
+    # the file is removed once closed
+    with f:
+        yield from iter_registers(f, 0, amount, register_size,
+                                  QUERY_CHUNK_REGISTERS)
+
+
+def sync_file(path: str) -> None:
+    '''
+    Waits until the contents of the file at path are on the disk.
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_file(source: str, target: str) -> None:
+    '''
+    Puts the file at source in place of target. source is synced before
+    the rename and its directory after it, so a crash leaves either the
+    old file or the whole new one at target.
+    '''
+    sync_file(source)
+    os.replace(source, target)
+    if os.name == 'posix':
+        # directories can not be opened on Windows
+        sync_file(os.path.dirname(os.path.abspath(target)))
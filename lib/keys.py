@@ -0,0 +1,154 @@
+import math
+import struct
+from typing import Any, Callable, List, Set, Tuple, Union
+
+# valid numbers start with this byte, so values that cannot be parsed
+# (empty or deleted fields) always come first
+NUMBER_PREFIX = b'\x01'
+SIGN_BIT = 1 << 63
+ALL_BITS = (1 << 64) - 1
+NUMERIC_KEY_LENGTH = 9
+
+
+def parse_number(value: Any, column_type: str) -> Union[int, float, None]:
+    '''
+    Number held by the text of an INTEGER or FLOAT column, or None if
+    it cannot be parsed (empty or deleted fields).
+    '''
+    text = str(value).strip(' ')
+    if column_type == 'INTEGER':
+        try:
+            return int(text)
+        except ValueError:
+            try:
+                return int(float(text))
+            except (ValueError, OverflowError):
+                return None
+    try:
+        # adding 0.0 turns -0.0 into 0.0, so both get the same key
+        return float(text) + 0.0
+    except ValueError:
+        return None
+
+
+def parse_value(text: str, column_type: str) -> Any:
+    '''
+    Value held by the text of a column: a number for INTEGER and FLOAT
+    columns (None if it cannot be parsed), the text without its padding
+    spaces otherwise.
+    '''
+    if column_type in ('INTEGER', 'FLOAT'):
+        return parse_number(text, column_type)
+    return text.strip(' ')
+
+
+def register_parser(column_sizes: List[int], column_types: List[str],
+                    columns: List[int]) -> Callable[[bytes], Tuple]:
+    '''
+    Function giving the values (see parse_value) of columns, in that
+    order, held by a register.
+    '''
+    fields = [(sum(column_sizes[:idx]), sum(column_sizes[:idx + 1]),
+               column_types[idx]) for idx in columns]
+
+    def parse(register: bytes) -> Tuple:
+        return tuple(parse_value(register[start:end].decode('utf-8',
+                                                            errors='replace'),
+                                 column_type)
+                     for start, end, column_type in fields)
+    return parse
+
+
+def encode_key(value: Any, column_type: str) -> bytes:
+    '''
+    Encodes the value of a column in bytes that sort the same way as the
+    values themselves, so keys can be compared without knowing the type:
+    INTEGER: 8 bytes big endian, with the sign bit flipped
+    FLOAT: 8 bytes of the IEEE 754 double, sign bit flipped for positive
+    numbers and every bit flipped for negative ones
+    CHAR: the utf-8 bytes of the text, without the padding spaces
+    '''
+    if column_type not in ('INTEGER', 'FLOAT'):
+        return str(value).strip(' ').encode('utf-8')
+    number = parse_number(value, column_type)
+    if number is None:
+        return b''
+    if column_type == 'INTEGER':
+        return NUMBER_PREFIX + struct.pack('>Q', (number + SIGN_BIT) & ALL_BITS)
+    bits = struct.unpack('>Q', struct.pack('>d', number))[0]
+    if bits & SIGN_BIT:
+        bits ^= ALL_BITS
+    else:
+        bits |= SIGN_BIT
+    return NUMBER_PREFIX + struct.pack('>Q', bits)
+
+
+def key_length(column_type: str, column_size: int) -> int:
+    '''
+    Maximum length of the key of a column.
+    '''
+    if column_type in ('INTEGER', 'FLOAT'):
+        return NUMERIC_KEY_LENGTH
+    return column_size
+
+
+def search_value(value: Any, column_type: str, bound: str = None) -> Any:
+    '''
+    Value searched on a column. On an INTEGER column, a number that is
+    not integral matches nothing (None is returned), unless it is the
+    'low' bound of a range, rounded up, or the 'high' one, rounded down.
+    '''
+    if column_type != 'INTEGER':
+        return value
+    text = str(value).strip(' ')
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        number = float(text)
+    except ValueError:
+        return value
+    if math.isinf(number) or math.isnan(number):
+        return value
+    if number.is_integer():
+        return int(number)
+    if bound == 'low':
+        return math.ceil(number)
+    if bound == 'high':
+        return math.floor(number)
+    return None
+
+
+def search_keys(values: List[Any], column_type: str) -> Set[bytes]:
+    '''
+    Keys of the values searched on a column (see search_value).
+    '''
+    return set(encode_key(value, column_type) for value in
+               (search_value(value, column_type) for value in values)
+               if value is not None)
+
+
+def key_bounds(values: List[Any], column_type: str) -> Tuple[bytes, bytes]:
+    '''
+    Lowest and highest key of the range between the lowest and highest
+    of values (see search_value).
+    '''
+    return (min(encode_key(search_value(value, column_type, 'low'),
+                           column_type) for value in values),
+            max(encode_key(search_value(value, column_type, 'high'),
+                           column_type) for value in values))
+
+
+def key_matcher(values: List[Any], column_type: str,
+                all_between: bool = False) -> Callable[[str], bool]:
+    '''
+    Builds a function telling if the text read from a column matches one
+    of values (or lies between the lowest and highest of them, if
+    all_between). The keys of values are encoded only once.
+    '''
+    if all_between:
+        low, high = key_bounds(values, column_type)
+        return lambda text: low <= encode_key(text, column_type) <= high
+    keys = search_keys(values, column_type)
+    return lambda text: encode_key(text, column_type) in keys
@@ -0,0 +1,65 @@
+from bisect import bisect_left, bisect_right
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+
+class Memtable:
+    '''
+    Registers of the extension file kept in memory, sorted by their key
+    on the sort column, so the registers not merged yet are found by
+    binary search and merged without being sorted again.
+    Registers with the same key keep the order they have on the file.
+    '''
+
+    def __init__(self, sort_key: Callable[[bytes], bytes],
+                 registers: Iterable[Tuple[bytes, int]] = ()) -> None:
+        '''
+        registers: register and its position on the extension file,
+        in the order of the file
+        '''
+        self.sort_key = sort_key
+        entries = sorted(((sort_key(register), register, offset)
+                          for register, offset in registers),
+                         key=lambda entry: entry[0])
+        self.keys: List[bytes] = [key for key, _, _ in entries]
+        self.entries: List[Tuple[bytes, int]] = [
+            (register, offset) for _, register, offset in entries]
+        self._offsets: Dict[int, bytes] = {
+            offset: key for key, _, offset in entries}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, register: bytes, offset: int) -> None:
+        key = self.sort_key(register)
+        # after the registers with the same key, which are older
+        idx = bisect_right(self.keys, key)
+        self.keys.insert(idx, key)
+        self.entries.insert(idx, (register, offset))
+        self._offsets[offset] = key
+
+    def remove(self, offset: int) -> None:
+        '''
+        Drops the register at offset of the extension file, if kept.
+        '''
+        key = self._offsets.pop(offset, None)
+        if key is None:
+            return
+        idx = bisect_left(self.keys, key)
+        while self.entries[idx][1] != offset:
+            idx += 1
+        del self.keys[idx]
+        del self.entries[idx]
+
+    def search(self, low: bytes, high: bytes) -> List[Tuple[bytes, int]]:
+        '''
+        Registers (and positions) whose key is between low and high.
+        '''
+        return self.entries[bisect_left(self.keys, low):
+                            bisect_right(self.keys, high)]
+
+    def registers(self) -> Iterator[bytes]:
+        for register, _ in self.entries:
+            yield register
+
+    def clear(self) -> None:
+        self.keys, self.entries, self._offsets = [], [], {}
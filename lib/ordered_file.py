@@ -1,28 +1,71 @@
+import heapq
 import logging
 import os
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Tuple, Union
 import numpy as np
 import pandas as pd
 from itertools import islice
+from .aggregate import Aggregation
+from .btree import BPlusTree, node_size_for
+from .csv_loader import (
+    LoadProgress,
+    SortColumn,
+    encode_csv_parallel,
+    read_csv_chunks,
+    sort_registers
+)
+from .header import TableHeader, file_signature
+from .memtable import Memtable
+from .runs import Compaction, RunManifest, merge_sources
+from .session import TableSession, read_operation, table_operation
+from .table_lock import TableLock
+from .vacuum import Vacuum
+from .wal import WriteAheadLog, replay_log
+from .vector_scan import (
+    iter_scan_file,
+    iter_select_records,
+    record_dtype,
+    records_to_columns,
+    scan_file
+)
+from .zone_map import ZoneMap, build_zone_map
+from .keys import (
+    encode_key,
+    key_bounds,
+    key_length,
+    key_matcher,
+    register_parser,
+    search_keys
+)
 from .helpers import (
-    check_between,
-    read_and_decode,
     adjust_digit_counts,
-    convert_list_to_str
+    convert_list_to_str,
+    iter_registers,
+    replace_file,
+    spill_registers
 )
 from .configs import (
     AMOUNT_POINTERS_CHARACTERS,
+    BACKGROUND_COMPACTION,
+    BUFFER_POOL_SIZE,
+    COMPACTION_BACKLOG_RUNS,
     FIELDS,
     EXTENSION_TABLE_THRESHOLD,
     FIRST_REGISTER_LENGTH,
+    LOAD_WRITE_BUFFER,
+    LOCATION_OFFSET_BITS,
+    LSM_TIER_RUNS,
     MAX_HEADER_COLUMNS,
     MAX_REGISTERS_LENGTH,
-    MAX_SPACE_POINTERS,
     MAX_SIZE_EXTENSION_TABLE,
     NEXT_AVALIABLE_LENGTH,
-    POINTERS_INDEX,
+    QUERY_CHUNK_REGISTERS,
+    SCAN_WORKERS,
     TIMESTAMP_LENGTH,
+    WRITE_AHEAD_LOG,
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -36,6 +79,10 @@ class OrderedFile:
         blocking_factor: int,
         fields_info: Dict,
         sort_column: str,
+        buffer_pool_size: int = BUFFER_POOL_SIZE,
+        scan_workers: int = SCAN_WORKERS,
+        background_compaction: bool = BACKGROUND_COMPACTION,
+        write_ahead_log: bool = WRITE_AHEAD_LOG,
     ) -> None:
         '''
         table_name: maximum of 32 characters (will be truncated)
@@ -47,6 +94,15 @@ class OrderedFile:
                 'size': 'max_size_of_field', (e.g.: 32)
             }
         }
+        buffer_pool_size: bytes of blocks kept in memory while the table is used
+        scan_workers: processes used by full scans of large files
+        (one per core, if None)
+        background_compaction: compact the runs on a background thread,
+        so inserts do not wait for it (see _compact)
+        write_ahead_log: log the pages written by each operation before
+        writing them in place, so a crash never leaves an operation half
+        done (see wal.WriteAheadLog). Once a table has a log, it is used
+        by every process, with or without write_ahead_log
         '''
         self.file_name = file_name
         self.table_name = table_name
@@ -56,8 +112,32 @@ class OrderedFile:
         self.register_types = [col['type'] for col in fields_info.values()]
         self.register_sizes = [int(col['size'])
                                for col in fields_info.values()]
-        self.extension_file = 'extension.txt'
+        # each table has its own extension file, so tables sharing a
+        # directory never mix their registers
+        self.extension_file = self._sidecar_path('ext')
         self.sort_column = sort_column
+        self.buffer_pool_size = buffer_pool_size
+        self.scan_workers = scan_workers
+        self.background_compaction = background_compaction
+        self.write_ahead_log = write_ahead_log
+        self._header = None
+        self._session = None
+        self._extension_signature = None
+        self._btree_indexes = None
+        self._manifest = None
+        self._memtable = None
+        self._zone_maps = None
+        self._vacuum = None
+        self._wal = None
+        self._table_lock = TableLock(self._sidecar_path('lock'),
+                                     self._sidecar_path('gate'))
+        # generation of the table left by the last operation (see TableLock)
+        self._generation = None
+        # operations and the background compaction take turns on the table
+        self._lock = threading.RLock()
+        self._compacted = threading.Condition(self._lock)
+        self._compaction = None
+        self._compaction_thread = None
 
     def _build_create_table(self) -> str:
         create_table_str = f'CREATE TABLE {self.table_name} (' + '\n'
@@ -66,8 +146,8 @@ class OrderedFile:
             create_table_str += f'{column} {col_type}({size}),\n'
         return create_table_str
 
-    def _build_header_string(self) -> str:
-        pointers, text = self._build_text_and_positions()
+    def _build_header_string(self, created_at: str = None) -> str:
+        pointers, text = self._build_text_and_positions(created_at)
         # calculate the final position for each value
         spaces = [MAX_REGISTERS_LENGTH, TIMESTAMP_LENGTH,
                   NEXT_AVALIABLE_LENGTH, FIRST_REGISTER_LENGTH]
@@ -111,15 +191,18 @@ class OrderedFile:
             formated_pointers += str(pointer) + '-' + str(end_pointer) + ';'
         return formated_pointers
 
-    def _build_text_and_positions(self) -> List[Union[List, str]]:
+    def _build_text_and_positions(
+            self, created_at: str = None) -> List[Union[List, str]]:
         current_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        # rewrites of an existing file keep the time it was created
+        created_at = created_at or current_time
         final_text = ''
         final_text += FIELDS['table_name'] + self.table_name + \
             FIELDS['blocking_factor'] + str(self.blocking_factor) + \
             FIELDS['total_registers']
         amount_pointer = len(final_text)
         final_text += '0' + ' '*(MAX_REGISTERS_LENGTH - 1) + \
-            FIELDS['timestamp_creation'] + current_time + \
+            FIELDS['timestamp_creation'] + created_at + \
             FIELDS['timestamp_update']
         timestamp_pointer = len(final_text)
         final_text += current_time + '\n\n' + self._build_create_table() + \
@@ -132,9 +215,20 @@ class OrderedFile:
         return [pointers, final_text]
 
     def _check_extension_file_size(self) -> int:
-        amount = read_and_decode(file_name=self.extension_file,
-                                 start=0, end=MAX_SIZE_EXTENSION_TABLE)
-        return int(amount)
+        with self._open_file(self.extension_file) as f:
+            f.seek(0)
+            counter = f.read(MAX_SIZE_EXTENSION_TABLE + 1)
+        return int(counter[:counter.index(b';')].decode().strip(' '))
+
+    def _extension_start(self) -> int:
+        '''
+        Position of the first register on the extension file, right after
+        the ';' that ends its counter (files created by older versions
+        have a narrower counter).
+        '''
+        with self._open_file(self.extension_file) as f:
+            f.seek(0)
+            return f.read(MAX_SIZE_EXTENSION_TABLE + 1).index(b';') + 1
 
     def _check_file(self) -> bool:
         if os.path.exists(self.file_name):
@@ -143,9 +237,7 @@ class OrderedFile:
 
     def _format_multiple_results(self, registers: str) \
             -> pd.DataFrame:
-        result = read_and_decode(
-            self.file_name, 0, MAX_HEADER_COLUMNS).split(';')[:-1]
-        sizes = [int(i.split(':')[1]) for i in result]
+        sizes = list(self._get_header().column_sizes)
         # consider the break line character as a column
         # sizes.append(1)
         total_sizes = sum(sizes)
@@ -163,10 +255,7 @@ class OrderedFile:
         return pd.DataFrame(data=data)
 
     def _format_select_result(self, register: str) -> pd.DataFrame:
-        result = read_and_decode(
-            self.file_name, 0, MAX_HEADER_COLUMNS).split(';')[:-1]
-        # exclude logical_byte column
-        sizes = [int(i.split(':')[1]) for i in result]
+        sizes = list(self._get_header().column_sizes)
         it = iter(register)
         sliced = [list(islice(it, 0, i)) for i in sizes]
         data = {name: [''.join(item)]
@@ -176,25 +265,15 @@ class OrderedFile:
         return df
 
     def _get_column_and_total_value(self, column: str) -> Tuple[int, int, int]:
-        header_str = read_and_decode(self.file_name, 0, MAX_HEADER_COLUMNS)
-        pairs = header_str.strip().split(';')[:-1]
         try:
-            desired_col_pair = pairs[self.column_names.index(column)]
+            column_idx = self.column_names.index(column)
         except ValueError:
             logging.error(f'Column {column} does not exists on db file.')
             raise
-        column_idx, column_size = desired_col_pair.split(':')
-        total_size_till_column = sum([int(value.split(':')[1])
-                                      for value in pairs[:int(column_idx)]])
-        total_register_size = sum([int(value.split(':')[1])
-                                  for value in pairs])
-        return int(column_size), total_size_till_column, total_register_size
+        return self._get_header().column_info(column_idx)
 
     def _get_column_sizes(self) -> List[int]:
-        result = read_and_decode(
-            self.file_name, 0, MAX_HEADER_COLUMNS).split(';')[:-1]
-        sizes = [int(i.split(':')[1]) for i in result]
-        return sizes
+        return list(self._get_header().column_sizes)
 
     def _get_column_type(self, target_col: str) -> str:
         result = ''
@@ -207,27 +286,199 @@ class OrderedFile:
             raise ValueError
         return result
 
-    def _get_desired_value(self, start, end) -> str:
-        return read_and_decode(self.file_name, int(start), int(end))
+    @classmethod
+    def open(cls, *args, **kwargs) -> 'OrderedFile':
+        '''
+        Opens the table for a session: its files stay open until close()
+        is called, instead of being opened by every operation.
+        Accepts the same arguments as the constructor. Can be used as:
+        with OrderedFile.open(file_name, ...) as table:
+            table.single_insert(...)
+        '''
+        table = cls(*args, **kwargs)
+        table._start_session()
+        return table
 
-    def _get_size_of_register(self) -> int:
-        result = read_and_decode(
-            self.file_name, 0, MAX_HEADER_COLUMNS).split(';')[:-1]
-        return sum([int(i.split(':')[1]) for i in result])
+    def close(self) -> None:
+        with self._lock:
+            self._close_session()
+            self._table_lock.close()
+
+    def _close_session(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        self._btree_indexes = None
+        self._zone_maps = None
 
-    def _get_start_and_end_field(self, field: str) -> List[str]:
-        pointers_string = read_and_decode(
-            self.file_name, MAX_HEADER_COLUMNS, MAX_SPACE_POINTERS + MAX_HEADER_COLUMNS)
-        field_range = pointers_string.split(';')[POINTERS_INDEX[field]]
-        start, end = field_range.split('-')
-        return start, end
+    def __enter__(self) -> 'OrderedFile':
+        if self._session is None:
+            self._start_session()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _start_session(self) -> None:
+        self._session = TableSession(self.buffer_pool_size, self._wal)
+        if self._header is not None:
+            self._set_layouts()
+
+    def _drop_log(self) -> None:
+        '''
+        Empties the write ahead log, if the table keeps one, so none of
+        its pages is written over a new file.
+        '''
+        if self._wal is None:
+            self._open_log()
+        if self._wal is not None:
+            self._wal.checkpoint()
+
+    def _open_log(self) -> None:
+        '''
+        Opens the write ahead log, if the table keeps one. The log belongs
+        to the table: once a process opens it with write_ahead_log, every
+        process writing the table logs its pages as well, otherwise a page
+        written without the log could be overwritten by an older one
+        replayed from it. What a crash left on the log is replayed first.
+        The log is only ever emptied, never removed, as other processes
+        may be appending to it.
+        '''
+        path = self._sidecar_path('wal')
+        if not self.write_ahead_log and not os.path.exists(path):
+            return
+        with self._table_lock.hold():
+            if os.path.exists(path):
+                replay_log(path)
+            self._wal = WriteAheadLog(path)
+        if self._session is not None:
+            self._session.pool.wal = self._wal
+
+    @contextmanager
+    def _operation(self, shared: bool = False) -> Iterator[TableSession]:
+        '''
+        Wraps a public operation. Without an open session, a temporary one
+        is used, so each file is opened at most once per operation.
+        Only one operation runs on the table at a time, and the lock of
+        the table is held meanwhile, shared if the operation only reads
+        (see table_lock.TableLock).
+        '''
+        with self._lock:
+            generation = self._table_lock.acquire(shared)
+            try:
+                if self._wal is None and self._table_lock.depth == 1:
+                    self._open_log()
+                    # the lock may have been taken exclusively meanwhile
+                    generation = self._table_lock.generation
+                temporary = self._session is None
+                if temporary:
+                    self._start_session()
+                session = self._session
+                if session.depth == 0:
+                    self._refresh_header(generation != self._generation)
+                session.depth += 1
+                try:
+                    yield session
+                    if session.depth == 1:
+                        # the header is committed along with the pages changed
+                        self._flush_header()
+                        session.flush()
+                except Exception:
+                    if session.depth == 1:
+                        # nothing of a failed operation is committed
+                        session.rollback()
+                        self._forget_indexes(replaced=False)
+                        self._manifest = None
+                    # pending header changes cannot be trusted anymore
+                    self._header = None
+                    self._memtable = None
+                    raise
+                finally:
+                    session.depth -= 1
+                    if temporary:
+                        self._close_session()
+            finally:
+                self._generation = self._table_lock.release()
+
+    @contextmanager
+    def _open_file(self, path: str) -> Iterator[BinaryIO]:
+        '''
+        Gives the handle kept by the session for path.
+        '''
+        yield self._session.handle(path)
+
+    def _get_header(self) -> TableHeader:
+        if self._header is None:
+            self._header = TableHeader(self.file_name)
+            self._load_header()
+        return self._header
+
+    def _load_header(self) -> None:
+        with self._open_file(self.file_name) as f:
+            self._header.load(f)
+        self._set_layouts()
+
+    def _set_layouts(self) -> None:
+        # one page of the buffer pool is one block of registers
+        block_size = self.blocking_factor * self._header.register_size
+        self._session.set_layout(self.file_name, self._header.records_start,
+                                 block_size)
+        self._session.set_layout(self.extension_file,
+                                 MAX_SIZE_EXTENSION_TABLE + 1, block_size)
+        if self._manifest is not None:
+            for number, _, _ in self._manifest.runs:
+                self._session.set_layout(self._run_path(number), 0, block_size)
+
+    def _refresh_header(self, changed: bool = False) -> None:
+        '''
+        Called at the beginning of every operation. Loads the header again
+        only if the file was modified by someone else (or changed, the
+        generation of the table moved), and the same for the extension
+        file and the runs.
+        '''
+        if self._header is not None and (changed or self._header.is_stale()):
+            # the buffer of the handle may hold old data as well
+            self._session.forget(self.file_name, replaced=False)
+            self._load_header()
+            # the indexes were probably changed along with the file
+            self._forget_indexes(replaced=False)
+            self._drop_vacuum()
+        if self._extension_signature is not None and (changed or \
+                self._extension_signature != file_signature(self.extension_file)):
+            self._session.forget(self.extension_file, replaced=False)
+            self._forget_indexes(replaced=False)
+            self._memtable = None
+        if self._manifest is not None and \
+                (changed or self._manifest.is_stale()):
+            # runs were compacted by someone else
+            for number, _, _ in self._manifest.runs:
+                self._session.forget(self._run_path(number), replaced=False)
+            self._manifest = None
+            self._forget_indexes(replaced=False)
+        if changed and self._compaction is not None:
+            # planned on files someone else may have merged already
+            self._compaction.stale = True
+
+    def _flush_header(self) -> None:
+        '''
+        Called at the end of every operation. Writes the changed header
+        fields at once.
+        '''
+        header = self._get_header()
+        with self._open_file(self.file_name) as f:
+            header.flush(f)
+        if os.path.exists(self.extension_file):
+            self._session.sync(self.extension_file)
+            self._extension_signature = file_signature(self.extension_file)
+
+    def _get_size_of_register(self) -> int:
+        return self._get_header().register_size
 
     def _get_value_from_field(self, field: str) -> str:
         '''
         Get value from a desired field of the header of the db file.
         '''
-        start, end = self._get_start_and_end_field(field)
-        return self._get_desired_value(start, end)
+        return self._get_header().get(field)
 
     def _make_header(self) -> None:
         if self._check_file():
@@ -236,243 +487,880 @@ class OrderedFile:
         with open(file=self.file_name, mode='w+b') as f:
             f.write(bytearray(header_text, 'utf-8'))
 
-    def _merge_extension_table(self, order_field: str) -> None:
-        register_size = self._get_size_of_register()
+    def _merge_extension_table(self) -> None:
+        '''
+        Moves the registers of the extension file to a new sorted run
+        (see _compact). Once the runs would hold as many registers as the
+        main file, they are all merged with it into a new main file
+        instead, so every register is written again only a logarithmic
+        amount of times.
+        The registers of the extension are already sorted on the
+        memtable (see _get_memtable).
+        '''
         extension_size = self._check_extension_file_size()
-        amount_on_main_file = int(self._get_value_from_field('amount'))
-        first_register_pos = self._get_value_from_field('first_register')
-        # +1 to account for the ; character
-        registers = read_and_decode(self.extension_file, MAX_SIZE_EXTENSION_TABLE+1,
-                                    999999)
-        # transform in list and split the registers
-        registers = list(registers[i:i+register_size] for i
-                         in range(0, extension_size*register_size, register_size))
-        # remove deleted registers
-        registers = [register for register in registers if register[0] == 'Y']
-        extension_size = len(registers)
-        # short circuit if everything on extension table was to be deleted
-        if not registers:
-            logging.info('Nothing to do!')
-            return
-        # sort the list based on desired field
-        column_sizes = self._get_column_sizes()
-        try:
-            desired_col_index = self.column_names.index(order_field)
-        except ValueError as e:
-            raise Exception(f'Column {order_field} does not exists.') from e
-
-        size_until_desired_col = sum(column_sizes[:desired_col_index])
-        start_pos = size_until_desired_col
-        end_pos = start_pos + column_sizes[desired_col_index]
-        registers.sort(key=lambda x: x[start_pos:end_pos])
-        # save the desired column values for easier comparison on next step
-        desired_column_values = [x[start_pos:end_pos] for x in registers]
-        logging.info(
-            f'Preparing to merge {len(registers)} registers to main file.')
-        # create new file to insert registers ordered by desired order_field
-        with open(file='temp_file.txt', mode='w+b') as f:
-            header_text = self._build_header_string()
-            f.write(bytearray(header_text, 'utf-8'))
-        # iterate on old and registers from extension file
-        # and insert every register sorted by the desired column
-        # while at it, do not insert registers with logical byte N
-        extension_index = 0
-        extension_value = desired_column_values[extension_index]
-        new_amount = 0
-        main_index = 0
-        temp = open(file='temp_file.txt', mode='r+b')
-        temp.seek(int(first_register_pos))
-        with open(file=self.file_name, mode='r+b') as f:
-            f.seek(int(first_register_pos))
-            current = f.read(register_size)
-            decoded = current.decode()
-            while main_index < amount_on_main_file \
-                    or extension_index < len(registers):
-                # check logical byte value
-                if decoded[0] == 'N':
-                    # logically deleted, can be skipped
-                    main_index += 1
-                    current = f.read(register_size)
-                    decoded = current.decode()
-                    continue
-                # check if the extension file current value is lower or not
-                # or if extension table is already empty
-                try:
-                    curr_main_value = decoded[start_pos:end_pos]
-                except IndexError:
-                    # reached the end of main file
-                    curr_main_value = ''
-                if (curr_main_value <= extension_value or
-                    extension_index == len(registers)) \
-                        and main_index < amount_on_main_file:
-                    temp.write(current)
-                    new_amount += 1
-                    main_index += 1
-                    current = f.read(register_size)
-                    decoded = current.decode()
-                # keep inserting extension table registers until
-                # main register is "lower" or extension table is empty
-                else:
-                    while (extension_value < curr_main_value or curr_main_value == '') \
-                            and extension_index < len(registers):
-                        temp.write(
-                            bytearray(registers[extension_index], 'utf-8'))
-                        new_amount += 1
-                        extension_index += 1
-                        if extension_index == len(registers):
-                            continue
-                        extension_value = desired_column_values[extension_index]
-            temp.write(b' ')
-        temp.close()
-        # delete old file
-        directory = os.path.dirname(os.path.realpath(self.file_name))
-        old_file_path = os.path.join(directory, self.file_name)
-        os.remove(old_file_path)
-        # rename new file to old file name
-        os.rename(os.path.join(directory, 'temp_file.txt'), old_file_path)
-        # update desired fields
-        self._update_desired_fields(['timestamp', 'amount'], [1, new_amount])
+        merged = len(self._get_memtable())
+        run_tables = self._run_tables()
+        to_main = not self.background_compaction and \
+            extension_size + self._get_manifest().amount() >= \
+            int(self._get_value_from_field('amount'))
+        if to_main:
+            logging.info(
+                f'Preparing to merge {extension_size} registers to main file.')
+            self._merge_runs((), False, ['main'] + run_tables + ['extension'])
+            self._remove_runs(run_tables)
+        else:
+            self._wait_for_backlog()
+            logging.info(
+                f'Preparing to merge {extension_size} registers to a new run.')
+            self._unindex_table('extension')
+            self._new_run(self._table_registers('extension'))
         logging.info(
-            f'Successfully merged {len(registers)} registers from extension file.')
+            f'Successfully merged {merged} registers from extension file.')
         # clear extension table
-        with open(file=self.extension_file, mode='w+b') as f:
+        with self._open_file(self.extension_file) as f:
+            f.seek(0)
             f.write(
                 bytearray(f'0{" "*(MAX_SIZE_EXTENSION_TABLE - 1)}; ', 'utf-8'))
+            f.truncate()
+        self._memtable.clear()
+        if to_main:
+            # every register moved, so the indexes are built again
+            self._rebuild_indexes()
+        else:
+            self._compact()
 
-    def _scan_single_key(self, pk_value: str, target_col: str,
-                         table: str = 'main', silenced: bool = True):
+    def _get_memtable(self) -> Memtable:
+        '''
+        Live registers of the extension file, sorted by sort_column.
+        Read from the file once, then kept up to date by every insert,
+        delete and merge while the file is not changed by someone else.
+        '''
+        if self._memtable is None:
+            register_size = self._get_size_of_register()
+            file, start, amount = self._table_area('extension')
+            with self._open_file(file) as f:
+                registers = [
+                    (register, start + idx*register_size)
+                    for idx, register in enumerate(
+                        iter_registers(f, start, amount, register_size))
+                    if register[:1] == b'Y']
+            self._memtable = Memtable(self._sort_key(), registers)
+        return self._memtable
+
+    def _add_to_memtable(self, registers: List[bytes], start: int) -> None:
+        # otherwise, it is read from the file when needed
+        if self._memtable is None:
+            return
+        register_size = self._get_size_of_register()
+        for idx, register in enumerate(registers):
+            self._memtable.add(bytes(register[:register_size]),
+                               start + idx*register_size)
+
+    def _get_manifest(self) -> RunManifest:
+        if self._manifest is None:
+            self._manifest = RunManifest(self._sidecar_path('runs'))
+            self._get_header()
+            self._set_layouts()
+        return self._manifest
+
+    def _run_path(self, number: int) -> str:
+        return self._sidecar_path(f'{number}.run')
+
+    def _run_number(self, table: str) -> int:
+        return int(table[len('run'):])
+
+    def _run_tables(self, tier: int = None) -> List[str]:
+        '''
+        Names of the runs (of tier, if given), oldest first.
+        '''
+        return [f'run{number}' for number, run_tier, _
+                in self._get_manifest().runs if tier in (None, run_tier)]
+
+    def _tables(self) -> List[str]:
+        '''
+        Every place holding registers, newest first: the extension file,
+        the runs and the main file.
+        '''
+        return ['extension'] + self._run_tables()[::-1] + ['main']
+
+    def _table_area(self, table: str) -> Tuple[str, int, int]:
+        '''
+        File of table, position of its first register and amount
+        of registers.
+        '''
         if table == 'main':
-            initial_pos = self._get_value_from_field('first_register')
-            amount = int(self._get_value_from_field('amount'))
-            file = self.file_name
+            return self.file_name, \
+                int(self._get_value_from_field('first_register')), \
+                int(self._get_value_from_field('amount'))
+        if table == 'extension':
+            return self.extension_file, self._extension_start(), \
+                self._check_extension_file_size()
+        return self._table_file(table), 0, \
+            self._get_manifest().amount(self._run_number(table))
+
+    def _write_run(self, path: str, registers: Iterator[bytes]) -> int:
+        amount = 0
+        with open(file=path, mode='wb', buffering=LOAD_WRITE_BUFFER) as f:
+            for register in registers:
+                f.write(register)
+                amount += 1
+            # on the disk before the manifest lists it
+            f.flush()
+            os.fsync(f.fileno())
+        return amount
+
+    def _new_run(self, registers: Iterator[bytes]) -> int:
+        '''
+        Writes registers (already sorted) to a new run of tier 0.
+        Returns the amount of registers written.
+        '''
+        manifest = self._get_manifest()
+        number = manifest.new_number()
+        path = self._run_path(number)
+        merged = self._write_run(path, registers)
+        if merged:
+            manifest.replace([], (number, 0, merged))
+            self._set_layouts()
+            self._index_table(f'run{number}')
+            self._write_zone_map(f'run{number}')
         else:
-            initial_pos = MAX_SIZE_EXTENSION_TABLE + 1
-            amount = self._check_extension_file_size()
-            file = self.extension_file
+            # every register was deleted
+            os.remove(path)
+        return merged
+
+    def _remove_runs(self, tables: List[str]) -> None:
+        '''
+        Drops the runs on tables, already merged into the main file.
+        '''
+        if not tables:
+            return
+        self._get_manifest().replace([self._run_number(table)
+                                      for table in tables])
+        self._remove_run_files(tables)
+
+    def _remove_run_files(self, tables: List[str]) -> None:
+        for table in tables:
+            for path in (self._table_file(table), self._zone_map_path(table)):
+                if self._session is not None:
+                    self._session.forget(path)
+                elif self._wal is not None:
+                    self._wal.release(path)
+                if os.path.exists(path):
+                    os.remove(path)
+            if self._zone_maps is not None:
+                self._zone_maps.pop(table, None)
+
+    def _compact(self) -> None:
+        '''
+        Does the compactions due (see _plan_compaction), or leaves them to
+        the background thread if background_compaction is set. Meanwhile,
+        the table keeps being read from the files being merged.
+        '''
+        if self.background_compaction:
+            if self._compaction_thread is None:
+                self._compaction_thread = threading.Thread(
+                    target=self._compaction_worker)
+                self._compaction_thread.start()
+            return
+        while True:
+            compaction = self._plan_compaction()
+            if compaction is None:
+                return
+            self._run_compaction(compaction)
+            self._commit_compaction(compaction)
+
+    def _compaction_worker(self) -> None:
+        '''
+        Body of the background thread: does one compaction at a time,
+        while there are compactions due.
+        '''
+        try:
+            while True:
+                with self._operation():
+                    if self._compaction is not None:
+                        if self._compaction.stale:
+                            self._discard_compaction()
+                        else:
+                            self._commit_compaction(self._compaction)
+                        self._compacted.notify_all()
+                    self._compaction = self._plan_compaction()
+                    if self._compaction is None:
+                        self._compaction_thread = None
+                        return
+                # the files are merged without holding the table
+                self._run_compaction(self._compaction)
+        except Exception:
+            logging.exception('Background compaction failed.')
+            with self._lock:
+                self._discard_compaction()
+                self._compaction_thread = None
+        finally:
+            with self._lock:
+                self._compacted.notify_all()
+
+    def _discard_compaction(self) -> None:
+        '''
+        Removes the files written by the background compaction, which
+        will not be committed.
+        '''
+        if self._compaction is not None:
+            for path in (self._compaction.path,
+                         self._compaction.zone_map_path):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+        self._compaction = None
+
+    def _wait_for_backlog(self) -> None:
+        '''
+        Blocks while COMPACTION_BACKLOG_RUNS runs wait for the
+        background compaction.
+        '''
+        while self._compaction_thread is not None and \
+                self._get_manifest().pending(LSM_TIER_RUNS) >= \
+                COMPACTION_BACKLOG_RUNS:
+            self._compacted.wait()
+
+    def wait_for_compaction(self) -> None:
+        '''
+        Blocks until the background compaction, if any, is done.
+        '''
+        with self._lock:
+            while self._compaction_thread is not None:
+                self._compacted.wait()
+
+    def _plan_compaction(self) -> Union[Compaction, None]:
+        '''
+        Size tiered compaction: every LSM_TIER_RUNS runs of the same tier
+        are merged into one run of the next tier, so only the runs
+        involved are written again. Once the runs hold as many registers
+        as the main file, they are all merged with it instead.
+        Returns the next compaction due, if any.
+        '''
+        manifest = self._get_manifest()
+        tier = manifest.full_tier(LSM_TIER_RUNS)
+        if tier is not None:
+            tables = self._run_tables(tier)
+            number = manifest.new_number()
+            if self.background_compaction:
+                # other processes must not take the number meanwhile
+                manifest.save()
+            path = self._run_path(number)
+            logging.info(f'Compacting {len(tables)} runs of tier {tier}.')
+            tier += 1
+        elif manifest.runs and \
+                manifest.amount() >= int(self._get_value_from_field('amount')):
+            tables = ['main'] + self._run_tables()
+            # one file per process, as several may compact the table
+            number = None
+            path = self._sidecar_path(f'compact.{os.getpid()}')
+            logging.info(f'Compacting {len(tables) - 1} runs with main file.')
+        else:
+            return None
+        sources = []
+        for table in tables:
+            file, start, amount = self._table_area(table)
+            # the files are read straight from the disk
+            self._session.sync(file)
+            sources.append((file, start, amount, self._location(table, 0)))
+        bloom_columns = self._zone_map_columns()
+        zone_map_path = None
+        if bloom_columns is not None:
+            zone_map_path = path + '.zmap' if number is None \
+                else self._zone_map_path(f'run{number}')
+        compaction = Compaction(tables, tier, sources, path,
+                                self._get_size_of_register(), self._sort_key(),
+                                number, zone_map_path, bloom_columns)
+        if tier is None:
+            # the space at the end of the header is where registers start
+            compaction.header = bytearray(self._build_header_string(
+                self._get_header().created_at)[:-1], 'utf-8')
+        return compaction
+
+    def _run_compaction(self, compaction: Compaction) -> None:
+        '''
+        Writes the new file of compaction. Does not use the session, so
+        it may run on the background thread.
+        '''
+        with open(file=compaction.path, mode='wb',
+                  buffering=LOAD_WRITE_BUFFER) as f:
+            if compaction.tier is None:
+                f.write(compaction.header)
+            start = f.tell()
+            # positions are only needed if registers may be deleted meanwhile
+            compaction.amount = merge_sources(
+                compaction.sources, f, compaction.register_size,
+                compaction.sort_key,
+                compaction.locations if self.background_compaction else None)
+            if compaction.tier is None:
+                f.write(b' ')
+            # synced here, out of the lock, before the commit uses it
+            f.flush()
+            os.fsync(f.fileno())
+        if compaction.zone_map_path is not None:
+            self._build_zone_map(compaction.zone_map_path, compaction.path,
+                                 start, compaction.amount,
+                                 compaction.bloom_columns)
+
+    def _commit_compaction(self, compaction: Compaction) -> None:
+        '''
+        Puts the file written by compaction in place of the files it
+        merged, and deletes from it the registers deleted meanwhile.
+        '''
+        runs = [table for table in compaction.tables if table != 'main']
+        numbers = [self._run_number(table) for table in runs]
+        if compaction.tier is None:
+            self._session.forget(self.file_name)
+            replace_file(compaction.path, self.file_name)
+            self._drop_vacuum()
+            # the cached header belongs to the replaced file
+            self._header = None
+            self._update_desired_fields(['timestamp', 'amount'],
+                                        [1, compaction.amount])
+            self._get_manifest().replace(numbers)
+            file, start = self.file_name, self._get_header().records_start
+            table = 'main'
+            if compaction.zone_map_path is not None:
+                self._forget_zone_maps()
+                replace_file(compaction.zone_map_path,
+                             self._zone_map_path(table))
+        else:
+            for table in runs:
+                self._unindex_table(table)
+            table = f'run{compaction.number}'
+            if compaction.amount:
+                self._get_manifest().replace(numbers, (
+                    compaction.number, compaction.tier, compaction.amount))
+            else:
+                self._get_manifest().replace(numbers)
+                self._remove_run_files([table])
+            file, start = compaction.path, 0
+        self._remove_run_files(runs)
+        self._set_layouts()
+        if compaction.zone_map_path is None and \
+                (compaction.tier is None or compaction.amount):
+            # zone maps may have been created while the files were merged
+            self._write_zone_map(table)
+        if compaction.deleted:
+            with self._open_file(file) as f:
+                for idx, location in enumerate(compaction.locations):
+                    if location in compaction.deleted:
+                        f.seek(start + idx*compaction.register_size)
+                        f.write(bytearray('N', 'utf-8'))
+        if compaction.tier is None:
+            self._rebuild_indexes()
+        elif compaction.amount:
+            self._index_table(f'run{compaction.number}')
+
+    def _scan_single_key(self, pk_value: str, target_col: str,
+                         table: str = 'main', silenced: bool = True):
+        if table == 'extension' and target_col == self.sort_column:
+            result, pointer, _ = self._search_memtable(
+                [pk_value], silenced, first_only=True)
+            return result, pointer
+        file, initial_pos, amount = self._table_area(table)
+        if target_col == self.sort_column:
+            # main file and runs are sorted by this column, no need to scan them
+            result, pointer, _ = self._search_sorted_routine(
+                [pk_value], target_col, initial_pos, amount, file,
+                silenced, first_only=True)
+            return result, pointer
+        tree = self._get_btree_indexes().get(target_col)
+        if tree is not None:
+            found = self._lookup_btree(tree, [pk_value], table=table)
+            if not found:
+                return '', 0
+            if not silenced:
+                logging.info('Register found!')
+            return found[0]
         result, pointer = self._scan_single_routine(pk_value, target_col, initial_pos,
-                                                    amount, file, silenced)
+                                                    amount, file, silenced, table)
         return result, pointer
 
     def _scan_all_keys(self, values: str, target_col: str,
                        table: str = 'main', silenced: bool = True,
                        all_between: bool = False):
-        if table == 'main':
-            initial_pos = self._get_value_from_field('first_register')
-            amount = int(self._get_value_from_field('amount'))
-            file = self.file_name
-        else:
-            initial_pos = MAX_SIZE_EXTENSION_TABLE + 1
-            amount = self._check_extension_file_size()
-            file = self.extension_file
+        if table == 'extension' and target_col == self.sort_column:
+            return self._search_memtable(values, silenced, all_between)
+        file, initial_pos, amount = self._table_area(table)
+        if target_col == self.sort_column:
+            # main file and runs are sorted by this column, no need to scan them
+            return self._search_sorted_routine(
+                values, target_col, initial_pos, amount, file,
+                silenced, all_between)
+        tree = self._get_btree_indexes().get(target_col)
+        if tree is not None:
+            found = self._lookup_btree(tree, values, all_between, table)
+            if found and not silenced:
+                logging.info('Register found!')
+            pointer = found[-1][1] if found else 0
+            return ''.join(register for register, _ in found), \
+                pointer, len(found)
         result, pointer, total_found = \
             self._scan_all_routine(values, target_col, initial_pos, amount,
-                                   file, silenced, all_between)
+                                   file, silenced, all_between, table)
         return result, pointer, total_found
 
     def _scan_single_routine(self, pk_value: str, target_col: str,
                              initial_pos: str, amount: int, file_name: str,
-                             silenced: bool = True) -> Tuple[str, int]:
-        cont, pointer = 0, 0
-        result = ''
-        pk_value = str(pk_value)
-        column_size, size_till_column, total_size = \
-            self._get_column_and_total_value(target_col)
-        with open(file=file_name, mode='r+b') as f:
-            f.seek(int(initial_pos))
-            while cont <= amount:
-                # check if it is logically deleted
-                # read specific column to check for equality
-                logical_byte = f.read(1).decode()
-                f.seek(size_till_column - 1, 1)
-                temp_result = f.read(column_size).decode().strip(' ')
-                if temp_result == pk_value and logical_byte == 'Y':
-                    if not silenced:
-                        logging.info('Register found!')
-                    # if found, read full register
-                    f.seek(-(size_till_column + column_size), 1)
-                    result = f.read(total_size).decode().strip(' ')
-                    break
-                cont += 1
-                f.seek(total_size - column_size - size_till_column, 1)
-            pointer += f.tell() - total_size
-        return result, pointer
+                             silenced: bool = True,
+                             table: str = 'main') -> Tuple[str, int]:
+        found = self._vector_scan([pk_value], target_col, initial_pos, amount,
+                                  file_name, table=table)
+        if not found:
+            return '', 0
+        if not silenced:
+            logging.info('Register found!')
+        return found[0]
 
     def _scan_all_routine(self, values: str, target_col: str, initial_pos: str,
                           amount: int, file_name: str, silenced: bool = True,
-                          all_between: bool = False) -> Tuple[str, int, int]:
-        total_found, cont, pointer = 0, 0, 0
+                          all_between: bool = False,
+                          table: str = 'main') -> Tuple[str, int, int]:
+        found = self._vector_scan(values, target_col, initial_pos, amount,
+                                  file_name, all_between, table)
+        if found and not silenced:
+            logging.info('Register found!')
+        pointer = found[-1][1] if found else 0
+        return ''.join(register for register, _ in found), pointer, len(found)
+
+    def _vector_scan(self, values: List[Any], target_col: str,
+                     initial_pos: str, amount: int, file_name: str,
+                     all_between: bool = False,
+                     table: str = 'main') -> List[Tuple[str, int]]:
+        '''
+        Registers (text and position) of file_name matching values on
+        target_col, found by one vectorized pass over the mapped file
+        (see vector_scan.scan_file), skipping the logically deleted ones
+        and the blocks ruled out by the zone map of table, if any.
+        '''
+        column_type = self._get_column_type(target_col)
+        column_idx = self.column_names.index(target_col)
+        register_size = self._get_size_of_register()
+        initial_pos = int(initial_pos)
+        block_registers, blocks = self._candidate_blocks(
+            table, target_col, values, amount, all_between)
+        # the mapped file must have every pending write
+        self._session.sync(file_name)
+        # the first column of every register is its logical byte
+        found = scan_file(file_name, initial_pos, amount,
+                          self._get_column_sizes(), column_idx, column_type,
+                          values, all_between, logical_column=0,
+                          workers=self.scan_workers,
+                          block_registers=block_registers, blocks=blocks)
+        return [(register.strip(' '), initial_pos + row*register_size)
+                for row, register in found]
+
+    def _candidate_blocks(self, table: str, target_col: str,
+                          values: List[Any], amount: int,
+                          all_between: bool = False) \
+            -> Tuple[int, Union[List[int], None]]:
+        '''
+        Registers of a block of table and the blocks of its amount
+        registers that may hold values on target_col, according to its
+        zone map (None if it has none).
+        '''
+        zone_map = self._get_zone_map(table)
+        if zone_map is None:
+            return self.blocking_factor, None
+        column_type = self._get_column_type(target_col)
+        return zone_map.block_registers, zone_map.candidate_blocks(
+            self.column_names.index(target_col),
+            self._key_ranges(values, column_type, all_between),
+            -(-amount // zone_map.block_registers))
+
+    def _key_ranges(self, values: List[Any], column_type: str,
+                    all_between: bool = False) -> List[Tuple[bytes, bytes]]:
+        '''
+        Lowest and highest key of each value (or of the whole range
+        between the lowest and highest of them, if all_between).
+        '''
+        if all_between:
+            return [key_bounds(values, column_type)]
+        keys = sorted(search_keys(values, column_type))
+        return [(key, key) for key in keys]
+
+    def _search_position(self, f: BinaryIO, key: bytes, column_type: str,
+                         initial_pos: int, amount: int, size_till_column: int,
+                         column_size: int, total_size: int,
+                         after_equals: bool = False) -> int:
+        '''
+        Binary search for the index of the first register whose key on
+        the sort column is not lower than key (or greater than key,
+        if after_equals is set), on a file sorted by that column.
+        '''
+        low, high = 0, amount
+        while low < high:
+            middle = (low + high) // 2
+            f.seek(initial_pos + middle*total_size + size_till_column)
+            current = encode_key(f.read(column_size).decode(), column_type)
+            if current < key or (after_equals and current == key):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _search_sorted_routine(self, values: List[Any], target_col: str,
+                               initial_pos: str, amount: int, file_name: str,
+                               silenced: bool = True, all_between: bool = False,
+                               first_only: bool = False) -> Tuple[str, int, int]:
+        '''
+        Same as _scan_all_routine, but for a file sorted by target_col:
+        each value (or the range between the lowest and highest value,
+        if all_between) is found by binary search and only the matching
+        registers are read.
+        '''
+        total_found, pointer = 0, 0
         result = ''
-        values = [str(val) for val in values]
         column_type = self._get_column_type(target_col)
+        ranges = self._key_ranges(values, column_type, all_between)
         column_size, size_till_column, total_size = \
             self._get_column_and_total_value(target_col)
-        with open(file=file_name, mode='r+b') as f:
-            f.seek(int(initial_pos))
-            while cont < amount:
-                # check if it is logically deleted
-                # read specific column to check for equality
-                logical_byte = f.read(1).decode()
-                f.seek(size_till_column - 1, 1)
-                temp_result = f.read(column_size).decode().strip(' ')
-                if (temp_result in values or
-                    (check_between(temp_result, values, column_type) and all_between)) \
-                        and logical_byte == 'Y':
+        initial_pos = int(initial_pos)
+        with self._open_file(file_name) as f:
+            for low_key, high_key in ranges:
+                start = self._search_position(
+                    f, low_key, column_type, initial_pos, amount,
+                    size_till_column, column_size, total_size)
+                end = self._search_position(
+                    f, high_key, column_type, initial_pos, amount,
+                    size_till_column, column_size, total_size,
+                    after_equals=True)
+                # the matching registers are all together, read them at once
+                f.seek(initial_pos + start*total_size)
+                block = f.read((end - start)*total_size).decode()
+                for idx in range(end - start):
+                    register = block[idx*total_size:(idx + 1)*total_size]
+                    # skip logically deleted registers
+                    if register[0] != 'Y':
+                        continue
                     if not silenced:
                         logging.info('Register found!')
-                    # if found, read full register
-                    f.seek(-(size_till_column + column_size), 1)
-                    a = f.read(total_size).decode().strip(' ')
-                    result += a
-                    cont += 1
+                    pointer = initial_pos + (start + idx)*total_size
+                    if first_only:
+                        return register.strip(' '), pointer, 1
+                    result += register.strip(' ')
                     total_found += 1
-                    continue
-                cont += 1
-                f.seek(total_size - column_size - size_till_column, 1)
-            pointer += f.tell() - total_size
+        return result, pointer, total_found
+
+    def _search_memtable(self, values: List[Any], silenced: bool = True,
+                         all_between: bool = False,
+                         first_only: bool = False) -> Tuple[str, int, int]:
+        '''
+        Same as _search_sorted_routine, for the extension file, whose
+        registers are found on the memtable by sort_column.
+        '''
+        total_found, pointer = 0, 0
+        result = ''
+        column_type = self._get_column_type(self.sort_column)
+        ranges = self._key_ranges(values, column_type, all_between)
+        memtable = self._get_memtable()
+        for low_key, high_key in ranges:
+            for register, pointer in memtable.search(low_key, high_key):
+                if not silenced:
+                    logging.info('Register found!')
+                if first_only:
+                    return register.decode().strip(' '), pointer, 1
+                result += register.decode().strip(' ')
+                total_found += 1
         return result, pointer, total_found
 
     def _update_desired_fields(self, fields: List[str], amounts: List[int]) -> None:
+        header = self._get_header()
         for field, amount in zip(fields, amounts):
-            start, end = self._get_start_and_end_field(field=field)
-            curr_value = self._get_desired_value(start, end)
-            with open(file=self.file_name, mode='r+b') as f:
-                f.seek(int(start))
-                if field == 'timestamp':
-                    date = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                    f.write(bytearray(date, 'utf8'))
-                elif field == 'amount':
-                    f.write(bytearray(str(int(curr_value)+amount), 'utf8'))
-                else:
-                    str_amount = str(amount)
-                    f.write(bytearray(
-                        str_amount + ' ' *
-                            (FIRST_REGISTER_LENGTH - len(str_amount)),
-                            'utf8'))
+            if field == 'timestamp':
+                header.touch()
+            elif field == 'amount':
+                header.add_amount(amount)
+            else:
+                header.set(field, str(amount))
 
     def _update_extension_table_amount(self, current_value: int,
                                        amount: int) -> None:
-        with open(file=self.extension_file, mode='r+b') as f:
-            f.write(bytearray(str(amount + current_value), 'utf-8'))
+        counter = str(amount + current_value)
+        if len(counter) >= self._extension_start():
+            raise ValueError(
+                f'The extension file cannot count {counter} registers.')
+        with self._open_file(self.extension_file) as f:
+            f.seek(0)
+            f.write(bytearray(counter, 'utf-8'))
 
-    def _write_on_end(self, records: List, log_info: bool = False) -> None:
+    def _write_on_end(self, records: List, log_info: bool = False) -> int:
         registers, amount = records
-        with open(file=self.extension_file, mode='r+b') as f:
-            f.seek(-1, 2)
+        with self._open_file(self.extension_file) as f:
+            start = f.seek(-1, 2)
             for register in registers:
                 f.write(register)
         # need to update the amount of records on file
         if log_info:
             logging.info(f'{amount} register(s) added!')
+        return start
+
+    def _sidecar_path(self, extension: str) -> str:
+        '''
+        Path of a file kept next to the db file, e.g. its indexes.
+        '''
+        return os.path.splitext(self.file_name)[0] + '.' + extension
+
+    def _btree_path(self, column: str) -> str:
+        return self._sidecar_path(column + '.bidx')
+
+    # the indexes point to registers of every file: the highest bits
+    # of a location tell the file holding it (0 is the main file,
+    # 1 the extension file and n + 2 the run n)
+    def _location(self, table: str, offset: int) -> int:
+        if table == 'main':
+            code = 0
+        elif table == 'extension':
+            code = 1
+        else:
+            code = self._run_number(table) + 2
+        return (code << LOCATION_OFFSET_BITS) + offset
+
+    def _split_location(self, location: int) -> Tuple[str, int]:
+        code = location >> LOCATION_OFFSET_BITS
+        offset = location - (code << LOCATION_OFFSET_BITS)
+        if code < 2:
+            return ('main', 'extension')[code], offset
+        return f'run{code - 2}', offset
+
+    def _table_file(self, table: str) -> str:
+        if table == 'main':
+            return self.file_name
+        if table == 'extension':
+            return self.extension_file
+        return self._run_path(self._run_number(table))
+
+    def _get_btree_indexes(self) -> Dict[str, BPlusTree]:
+        '''
+        B+tree indexes of the table, by column.
+        '''
+        if self._btree_indexes is None:
+            self._btree_indexes = {}
+            for column in self.column_names:
+                path = self._btree_path(column)
+                if not os.path.exists(path):
+                    continue
+                with self._open_file(path) as f:
+                    tree = BPlusTree(f)
+                # one page of the buffer pool is one node
+                self._session.set_layout(path, 0, tree.node_size)
+                self._btree_indexes[column] = tree
+        return self._btree_indexes
+
+    def _forget_indexes(self, replaced: bool = True) -> None:
+        for column in self.column_names:
+            self._session.forget(self._btree_path(column), replaced)
+        self._btree_indexes = None
+        self._forget_zone_maps(replaced)
+
+    def _zone_map_path(self, table: str) -> str:
+        if table == 'main':
+            return self._sidecar_path('zmap')
+        return self._sidecar_path(f'{self._run_number(table)}.zmap')
+
+    def _get_zone_map(self, table: str) -> Union[ZoneMap, None]:
+        '''
+        Zone map of the main file or of a run, if the table has zone maps
+        (see create_zone_maps). The extension file has none.
+        '''
+        if table == 'extension':
+            return None
+        if self._zone_maps is None:
+            self._zone_maps = {}
+        if table not in self._zone_maps:
+            path = self._zone_map_path(table)
+            zone_map = None
+            if os.path.exists(path):
+                with self._open_file(path) as f:
+                    zone_map = ZoneMap(f)
+            self._zone_maps[table] = zone_map
+        return self._zone_maps[table]
+
+    def _forget_zone_maps(self, replaced: bool = True) -> None:
+        for table in self._zone_maps or {}:
+            self._session.forget(self._zone_map_path(table), replaced)
+        self._zone_maps = None
+
+    def _zone_map_columns(self) -> Union[List[int], None]:
+        '''
+        Columns with Bloom filters on the zone maps, or None if the table
+        has no zone maps. The main file always has one if they do.
+        '''
+        zone_map = self._get_zone_map('main')
+        return None if zone_map is None else zone_map.bloom_columns()
+
+    def _build_zone_map(self, path: str, file: str, start: int, amount: int,
+                        bloom_columns: List[int]) -> None:
+        # reads and writes straight from the disk, without the session
+        with open(file=path, mode='w+b') as f:
+            build_zone_map(f, file, start, amount, self.register_sizes,
+                           self.register_types, self.blocking_factor,
+                           bloom_columns, logical_column=0)
+
+    def _write_zone_map(self, table: str,
+                        bloom_columns: List[int] = None) -> None:
+        '''
+        Builds the zone map of table again, if the table has zone maps
+        (or with Bloom filters on bloom_columns, if given).
+        '''
+        if bloom_columns is None:
+            bloom_columns = self._zone_map_columns()
+            if bloom_columns is None:
+                return
+        path = self._zone_map_path(table)
+        file, start, amount = self._table_area(table)
+        self._session.sync(file)
+        self._forget_zone_maps()
+        self._build_zone_map(path, file, start, amount, bloom_columns)
+
+    def _index_key(self, tree: BPlusTree, register: str) -> bytes:
+        column_size, size_till_column, _ = \
+            self._get_column_and_total_value(tree.column)
+        value = register[size_till_column:size_till_column + column_size]
+        return encode_key(value, self._get_column_type(tree.column))[
+            :tree.key_length]
+
+    def _index_registers(self, registers: List[Tuple[str, int]],
+                         table: str = 'extension') -> None:
+        '''
+        Adds the written registers (text and position on table)
+        to the indexes.
+        '''
+        for tree in self._get_btree_indexes().values():
+            for register, offset in registers:
+                tree.insert(self._index_key(tree, register),
+                            self._location(table, offset))
+
+    def _unindex_registers(self, offsets: List[int],
+                           table: str = 'main') -> None:
+        '''
+        Removes the registers at offsets of table from the indexes.
+        Must be called before the registers are deleted.
+        '''
+        trees = list(self._get_btree_indexes().values())
+        if not trees:
+            return
+        register_size = self._get_size_of_register()
+        with self._open_file(self._table_file(table)) as f:
+            for offset in offsets:
+                f.seek(offset)
+                register = f.read(register_size).decode()
+                for tree in trees:
+                    tree.delete(self._index_key(tree, register),
+                                self._location(table, offset))
+
+    def _index_table(self, table: str) -> None:
+        if self._get_btree_indexes():
+            self._index_registers(self._live_registers(table), table)
+
+    def _unindex_table(self, table: str) -> None:
+        '''
+        Removes every register of table from the indexes, before they
+        are moved to another file.
+        '''
+        trees = list(self._get_btree_indexes().values())
+        if not trees:
+            return
+        for register, offset in self._live_registers(table):
+            for tree in trees:
+                tree.delete(self._index_key(tree, register),
+                            self._location(table, offset))
+
+    def _live_registers(self, table: str = 'main') -> List[Tuple[str, int]]:
+        '''
+        Every register (text and position) on table, skipping
+        the logically deleted ones.
+        '''
+        register_size = self._get_size_of_register()
+        file, start, amount = self._table_area(table)
+        with self._open_file(file) as f:
+            f.seek(start)
+            data = f.read(amount*register_size).decode()
+        registers = []
+        for idx in range(amount):
+            register = data[idx*register_size:(idx + 1)*register_size]
+            if register[:1] == 'Y':
+                registers.append((register, start + idx*register_size))
+        return registers
+
+    def _rebuild_indexes(self, columns: List[str] = None) -> None:
+        '''
+        Builds the indexes of columns (all of them, if not given) again
+        from the registers of every file, e.g. after the extension file
+        is merged into the main one.
+        '''
+        trees = [tree for column, tree in self._get_btree_indexes().items()
+                 if columns is None or column in columns]
+        if not trees:
+            return
+        registers = [(register, self._location(table, offset))
+                     for table in self._tables()
+                     for register, offset in self._live_registers(table)]
+        for tree in trees:
+            tree.bulk_load([(self._index_key(tree, register), location)
+                            for register, location in registers])
+
+    def _lookup_btree(self, tree: BPlusTree, values: List[Any],
+                      all_between: bool = False,
+                      table: str = 'main') -> List[Tuple[str, int]]:
+        '''
+        Registers (text and position) of table whose indexed column is one
+        of values (or between the lowest and highest of them, if
+        all_between), in the order they are on the file.
+        '''
+        column_type = self._get_column_type(tree.column)
+        column_size, size_till_column, register_size = \
+            self._get_column_and_total_value(tree.column)
+        if all_between:
+            ranges = [key_bounds(values, column_type)]
+        else:
+            ranges = [(key, key) for key in
+                      search_keys(values, column_type)]
+        offsets = set()
+        for low, high in ranges:
+            for _, location in tree.search(low, high):
+                location_table, offset = self._split_location(location)
+                if location_table == table:
+                    offsets.add(offset)
+        matches = key_matcher(values, column_type, all_between)
+        found = []
+        with self._open_file(self._table_file(table)) as f:
+            for offset in sorted(offsets):
+                f.seek(offset)
+                register = f.read(register_size).decode()
+                # the index may keep only a prefix of long keys
+                if register[:1] == 'Y' and matches(
+                        register[size_till_column:size_till_column + column_size]):
+                    found.append((register.strip(' '), offset))
+        return found
 
     def create_register_files(self) -> None:
         logging.info('Creating database file...')
-        self._make_header()
-        with open(file=self.extension_file, mode='w+b') as f:
-            # write the amount of registers on extension file atm
-            f.write(
-                bytearray(f'0{" "*(MAX_SIZE_EXTENSION_TABLE - 1)}; ', 'utf-8'))
+        with self._lock, self._table_lock.hold():
+            if not self._check_file():
+                # runs and log left by a table whose main file was removed
+                self._drop_log()
+                manifest = RunManifest(self._sidecar_path('runs'))
+                self._remove_run_files([f'run{number}'
+                                        for number, _, _ in manifest.runs])
+                for path in (manifest.path, self._sidecar_path('zmap')):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._manifest = None
+                self._zone_maps = None
+            self._make_header()
+            if self._session is not None:
+                self._session.forget(self.extension_file)
+            elif self._wal is not None:
+                self._wal.release(self.extension_file)
+            self._memtable = None
+            with open(file=self.extension_file, mode='w+b') as f:
+                # write the amount of registers on extension file atm
+                f.write(bytearray(
+                    f'0{" "*(MAX_SIZE_EXTENSION_TABLE - 1)}; ', 'utf-8'))
         logging.info('Database file created!')
 
+    @table_operation
     def single_insert(self, *args) -> int:
         result = 'Y'  # first byte is for logical deletion if necessary
         for info in args:
@@ -480,7 +1368,9 @@ class OrderedFile:
         # this space will be consumed for the next write
         result += ' '
         byte_result = bytearray(result, 'utf-8')
-        self._write_on_end([[byte_result], 1], True)
+        start = self._write_on_end([[byte_result], 1], True)
+        self._index_registers([(result, start)])
+        self._add_to_memtable([byte_result], start)
 
         amount_on_extension_table = self._check_extension_file_size()
         # need to update the extension table counter
@@ -493,10 +1383,11 @@ class OrderedFile:
             logging.info(
                 'Extension table threshold reached.'
                 'Preparing to merge with the main file.')
-            self._merge_extension_table(self.sort_column)
+            self._merge_extension_table()
 
         return 1
 
+    @table_operation
     def bulk_insert(self, registers: List[List]) -> int:
         total_registers = len(registers)
         write_list = [bytearray('Y' + convert_list_to_str(
@@ -505,7 +1396,11 @@ class OrderedFile:
         # until the end on the line above
         write_list.append(bytearray('Y' + convert_list_to_str(
             registers[-1]) + ' ', encoding='utf-8'))
-        self._write_on_end([write_list, total_registers])
+        start = self._write_on_end([write_list, total_registers])
+        register_size = self._get_size_of_register()
+        self._index_registers([(register.decode(), start + idx*register_size)
+                               for idx, register in enumerate(write_list)])
+        self._add_to_memtable(write_list, start)
         logging.info(f'{total_registers} register(s) added!')
         # check if we need to reorder main file,
         # incorporating extension file records
@@ -517,100 +1412,593 @@ class OrderedFile:
             logging.info(
                 'Extension table threshold reached.'
                 'Preparing to merge with the main file.')
-            self._merge_extension_table(self.sort_column)
+            self._merge_extension_table()
         return 1
 
+    @read_operation
     def single_select(self, pk_col: str, pk_value: Any) -> None:
-        result, _ = self._scan_single_key(pk_value, pk_col, 'main', False)
-        ext_result, _ = self._scan_single_key(pk_value, pk_col,
-                                              'extension', False)
-        if result == '' and ext_result == '':
-            logging.info(f'The value {pk_value} '
-                         f'does not exists on column {pk_col}.')
-        else:
+        # newest registers first, so the smallest files are searched first
+        for table in self._tables():
+            result, _ = self._scan_single_key(pk_value, pk_col, table, False)
             if result:
-                pretty_result = self._format_select_result(result)
-            else:
-                pretty_result = self._format_select_result(ext_result)
-            print(pretty_result)
+                print(self._format_select_result(result))
+                return
+        logging.info(f'The value {pk_value} '
+                     f'does not exists on column {pk_col}.')
 
+    @read_operation
     def select_all(self, target_col: str,
                    values: List[Any], all_between: bool = False) -> None:
-        records, _, total_found = self._scan_all_keys(
-            values, target_col, 'main', True, all_between)
-        records_extension, _, total_found_extension = self._scan_all_keys(
-            values, target_col, 'extension', True, all_between)
-        # records, _, total_found = self._scan_file_for_values(
-        #     target_col, values, all_between, True)
-        grand_total = total_found + total_found_extension
+        all_records, locations = '', []
+        # oldest registers first, the order they will have once merged
+        for table in self._tables()[::-1]:
+            records, _, total_found = self._scan_all_keys(
+                values, target_col, table, True, all_between)
+            all_records += records
+            locations += [table]*total_found
+        grand_total = len(locations)
         print(f'Found {grand_total} records satisfying the conditions.')
         # pretty print
         if grand_total > 0:
-            all_records = records + records_extension
             final = self._format_multiple_results(all_records)
             # add column to indicate location of register
-            final['file_location'] = \
-                ['main']*total_found + ['extension']*total_found_extension
+            final['file_location'] = locations
             # drop logical byte column
             final.drop(columns=['logical_byte'], inplace=True)
             print(final.head(grand_total))
 
+    @table_operation
     def single_delete(self, pk_col: str, pk_value: str) -> None:
-        # find pointer to start of register and get total register size
-        result, pointer = self._scan_single_key(pk_value, pk_col, 'main', True)
-        result_extend, pointer_extended = \
-            self._scan_single_key(pk_value, pk_col, 'extension', True)
+        # find pointer to start of register, newest registers first
+        for table in self._tables():
+            result, pointer = self._scan_single_key(pk_value, pk_col, table, True)
+            if result:
+                break
         # check if register exists
-        if result == '' and result_extend == '':
+        if result == '':
             logging.info(f'Register with value {pk_value} on column {pk_col}'
                          f' does not exists.')
             return
-        # change logical byte to 'N'
-        # deleted is on main file
-        if result:
-            file_name = self.file_name
-            final_pointer = pointer
-        # deleted is on extension file
-        else:
-            file_name = self.extension_file
-            final_pointer = pointer_extended
-        with open(file=file_name, mode='r+b') as f:
-            f.seek(final_pointer)
-            f.write(bytearray('N', 'utf-8'))
+        self._delete_registers(table, [pointer])
         logging.info('Record deleted!')
 
-    def populate_from_csv_file(self, file_path: str, separator: str = ',',
-                               max_lines: int = 1000) -> None:
-        total_lines = 0
-        final_text = ''
+    @table_operation
+    def bulk_delete(self, column: str, values: List[Any],
+                    all_between: bool = False) -> int:
+        '''
+        Deletes every register matching values on column (or between the
+        lowest and highest of them, if all_between), found by a single
+        scan (or search) of each file. Returns the amount of registers
+        deleted.
+        '''
+        deleted = 0
+        for table in self._tables():
+            offsets = [offset for positions, _ in self._iter_records(
+                table, column, values, all_between)
+                for offset in positions.tolist()]
+            self._delete_registers(table, offsets)
+            deleted += len(offsets)
+        logging.info(f'{deleted} records deleted!')
+        return deleted
+
+    @table_operation
+    def delete_where(self, predicate: Callable[[Dict[str, np.ndarray]],
+                                               np.ndarray]) -> int:
+        '''
+        Deletes every register for which predicate holds. predicate gets
+        the typed arrays of every column but the logical byte of a chunk
+        of registers (see to_numpy) and gives a mask of the ones to
+        delete, e.g.:
+        delete_where(lambda rows: (rows['year'] < 2000) & (rows['score'] > 8))
+        Each file is scanned once. Returns the amount of registers deleted.
+        '''
+        columns = list(range(1, len(self.column_names)))
+        deleted = 0
+        for table in self._tables():
+            offsets = []
+            for positions, records in self._iter_records(table, None, ()):
+                chunk = dict(zip(self.column_names[1:], records_to_columns(
+                    records, self.register_types, columns)))
+                mask = np.asarray(predicate(chunk), dtype=bool)
+                offsets += positions[mask].tolist()
+            self._delete_registers(table, offsets)
+            deleted += len(offsets)
+        logging.info(f'{deleted} records deleted!')
+        return deleted
+
+    def _delete_registers(self, table: str, offsets: List[int]) -> None:
+        '''
+        Changes the logical byte of the registers of table at offsets to
+        'N', runs are only changed this way.
+        '''
+        if not offsets:
+            return
+        self._unindex_registers(offsets, table)
+        if table == 'extension':
+            memtable = self._get_memtable()
+            for offset in offsets:
+                memtable.remove(offset)
+        if self._compaction is not None and table in self._compaction.tables:
+            # they may be copied already by the background compaction
+            self._compaction.deleted.update(
+                self._location(table, offset) for offset in offsets)
+        if self._vacuum is not None and table == 'main':
+            _, start, _ = self._table_area('main')
+            register_size = self._get_size_of_register()
+            self._vacuum.note_changes((offset - start) // register_size
+                                      for offset in offsets)
+        with self._open_file(self._table_file(table)) as f:
+            for offset in sorted(offsets):
+                f.seek(offset)
+                f.write(bytearray('N', 'utf-8'))
+
+    def query(self, target_col: str = None, values: List[Any] = (),
+              all_between: bool = False, columns: List[str] = None,
+              limit: int = None) -> Iterator[Tuple]:
+        '''
+        Lazy version of select_all: yields the registers matching values
+        on target_col (every register, if target_col is not given) as
+        tuples with the values (see keys.parse_value) of columns (every
+        one but the logical byte, if not given), sorted by sort_column.
+        The reading stops after limit rows.
+        The rows are a snapshot of the table: every one is read while the
+        lock of the table is held, and the lock is released before the
+        first one is given, so an iterator left open does not keep other
+        processes (or threads) from writing, and what they write is not
+        seen by it. Results bigger than QUERY_CHUNK_REGISTERS rows are
+        kept on a temporary file (see helpers.spill_registers), so they
+        are read with constant memory.
+        '''
+        if limit is not None and limit <= 0:
+            return
+        with self._operation(shared=True):
+            columns = self.column_names[1:] if columns is None else columns
+            for column in columns:
+                # complains about unknown columns
+                self._get_column_type(column)
+            parse = register_parser(
+                self._get_column_sizes(), self.register_types,
+                [self.column_names.index(column) for column in columns])
+            # every table is sorted, the oldest registers come first on ties
+            merged = heapq.merge(
+                *[self._query_registers(table, target_col, values, all_between)
+                  for table in self._tables()[::-1]],
+                key=self._sort_key())
+            registers = spill_registers(
+                merged, self._get_size_of_register(),
+                os.path.dirname(os.path.abspath(self.file_name)), limit)
+        yield from map(parse, registers)
+
+    def _query_registers(self, table: str, target_col: str,
+                         values: List[Any],
+                         all_between: bool = False) -> Iterator[bytes]:
+        '''
+        Live registers of table matching values on target_col (every
+        register, if target_col is None), sorted by sort_column.
+        The lookups of the indexes are not lazy, only the registers found
+        are read lazily.
+        '''
+        if target_col is None:
+            yield from self._table_registers(table)
+            return
+        column_type = self._get_column_type(target_col)
+        column_size, size_till_column, register_size = \
+            self._get_column_and_total_value(target_col)
+        if table == 'extension':
+            # the memtable holds every register of the extension file
+            if target_col == self.sort_column:
+                memtable = self._get_memtable()
+                for low_key, high_key in self._key_ranges(values, column_type,
+                                                          all_between):
+                    for register, _ in memtable.search(low_key, high_key):
+                        yield register
+                return
+            matches = key_matcher(values, column_type, all_between)
+            for register in self._get_memtable().registers():
+                if matches(register[size_till_column:size_till_column +
+                                    column_size].decode()):
+                    yield register
+            return
+        file, start, amount = self._table_area(table)
+        if target_col == self.sort_column:
+            with self._open_file(file) as f:
+                for low_key, high_key in self._key_ranges(values, column_type,
+                                                          all_between):
+                    first = self._search_position(
+                        f, low_key, column_type, start, amount,
+                        size_till_column, column_size, register_size)
+                    end = self._search_position(
+                        f, high_key, column_type, start, amount,
+                        size_till_column, column_size, register_size,
+                        after_equals=True)
+                    for register in iter_registers(
+                            f, start + first*register_size, end - first,
+                            register_size, QUERY_CHUNK_REGISTERS):
+                        if register[:1] == b'Y':
+                            yield register
+            return
+        tree = self._get_btree_indexes().get(target_col)
+        if tree is not None:
+            found = self._lookup_btree(tree, values, all_between, table)
+            with self._open_file(file) as f:
+                for _, offset in found:
+                    f.seek(offset)
+                    yield f.read(register_size)
+            return
+        column_idx = self.column_names.index(target_col)
+        block_registers, blocks = self._candidate_blocks(
+            table, target_col, values, amount, all_between)
+        # the mapped file must have every pending write
+        self._session.sync(file)
+        for _, register in iter_scan_file(
+                file, start, amount, self._get_column_sizes(), column_idx,
+                column_type, values, all_between, logical_column=0,
+                block_registers=block_registers, blocks=blocks):
+            yield register.encode('utf-8')
+
+    @read_operation
+    def to_numpy(self, target_col: str = None, values: List[Any] = (),
+                 all_between: bool = False,
+                 columns: List[str] = None) -> Dict[str, np.ndarray]:
+        '''
+        Registers matching values on target_col (every register, if
+        target_col is not given) as one typed array for each of columns
+        (every one but the logical byte, if not given), see
+        vector_scan.records_to_columns, in the order of select_all.
+        The registers of each file are copied at once from the mapped
+        file and converted column by column, without a python object
+        per field.
+        '''
+        columns = self.column_names[1:] if columns is None else columns
+        for column in columns:
+            # complains about unknown columns
+            self._get_column_type(column)
+        records = np.concatenate(
+            [np.zeros(0, dtype=record_dtype(self._get_column_sizes()))] +
+            [records for table in self._tables()[::-1] for _, records in
+             self._iter_records(table, target_col, values, all_between)])
+        return dict(zip(columns, records_to_columns(
+            records, self.register_types,
+            [self.column_names.index(column) for column in columns])))
+
+    def to_dataframe(self, target_col: str = None, values: List[Any] = (),
+                     all_between: bool = False,
+                     columns: List[str] = None) -> pd.DataFrame:
+        '''
+        Same as to_numpy, as a DataFrame built on the arrays.
+        '''
+        return pd.DataFrame(self.to_numpy(target_col, values, all_between,
+                                          columns))
+
+    @read_operation
+    def aggregate(self, functions: List[Tuple[str, str]],
+                  group_by: List[str] = (), target_col: str = None,
+                  values: List[Any] = (),
+                  all_between: bool = False) -> List[Tuple]:
+        '''
+        Computes aggregates (count, sum, min, max or avg, see
+        aggregate.Aggregation) of the registers matching values on
+        target_col (every register, if target_col is not given), grouped
+        by the columns group_by, while they are scanned. Every file is
+        read (the extension file and the runs included), skipping the
+        logically deleted registers. e.g.:
+        aggregate([('count', '*'), ('avg', 'score')], group_by=['year'])
+        Returns one tuple per group: its values on group_by followed
+        by the aggregates.
+        '''
+        for column in list(group_by) + [column for _, column in functions
+                                        if column != '*']:
+            # complains about unknown columns
+            self._get_column_type(column)
+        aggregation = Aggregation(
+            [(function.lower(), None if column == '*'
+              else self.column_names.index(column))
+             for function, column in functions],
+            self.register_types,
+            [self.column_names.index(column) for column in group_by])
+        for table in self._tables()[::-1]:
+            for _, records in self._iter_records(table, target_col, values,
+                                                 all_between):
+                aggregation.add(records)
+        return aggregation.results()
+
+    def _iter_records(self, table: str, target_col: str,
+                      values: List[Any], all_between: bool = False) \
+            -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        '''
+        Live registers of table matching values on target_col (every
+        register, if target_col is None) as chunks of positions and
+        structured records, in the order they are on the file (see
+        vector_scan.iter_select_records).
+        '''
+        file, start, amount = self._table_area(table)
+        column_sizes = self._get_column_sizes()
+        register_size = self._get_size_of_register()
+        # the mapped file must have every pending write
+        self._session.sync(file)
+        tree = None if target_col is None else \
+            self._get_btree_indexes().get(target_col)
+        if target_col is None:
+            chunks = iter_select_records(file, start, amount, column_sizes,
+                                         logical_column=0)
+        elif target_col == self.sort_column and table != 'extension':
+            column_type = self._get_column_type(target_col)
+            column_size, size_till_column, _ = \
+                self._get_column_and_total_value(target_col)
+            rows = []
+            with self._open_file(file) as f:
+                for low_key, high_key in self._key_ranges(values, column_type,
+                                                          all_between):
+                    first = self._search_position(
+                        f, low_key, column_type, start, amount,
+                        size_till_column, column_size, register_size)
+                    end = self._search_position(
+                        f, high_key, column_type, start, amount,
+                        size_till_column, column_size, register_size,
+                        after_equals=True)
+                    rows += range(first, end)
+            chunks = iter_select_records(file, start, amount, column_sizes,
+                                         logical_column=0, rows=rows)
+        elif tree is not None:
+            found = self._lookup_btree(tree, values, all_between, table)
+            chunks = iter_select_records(
+                file, start, amount, column_sizes,
+                rows=[(offset - start) // register_size for _, offset in found])
+        else:
+            block_registers, blocks = self._candidate_blocks(
+                table, target_col, values, amount, all_between)
+            chunks = iter_select_records(
+                file, start, amount, column_sizes,
+                self.column_names.index(target_col),
+                self._get_column_type(target_col), values, all_between,
+                logical_column=0, block_registers=block_registers,
+                blocks=blocks)
+        for rows, records in chunks:
+            yield start + rows*register_size, records
+
+    def _sort_key(self) -> Callable[[bytes], bytes]:
+        '''
+        Function giving the key of a register on sort_column.
+        '''
+        size_till_column, column_size, column_type = self._sort_column_info()
+        end = size_till_column + column_size
+        return lambda register: encode_key(
+            register[size_till_column:end].decode(), column_type)
+
+    def _table_registers(self, table: str = 'main') -> Iterator[bytes]:
+        '''
+        Registers of table sorted by sort_column, skipping the logically
+        deleted ones.
+        '''
+        if table == 'extension':
+            yield from self._get_memtable().registers()
+            return
         register_size = self._get_size_of_register()
+        file, start, amount = self._table_area(table)
+        with self._open_file(file) as f:
+            for register in iter_registers(f, start, amount, register_size):
+                if register[:1] == b'Y':
+                    yield register
+
+    def _run_registers(self, run: str, register_size: int) -> Iterator[bytes]:
+        with open(file=run, mode='rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            yield from iter_registers(f, 0, size // register_size, register_size)
+
+    def _replace_main_file(self, registers: Iterator[bytes]) -> int:
+        '''
+        Writes a new main file holding registers (already sorted) and
+        puts it in place of the current one. Returns the amount written.
+        '''
+        temp_path = self._sidecar_path('tmp')
+        amount = 0
+        with open(file=temp_path, mode='wb', buffering=LOAD_WRITE_BUFFER) as f:
+            # the space at the end of the header is where registers start
+            f.write(bytearray(self._build_header_string(
+                self._get_header().created_at)[:-1], 'utf-8'))
+            for register in registers:
+                f.write(register)
+                amount += 1
+            f.write(b' ')
+        self._session.forget(self.file_name)
+        replace_file(temp_path, self.file_name)
+        self._drop_vacuum()
+        # the cached header belongs to the replaced file
+        self._header = None
+        self._update_desired_fields(['timestamp', 'amount'], [1, amount])
+        self._write_zone_map('main')
+        return amount
+
+    @table_operation
+    def vacuum(self, blocks: int = None) -> Union[int, None]:
+        '''
+        Rewrites the main file without the logically deleted registers,
+        keeping them sorted. Copies blocks blocks per call (all of them,
+        if None), so it can be spread over maintenance windows, e.g.:
+        while table.vacuum(blocks=1000) is None: ...
+        The table can be used normally between two calls. Once every
+        block is copied, the new file is put in place of the main file
+        and the indexes are built again. Returns the bytes reclaimed
+        then, or None while there are blocks left. The runs and the
+        extension file are left to the compactions, which drop their
+        deleted registers already.
+        '''
+        # the main file cannot be compacted meanwhile
+        self.wait_for_compaction()
+        file, start, amount = self._table_area('main')
+        # the file is read straight from the disk
+        self._session.sync(file)
+        if self._vacuum is None:
+            # the copy is kept between operations, one per process
+            self._vacuum = Vacuum(
+                self._sidecar_path(f'vacuum.{os.getpid()}'),
+                bytearray(self._build_header_string(
+                    self._get_header().created_at)[:-1], 'utf-8'),
+                self._get_size_of_register(), self.blocking_factor)
+        vacuum = self._vacuum
+        try:
+            done = vacuum.copy_blocks(file, start, amount, blocks,
+                                      logical_start=0)
+            logging.info(f'Vacuum copied {vacuum.next_row} '
+                         f'of {amount} registers.')
+            if not done:
+                return None
+            return self._commit_vacuum()
+        except Exception:
+            self._drop_vacuum()
+            raise
+
+    def _commit_vacuum(self) -> int:
+        '''
+        Puts the copy made by vacuum in place of the main file, and
+        deletes from it the registers deleted meanwhile.
+        '''
+        vacuum = self._vacuum
+        with open(file=vacuum.path, mode='r+b') as f:
+            for position in vacuum.stale_positions():
+                f.seek(vacuum.records_start + position*vacuum.register_size)
+                f.write(bytearray('N', 'utf-8'))
+        vacuum.finish()
+        size = os.path.getsize(self.file_name)
+        self._session.forget(self.file_name)
+        replace_file(vacuum.path, self.file_name)
+        self._vacuum = None
+        # the cached header belongs to the replaced file
+        self._header = None
+        self._update_desired_fields(['timestamp', 'amount'],
+                                    [1, vacuum.amount])
+        self._write_zone_map('main')
+        # every register of the main file moved
+        self._rebuild_indexes()
+        reclaimed = size - os.path.getsize(self.file_name)
+        logging.info(f'Vacuum reclaimed {reclaimed} bytes.')
+        return reclaimed
+
+    def _drop_vacuum(self) -> None:
+        '''
+        Throws away the vacuum in progress, e.g. when the main file was
+        replaced. The next call starts it again.
+        '''
+        if self._vacuum is not None:
+            if os.path.exists(self._vacuum.path):
+                os.remove(self._vacuum.path)
+            self._vacuum = None
+
+    @table_operation
+    def populate_from_csv_file(self, file_path: str, separator: str = ',',
+                               max_lines: int = None) -> None:
+        '''
+        Loads the rows of a csv file (with a header line) into the main
+        file, keeping it sorted by sort_column. The csv is read in chunks
+        of CSV_CHUNK_REGISTERS rows, each one sorted in memory and written
+        to a run file (see _merge_runs).
+        max_lines: maximum of registers to load (all of them, if None)
+        '''
+        # the main file is replaced, it cannot be compacted meanwhile
+        self.wait_for_compaction()
+        column_sizes = self._get_column_sizes()
+        sort_column = self._sort_column_info()
         logging.info(f'Loading data from file {file_path}')
-        with open(file_path, 'r+', encoding='utf-8') as f:
-            for line in f:
-                if total_lines == max_lines + 1:
-                    # max line per iteration reached
-                    break
-                # skip header
-                if total_lines == 0:
-                    total_lines += 1
-                    continue
-                text = ''.join(line[:-1].split(separator))
-                # this register has some character that does not belong
-                # to regular 127 ASCII table, so it exceeds the
-                # register max size, cannot add to database
-                if len(text.encode("utf-8")) > register_size:
-                    logging.warning(
-                        f'The register {text} cannot be added because'
-                        f' it uses a character that does not belongs to ASCII 127.')
+        # first column is the logical byte, not on the csv
+        chunks = read_csv_chunks(file_path, column_sizes[1:], separator,
+                                 max_lines, prefix=b'Y')
+        registers, throughput = self._merge_runs(
+            b''.join(sort_registers(chunk, sort_column)) for chunk in chunks)
+        self._rebuild_indexes()
+        logging.info(f'Populated database with {registers} records '
+                     f'from {file_path} ({throughput})!')
+
+    @table_operation
+    def parallel_load(self, file_path: str, separator: str = ',',
+                      workers: int = None) -> None:
+        '''
+        Same as populate_from_csv_file, but the csv is split in ranges of
+        lines that are encoded and sorted by a pool of worker processes,
+        while this process writes them as runs and merges them.
+        workers: amount of processes (one per core, if None)
+        '''
+        self.wait_for_compaction()
+        column_sizes = self._get_column_sizes()
+        logging.info(f'Loading data from file {file_path} in parallel')
+        registers, throughput = self._merge_runs(encode_csv_parallel(
+            file_path, column_sizes[1:], separator, prefix=b'Y',
+            sort_column=self._sort_column_info(), workers=workers))
+        self._rebuild_indexes()
+        logging.info(f'Populated database with {registers} records '
+                     f'from {file_path} ({throughput})!')
+
+    def _sort_column_info(self) -> SortColumn:
+        column_size, size_till_column, _ = \
+            self._get_column_and_total_value(self.sort_column)
+        return size_till_column, column_size, \
+            self._get_column_type(self.sort_column)
+
+    def _merge_runs(self, sorted_runs: Iterator[bytes], log_info: bool = True,
+                    tables: List[str] = ('main',),
+                    write: Callable[[Iterator[bytes]], int] = None) \
+            -> Tuple[int, str]:
+        '''
+        Writes each block of sorted registers to a temporary file, then
+        merges them with the registers of tables through write (into a
+        new main file, if not given). Returns the amount of registers
+        of sorted_runs and the throughput of the load.
+        '''
+        register_size = self._get_size_of_register()
+        progress = LoadProgress(register_size)
+        runs = []
+        try:
+            for data in sorted_runs:
+                if not data:
                     continue
-                final_text += ''.join(line[:-1].split(separator))
-                total_lines += 1
-            final_text += ' '
-        # write the registers
-        with open(file=self.file_name, mode='r+b') as f:
-            f.seek(-1, 2)
-            f.write(bytearray(final_text, 'utf-8'))
-        logging.info(
-            f'Populated database with {total_lines - 1} records from {file_path}!')
-        self._update_desired_fields(
-            fields=['amount', 'timestamp'], amounts=[total_lines - 1, 1])
+                runs.append(self._sidecar_path(f'sort{len(runs)}'))
+                with open(file=runs[-1], mode='wb') as f:
+                    f.write(data)
+                progress.add(len(data) // register_size, log_info)
+            sources = [self._table_registers(table) for table in tables]
+            for run in runs:
+                sources.append(self._run_registers(run, register_size))
+            write = write or self._replace_main_file
+            write(heapq.merge(*sources, key=self._sort_key()))
+        finally:
+            for run in runs:
+                if os.path.exists(run):
+                    os.remove(run)
+        return progress.registers, progress.throughput()
+
+    @table_operation
+    def create_index(self, column: str) -> None:
+        '''
+        Creates a persistent B+tree index on any column, used by
+        single_select, single_delete and select_all on that column
+        (both for lists of values and for ranges) instead of a full scan,
+        on the main file, the runs and the extension file. It is kept up to date
+        by every insert and delete, and built again on every merge.
+        '''
+        column_type = self._get_column_type(column)
+        column_size, _, register_size = self._get_column_and_total_value(column)
+        index_key_length = min(key_length(column_type, column_size), 255)
+        path = self._btree_path(column)
+        self._session.forget(path)
+        with open(file=path, mode='w+b') as f:
+            BPlusTree.create(f, column, index_key_length, node_size_for(
+                self.blocking_factor*register_size, index_key_length))
+        self._btree_indexes = None
+        self._rebuild_indexes([column])
+        logging.info(f'Index created on column {column}.')
+
+    @table_operation
+    def create_zone_maps(self, bloom_columns: List[str] = ()) -> None:
+        '''
+        Creates a zone map (see zone_map.ZoneMap) for the main file and
+        every run: the lowest and highest value of each column on each
+        block, plus a Bloom filter of the values of bloom_columns (useful
+        for columns searched by equality). Scans of columns other than
+        sort_column skip the blocks that cannot hold the values searched.
+        Every new run and main file gets its zone map as well.
+        '''
+        columns = [self.column_names.index(column) for column in bloom_columns]
+        # the files merged meanwhile would get the previous Bloom filters
+        self.wait_for_compaction()
+        for table in ['main'] + self._run_tables():
+            self._write_zone_map(table, columns)
+        logging.info(f'Zone maps created for {len(self._run_tables()) + 1} files.')
@@ -0,0 +1,173 @@
+import heapq
+import os
+from array import array
+from typing import BinaryIO, Callable, Iterator, List, Tuple, Union
+from .header import file_signature
+from .helpers import iter_registers, replace_file
+
+# number, tier and amount of registers of a run
+Run = Tuple[int, int, int]
+# file, position of the first register, amount of registers and
+# location of the first byte of the file (see OrderedFile._location)
+Source = Tuple[str, int, int, int]
+
+
+class RunManifest:
+    '''
+    Sorted runs of an ordered table, oldest first, listed in a small text
+    file next to it: the first line holds the number of the next run and
+    every other line the number, tier and amount of registers of a run
+    ('3;1;16;'). Runs are never changed after being written (only their
+    logical bytes are), so compacting runs only writes a new run and
+    replaces this file.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.next_run = 0
+        self.runs: List[Run] = []
+        self._signature = None
+        if os.path.exists(path):
+            self.load()
+
+    def load(self) -> None:
+        with open(file=self.path, mode='r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        self.next_run = int(lines[0])
+        self.runs = []
+        for line in lines[1:]:
+            if line:
+                number, tier, amount = line.split(';')[:3]
+                self.runs.append((int(number), int(tier), int(amount)))
+        self._signature = file_signature(self.path)
+
+    def save(self) -> None:
+        '''
+        Writes the manifest to a temporary file that takes the place of
+        the current one, so it is never read half written.
+        '''
+        text = f'{self.next_run}\n' + ''.join(
+            f'{number};{tier};{amount};\n' for number, tier, amount in self.runs)
+        temp_path = self.path + '.tmp'
+        with open(file=temp_path, mode='w', encoding='utf-8') as f:
+            f.write(text)
+        replace_file(temp_path, self.path)
+        self._signature = file_signature(self.path)
+
+    def is_stale(self) -> bool:
+        '''
+        True if the file was changed by someone else since the last
+        load or save.
+        '''
+        try:
+            return file_signature(self.path) != self._signature
+        except FileNotFoundError:
+            return self._signature is not None
+
+    def amount(self, number: int = None) -> int:
+        '''
+        Amount of registers of run number (of every run, if not given).
+        '''
+        return sum(amount for run, _, amount in self.runs
+                   if number is None or run == number)
+
+    def new_number(self) -> int:
+        self.next_run += 1
+        return self.next_run - 1
+
+    def pending(self, runs_per_tier: int) -> int:
+        '''
+        Amount of runs waiting to be compacted (see full_tier).
+        '''
+        tiers = [tier for _, tier, _ in self.runs]
+        return sum(1 for tier in tiers if tiers.count(tier) >= runs_per_tier)
+
+    def full_tier(self, runs_per_tier: int) -> Union[int, None]:
+        '''
+        Lowest tier holding at least runs_per_tier runs, if any.
+        '''
+        tiers = [tier for _, tier, _ in self.runs]
+        full = [tier for tier in set(tiers) if tiers.count(tier) >= runs_per_tier]
+        return min(full) if full else None
+
+    def replace(self, numbers: List[int], run: Run = None) -> None:
+        '''
+        Removes the runs numbers and adds run (the result of merging
+        them, if any), which is as new as the newest of them.
+        '''
+        positions = [idx for idx, item in enumerate(self.runs)
+                     if item[0] in numbers]
+        self.runs = [item for item in self.runs if item[0] not in numbers]
+        if run is not None:
+            if positions:
+                self.runs.insert(positions[-1] - len(positions) + 1, run)
+            else:
+                self.runs.append(run)
+        self.save()
+
+
+class Compaction:
+    '''
+    Merge of some runs (and of the main file, if tier is None) into a new
+    file. It is planned and committed by the table, while the merge
+    itself (see merge_sources) may run on a background thread.
+    Registers deleted from the tables in between are kept on deleted, by
+    location, and deleted from the new file when it is committed.
+    The new main file starts with header, built by the table, before the
+    registers. The zone map of the new file is written to zone_map_path,
+    if given.
+    It is stale, and never committed, if another process changed the
+    table in between.
+    '''
+
+    def __init__(self, tables: List[str], tier: Union[int, None],
+                 sources: List[Source], path: str, register_size: int,
+                 sort_key: Callable[[bytes], bytes], number: int = None,
+                 zone_map_path: str = None,
+                 bloom_columns: List[int] = ()) -> None:
+        self.tables = tables
+        self.tier = tier
+        self.sources = sources
+        self.path = path
+        self.register_size = register_size
+        self.sort_key = sort_key
+        self.number = number
+        self.zone_map_path = zone_map_path
+        self.bloom_columns = bloom_columns
+        self.header = b''
+        self.amount = 0
+        self.locations = array('Q')
+        self.deleted = set()
+        self.stale = False
+
+
+def _source_registers(source: Source,
+                      register_size: int) -> Iterator[Tuple[bytes, int]]:
+    path, start, amount, location = source
+    with open(file=path, mode='rb') as f:
+        for idx, register in enumerate(
+                iter_registers(f, start, amount, register_size)):
+            if register[:1] == b'Y':
+                yield register, location + start + idx*register_size
+
+
+def merge_sources(sources: List[Source], output: BinaryIO, register_size: int,
+                  sort_key: Callable[[bytes], bytes],
+                  locations: array = None) -> int:
+    '''
+    Merges the sorted registers of sources into output, skipping the
+    logically deleted ones. Every file is read with its own handle, so
+    the session of the table is not used. The location of each written
+    register is added to locations, if given. Returns the amount of
+    registers written.
+    '''
+    amount = 0
+    merged = heapq.merge(*[_source_registers(source, register_size)
+                           for source in sources],
+                         key=lambda item: sort_key(item[0]))
+    for register, location in merged:
+        output.write(register)
+        if locations is not None:
+            locations.append(location)
+        amount += 1
+    return amount
@@ -0,0 +1,106 @@
+import functools
+from typing import BinaryIO, Callable, Dict, Tuple
+from .buffer_pool import BufferPool, PagedFile
+from .configs import BUFFER_POOL_SIZE, DEFAULT_PAGE_SIZE
+from .wal import WriteAheadLog
+
+
+class TableSession:
+    '''
+    Keeps one handle open for each file used by a table (data file,
+    extension file...), so the files are opened only once for the whole
+    session instead of once per read or write.
+    Every read and write goes through the buffer pool of the session,
+    and through the write ahead log of the table, if given.
+    '''
+
+    def __init__(self, pool_size: int = BUFFER_POOL_SIZE,
+                 wal: WriteAheadLog = None) -> None:
+        self.pool = BufferPool(pool_size, wal)
+        self._handles: Dict[str, BinaryIO] = {}
+        self._layouts: Dict[str, Tuple[int, int]] = {}
+        self.depth = 0
+
+    def handle(self, path: str) -> PagedFile:
+        if path not in self._handles:
+            f = open(file=path, mode='r+b', buffering=0)
+            self._handles[path] = f
+            base, page_size = self._layouts.get(path, (0, DEFAULT_PAGE_SIZE))
+            self.pool.attach(path, f, base, page_size)
+        return PagedFile(self.pool, path)
+
+    def set_layout(self, path: str, base: int, page_size: int) -> None:
+        '''
+        Tells where the records of path start and the size of a block,
+        so every page of the pool is one block of records.
+        '''
+        self._layouts[path] = (base, page_size)
+        if path in self._handles:
+            self.pool.set_layout(path, base, page_size)
+
+    def forget(self, path: str, replaced: bool = True) -> None:
+        '''
+        Closes the handle of a file that was replaced, removed or changed
+        by someone else. It will be opened again on the next use.
+        replaced is False if the file was only written by another process,
+        so its pages on the log are still good.
+        '''
+        f = self._handles.pop(path, None)
+        if f is not None:
+            self.pool.detach(path)
+            f.close()
+        wal = self.pool.wal
+        if replaced and wal is not None and wal.has_pages(path):
+            # the log must not write the old pages over the new file
+            self.pool.flush()
+            wal.release(path)
+
+    def sync(self, path: str) -> None:
+        '''
+        Writes the pending pages of path, so the file can be read
+        straight from the disk (e.g. mapped in memory).
+        '''
+        if path in self._handles:
+            self.pool.flush(path)
+
+    def flush(self) -> None:
+        self.pool.flush()
+
+    def rollback(self) -> None:
+        '''
+        Throws away the pages changed since the last flush.
+        '''
+        self.pool.rollback()
+
+    def close(self) -> None:
+        self.pool.flush()
+        for path, f in self._handles.items():
+            self.pool.detach(path)
+            f.close()
+        self._handles = {}
+
+
+def table_operation(method: Callable) -> Callable:
+    '''
+    Marks a public method of a table as one operation: a session is used
+    (a temporary one if the table was not opened with a session), the
+    header is checked at the beginning and flushed once at the end.
+    The table is locked for other processes meanwhile.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._operation():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def read_operation(method: Callable) -> Callable:
+    '''
+    Same as table_operation, for methods that only read the table: other
+    processes can read it at the same time (see table_lock.TableLock).
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._operation(shared=True):
+            return method(self, *args, **kwargs)
+    return wrapper
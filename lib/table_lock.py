@@ -0,0 +1,108 @@
+import os
+from contextlib import contextmanager
+from typing import Iterator
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where tables are not shared by processes
+    fcntl = None
+
+# digits of the generation kept on the lock file
+GENERATION_LENGTH = 20
+
+
+class TableLock:
+    '''
+    Reader/writer lock of a table, shared by every process using it
+    (flock on the sidecar file at path). Operations that only read take
+    it shared, the others exclusive, for their whole duration, so no file
+    of the table is written, replaced or removed while another process
+    reads it.
+    A writer waiting for the lock holds the file at gate_path, which
+    readers go through before taking the lock, so a steady stream of
+    readers does not keep writers waiting forever.
+    The lock file also holds the generation of the table, moved by every
+    exclusive operation. An operation pins the generation it started on:
+    if it is not the one left by the last operation of the same table
+    object, another process changed the table, and every page, header and
+    index cached must be read again.
+    Nested operations keep the lock of the outer one, which is made
+    exclusive if a nested one needs it.
+    '''
+
+    def __init__(self, path: str, gate_path: str) -> None:
+        self.path = path
+        self.gate_path = gate_path
+        self.fd = None
+        self.gate_fd = None
+        self.depth = 0
+        self.shared = False
+        self.generation = 0
+
+    def _read_generation(self) -> int:
+        data = os.pread(self.fd, GENERATION_LENGTH, 0)
+        return int(data) if data.strip() else 0
+
+    def acquire(self, shared: bool = False) -> int:
+        '''
+        Takes the lock and returns the generation of the table.
+        '''
+        if self.depth:
+            if self.shared and not shared:
+                # not atomic: a writer may run in between
+                self._flock(self.fd, 'LOCK_EX')
+                self.shared = False
+                self.generation = self._read_generation()
+            self.depth += 1
+            return self.generation
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.gate_fd = os.open(self.gate_path, os.O_RDWR | os.O_CREAT,
+                                   0o644)
+        self._flock(self.gate_fd, 'LOCK_SH' if shared else 'LOCK_EX')
+        try:
+            self._flock(self.fd, 'LOCK_SH' if shared else 'LOCK_EX')
+        finally:
+            self._flock(self.gate_fd, 'LOCK_UN')
+        self.depth = 1
+        self.shared = shared
+        self.generation = self._read_generation()
+        return self.generation
+
+    def release(self) -> int:
+        '''
+        Releases the lock taken by acquire, moving the generation if it
+        was exclusive. Returns the generation left.
+        '''
+        self.depth -= 1
+        if self.depth:
+            return self.generation
+        if not self.shared:
+            self.generation += 1
+            os.pwrite(self.fd, str(self.generation).zfill(
+                GENERATION_LENGTH).encode('utf-8'), 0)
+        self._flock(self.fd, 'LOCK_UN')
+        return self.generation
+
+    @contextmanager
+    def hold(self, shared: bool = False) -> Iterator[int]:
+        '''
+        acquire and release as a context manager, for work done out of
+        an operation of the table.
+        '''
+        generation = self.acquire(shared)
+        try:
+            yield generation
+        finally:
+            self.release()
+
+    @staticmethod
+    def _flock(fd: int, operation: str) -> None:
+        if fcntl is not None:
+            fcntl.flock(fd, getattr(fcntl, operation))
+
+    def close(self) -> None:
+        if self.fd is not None and not self.depth:
+            os.close(self.fd)
+            os.close(self.gate_fd)
+            self.fd = self.gate_fd = None
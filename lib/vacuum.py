@@ -0,0 +1,118 @@
+from array import array
+from typing import Iterable, List
+import numpy as np
+from .configs import LOAD_WRITE_BUFFER, VACUUM_CHUNK_REGISTERS
+
+
+class Vacuum:
+    '''
+    Rewrite of the record area of a data file into a dense copy at path,
+    done a few blocks at a time (see copy_blocks), so the table can be
+    used between two steps. moved holds the row (on the record area of
+    the file) of every register copied, in order. Rows already passed
+    that are written or deleted meanwhile are kept on changed, so their
+    copies can be fixed before the copy is put in place of the file.
+    '''
+
+    def __init__(self, path: str, header: bytes, register_size: int,
+                 block_registers: int) -> None:
+        self.path = path
+        self.records_start = len(header)
+        self.register_size = register_size
+        self.block_registers = block_registers
+        self.next_row = 0
+        self.amount = 0
+        self.moved = array('Q')
+        self.changed = set()
+        with open(file=path, mode='wb') as f:
+            f.write(header)
+
+    def note_changes(self, rows: Iterable[int]) -> None:
+        '''
+        Called when the registers at rows are written or deleted.
+        '''
+        self.changed.update(row for row in rows if row < self.next_row)
+
+    def copy_blocks(self, file_name: str, start: int, rows: int,
+                    blocks: int = None, deleted_rows: np.ndarray = (),
+                    logical_start: int = None) -> bool:
+        '''
+        Appends to the copy the registers of the next blocks (all of them,
+        if None) of the rows registers that start at byte start of
+        file_name, skipping the ones on deleted_rows or whose byte at
+        logical_start is not 'Y'. The file is read with its own handle,
+        so it must not have pending writes. Returns True once every row
+        was copied.
+        '''
+        end = rows if blocks is None else \
+            min(rows, self.next_row + blocks*self.block_registers)
+        size = self.register_size
+        with open(file=file_name, mode='rb') as source, \
+                open(file=self.path, mode='ab',
+                     buffering=LOAD_WRITE_BUFFER) as output:
+            while self.next_row < end:
+                amount = min(end - self.next_row, VACUUM_CHUNK_REGISTERS)
+                source.seek(start + self.next_row*size)
+                data = source.read(amount*size)
+                amount = len(data) // size
+                if not amount:
+                    break
+                registers = np.frombuffer(data, dtype=np.uint8,
+                                          count=amount*size).reshape(amount, size)
+                numbers = np.arange(self.next_row, self.next_row + amount)
+                keep = ~np.isin(numbers, deleted_rows)
+                if logical_start is not None:
+                    keep &= registers[:, logical_start] == ord('Y')
+                output.write(registers[keep].tobytes())
+                self.moved.extend(numbers[keep].tolist())
+                self.next_row += amount
+        self.amount = len(self.moved)
+        return self.next_row >= rows
+
+    def stale_positions(self) -> List[int]:
+        '''
+        Positions, on the copy, of the registers changed after they
+        were copied.
+        '''
+        if not self.changed:
+            return []
+        moved = np.frombuffer(self.moved, dtype=np.uint64)
+        return np.flatnonzero(np.isin(
+            moved, np.fromiter(self.changed, dtype=np.uint64))).tolist()
+
+    def fill_holes(self, holes: List[int], registers: List[bytes]) -> None:
+        '''
+        Writes registers on the positions of holes, appending the ones
+        left, then moves the last registers of the copy to the holes
+        still empty, so the copy stays dense. Only for files whose
+        order does not matter.
+        '''
+        holes = sorted(holes)
+        size = self.register_size
+        with open(file=self.path, mode='r+b') as f:
+            for register in registers:
+                position = holes.pop(0) if holes else self.amount
+                if position == self.amount:
+                    self.amount += 1
+                f.seek(self.records_start + position*size)
+                f.write(register)
+            empty = set(holes)
+            while holes:
+                last = self.amount - 1
+                self.amount -= 1
+                if last in empty:
+                    empty.discard(last)
+                    holes.remove(last)
+                    continue
+                f.seek(self.records_start + last*size)
+                register = f.read(size)
+                position = holes.pop(0)
+                empty.discard(position)
+                f.seek(self.records_start + position*size)
+                f.write(register)
+            f.truncate(self.records_start + self.amount*size)
+
+    def finish(self) -> None:
+        # the space at the end of the file is where new registers start
+        with open(file=self.path, mode='ab') as f:
+            f.write(b' ')
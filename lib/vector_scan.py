@@ -0,0 +1,377 @@
+import mmap
+import multiprocessing
+import os
+from bisect import bisect_left
+from typing import Any, Iterable, Iterator, List, Tuple
+import numpy as np
+from .configs import PARALLEL_SCAN_MIN_BYTES, QUERY_CHUNK_REGISTERS
+from .keys import encode_key, parse_number, search_value
+
+
+def record_dtype(column_sizes: List[int]) -> np.dtype:
+    '''
+    Structured type of one register: column i is the field 'c<i>',
+    holding the raw bytes of the column.
+    '''
+    return np.dtype([(f'c{idx}', f'S{size}')
+                     for idx, size in enumerate(column_sizes)])
+
+
+def column_numbers(column: np.ndarray,
+                    column_type: str) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Numbers of an INTEGER or FLOAT column, along with a mask telling
+    which fields could be parsed (see keys.parse_number).
+    '''
+    stripped = np.char.strip(column, b' ')
+    try:
+        numbers = stripped.astype(np.float64)
+        valid = np.ones(len(numbers), dtype=bool)
+    except ValueError:
+        # some field is empty or not a number, parse one by one
+        parsed = [parse_number(text.decode(errors='replace'), column_type)
+                  for text in stripped.tolist()]
+        valid = np.array([number is not None for number in parsed], dtype=bool)
+        numbers = np.array([number if number is not None else 0.0
+                            for number in parsed], dtype=np.float64)
+    if column_type == 'INTEGER':
+        numbers = np.trunc(numbers)
+    return numbers, valid
+
+
+def column_mask(column: np.ndarray, column_type: str, values: List[Any],
+                all_between: bool = False) -> np.ndarray:
+    '''
+    Mask of the fields of column matching one of values (or between
+    the lowest and highest of them, if all_between), with the same
+    semantics as keys.key_matcher.
+    '''
+    if column_type not in ('INTEGER', 'FLOAT'):
+        stripped = np.char.strip(column, b' ')
+        keys = [encode_key(value, column_type) for value in values]
+        if all_between:
+            return (stripped >= min(keys)) & (stripped <= max(keys))
+        return np.isin(stripped, keys)
+    numbers, valid = column_numbers(column, column_type)
+    if all_between:
+        # fields that are not numbers come before every number
+        order = lambda number: (number is not None, number or 0)
+        low = min((parse_number(search_value(value, column_type, 'low'),
+                                column_type) for value in values), key=order)
+        high = max((parse_number(search_value(value, column_type, 'high'),
+                                 column_type) for value in values), key=order)
+        if high is None:
+            return ~valid
+        mask = valid & (numbers <= high)
+        if low is None:
+            return mask | ~valid
+        return mask & (numbers >= low)
+    parsed = [parse_number(value, column_type) for value in
+              (search_value(value, column_type) for value in values)
+              if value is not None]
+    mask = valid & np.isin(numbers, [number for number in parsed
+                                     if number is not None])
+    if None in parsed:
+        mask |= ~valid
+    return mask
+
+
+def _matching_rows(buffer: mmap.mmap, start: int, amount: int,
+                   column_sizes: List[int], column_idx: int,
+                   column_type: str, values: List[Any], all_between: bool,
+                   deleted_rows: Iterable[int],
+                   logical_column: int, rows: np.ndarray = None) -> np.ndarray:
+    records = np.frombuffer(buffer, dtype=record_dtype(column_sizes),
+                            count=amount, offset=start)
+    if rows is not None:
+        # only these registers are read
+        records = records[rows]
+    if column_idx is None:
+        mask = np.ones(len(records), dtype=bool)
+    else:
+        mask = column_mask(records[f'c{column_idx}'], column_type, values,
+                           all_between)
+    if logical_column is not None:
+        mask &= records[f'c{logical_column}'] == b'Y'
+    deleted_rows = [row for row in deleted_rows if 0 <= row < amount]
+    if deleted_rows and rows is not None:
+        mask &= ~np.isin(rows, deleted_rows)
+    elif deleted_rows:
+        mask[deleted_rows] = False
+    if rows is not None:
+        return rows[mask]
+    return np.flatnonzero(mask)
+
+
+def _block_rows(blocks: List[int], block_registers: int,
+                amount: int) -> np.ndarray:
+    '''
+    Numbers of the registers of blocks, among the amount registers
+    of a range.
+    '''
+    if not blocks:
+        return np.zeros(0, dtype=np.int64)
+    rows = (np.asarray(blocks, dtype=np.int64)[:, None]*block_registers +
+            np.arange(block_registers, dtype=np.int64)).ravel()
+    return rows[rows < amount]
+
+
+def _scan_range(task: Tuple) -> List[Tuple[int, str]]:
+    '''
+    Scans the amount registers starting on register first_row of the
+    record area (see scan_file). Runs on the worker processes of a
+    parallel scan, each one mapping the file by itself.
+    '''
+    file_name, start, first_row, amount, column_sizes, column_idx, \
+        column_type, values, all_between, deleted_rows, logical_column, \
+        blocks, block_registers = task
+    register_size = sum(column_sizes)
+    range_start = start + first_row*register_size
+    with open(file=file_name, mode='rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        block_rows = None
+        if blocks is not None:
+            block_rows = _block_rows([block - first_row // block_registers
+                                      for block in blocks],
+                                     block_registers, amount)
+        rows = _matching_rows(buffer, range_start, amount, column_sizes,
+                              column_idx, column_type, values, all_between,
+                              [row - first_row for row in deleted_rows],
+                              logical_column, block_rows)
+        # only the matching registers are decoded
+        return [(first_row + row,
+                 buffer[range_start + row*register_size:
+                        range_start + (row + 1)*register_size].decode())
+                for row in rows.tolist()]
+    finally:
+        buffer.close()
+
+
+def scan_file(file_name: str, start: int, amount: int, column_sizes: List[int],
+              column_idx: int, column_type: str, values: List[Any],
+              all_between: bool = False, deleted_rows: Iterable[int] = (),
+              logical_column: int = None, workers: int = 1,
+              block_registers: int = 1,
+              blocks: List[int] = None) -> List[Tuple[int, str]]:
+    '''
+    Evaluates the predicate on column column_idx over the amount registers
+    that start at byte start of file_name (or as many as the file holds,
+    if amount is None) in one vectorized pass over the mapped file.
+    Registers on deleted_rows, or whose logical_column is not 'Y', are
+    skipped. Returns the number and text of every matching register,
+    in the order of the file. The file must not have pending writes.
+    With more than one worker, record areas of at least
+    PARALLEL_SCAN_MIN_BYTES are split in ranges of whole blocks
+    (block_registers registers each), scanned by a pool of processes.
+    blocks: numbers of the only blocks to read (all of them, if None),
+    e.g. the ones a zone map cannot rule out
+    '''
+    register_size = sum(column_sizes)
+    size = os.stat(file_name).st_size
+    fitting = max((size - start) // register_size, 0)
+    amount = fitting if amount is None else min(amount, fitting)
+    if amount <= 0:
+        return []
+    deleted_rows = sorted(deleted_rows)
+    if blocks is not None:
+        blocks = sorted(blocks)
+        if not blocks:
+            return []
+    if workers is None:
+        workers = os.cpu_count() or 1
+    read_rows = amount if blocks is None else len(blocks)*block_registers
+    if workers <= 1 or read_rows*register_size < PARALLEL_SCAN_MIN_BYTES:
+        workers = 1
+    # every range but the last one is made of whole blocks
+    range_blocks = -(-amount // (workers*block_registers))
+    range_rows = range_blocks*block_registers
+    tasks = []
+    for first_row in range(0, amount, range_rows):
+        last_row = min(first_row + range_rows, amount)
+        task_blocks = None
+        if blocks is not None:
+            task_blocks = blocks[
+                bisect_left(blocks, first_row // block_registers):
+                bisect_left(blocks, -(-last_row // block_registers))]
+            if not task_blocks:
+                continue
+        tasks.append((file_name, start, first_row, last_row - first_row,
+                      column_sizes, column_idx, column_type, values,
+                      all_between,
+                      deleted_rows[bisect_left(deleted_rows, first_row):
+                                   bisect_left(deleted_rows, last_row)],
+                      logical_column, task_blocks, block_registers))
+    if not tasks:
+        return []
+    if len(tasks) == 1:
+        return _scan_range(tasks[0])
+    with multiprocessing.Pool(len(tasks)) as pool:
+        # map keeps the order of the ranges, so matches stay in file order
+        return [match for matches in pool.map(_scan_range, tasks)
+                for match in matches]
+
+
+def _chunks(file_name: str, start: int, amount: int, register_size: int,
+            block_registers: int, chunk_registers: int,
+            deleted_rows: Iterable[int], blocks: List[int] = None,
+            rows: List[int] = None) -> Iterator[Tuple]:
+    '''
+    Splits the amount registers starting at byte start of file_name on
+    chunks of about chunk_registers registers (whole blocks), giving the
+    first row, amount of registers, deleted rows, blocks and rows of each
+    one, counted from the chunk. Chunks without blocks or rows to read
+    are skipped.
+    '''
+    size = os.stat(file_name).st_size
+    fitting = max((size - start) // register_size, 0)
+    amount = fitting if amount is None else min(amount, fitting)
+    deleted_rows = sorted(deleted_rows)
+    if blocks is not None:
+        blocks = sorted(blocks)
+    if rows is not None:
+        rows = sorted(rows)
+    chunk_blocks = max(chunk_registers // block_registers, 1)
+    chunk_rows = chunk_blocks*block_registers
+    for first_row in range(0, amount, chunk_rows):
+        last_row = min(first_row + chunk_rows, amount)
+        first_block = first_row // block_registers
+        chunk_blocks_read, chunk_rows_read = None, None
+        if blocks is not None:
+            chunk_blocks_read = [
+                block - first_block for block in blocks[
+                    bisect_left(blocks, first_block):
+                    bisect_left(blocks, first_block + chunk_blocks)]]
+            if not chunk_blocks_read:
+                continue
+        if rows is not None:
+            chunk_rows_read = [row - first_row for row in rows[
+                bisect_left(rows, first_row):bisect_left(rows, last_row)]]
+            if not chunk_rows_read:
+                continue
+        yield first_row, last_row - first_row, \
+            [row - first_row for row in deleted_rows[
+                bisect_left(deleted_rows, first_row):
+                bisect_left(deleted_rows, last_row)]], \
+            chunk_blocks_read, chunk_rows_read
+
+
+def iter_scan_file(file_name: str, start: int, amount: int,
+                   column_sizes: List[int], column_idx: int, column_type: str,
+                   values: List[Any], all_between: bool = False,
+                   deleted_rows: Iterable[int] = (), logical_column: int = None,
+                   block_registers: int = 1, blocks: List[int] = None,
+                   chunk_registers: int = QUERY_CHUNK_REGISTERS) \
+        -> Iterator[Tuple[int, str]]:
+    '''
+    Same as scan_file, but the registers are scanned by this process
+    about chunk_registers at a time (whole blocks), yielding the matches
+    of a chunk before the next one is read. Stopping the iteration
+    stops the scan.
+    '''
+    register_size = sum(column_sizes)
+    for first_row, chunk_amount, chunk_deleted, chunk_blocks, _ in _chunks(
+            file_name, start, amount, register_size, block_registers,
+            chunk_registers, deleted_rows, blocks):
+        found = scan_file(
+            file_name, start + first_row*register_size, chunk_amount,
+            column_sizes, column_idx, column_type, values, all_between,
+            chunk_deleted, logical_column, block_registers=block_registers,
+            blocks=chunk_blocks)
+        for row, register in found:
+            yield first_row + row, register
+
+
+def select_records(file_name: str, start: int, amount: int,
+                   column_sizes: List[int], column_idx: int = None,
+                   column_type: str = None, values: List[Any] = (),
+                   all_between: bool = False, deleted_rows: Iterable[int] = (),
+                   logical_column: int = None, block_registers: int = 1,
+                   blocks: List[int] = None,
+                   rows: List[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Same as scan_file, but the matching registers (every one, if
+    column_idx is None) are given as their rows and structured records
+    (see record_dtype), copied at once from the mapped file. Only rows
+    are read, if given.
+    '''
+    register_size = sum(column_sizes)
+    dtype = record_dtype(column_sizes)
+    size = os.stat(file_name).st_size
+    fitting = max((size - start) // register_size, 0)
+    amount = fitting if amount is None else min(amount, fitting)
+    if amount == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=dtype)
+    candidates = None
+    if blocks is not None:
+        candidates = _block_rows(blocks, block_registers, amount)
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+        candidates = rows[rows < amount] if candidates is None \
+            else np.intersect1d(candidates, rows)
+    with open(file=file_name, mode='rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        found = _matching_rows(buffer, start, amount, column_sizes,
+                               column_idx, column_type, values, all_between,
+                               deleted_rows, logical_column, candidates)
+        records = np.frombuffer(buffer, dtype=dtype, count=amount,
+                                offset=start)
+        # fancy indexing copies the rows, so the file can be unmapped
+        selected = records[found]
+        del records
+        return found, selected
+    finally:
+        buffer.close()
+
+
+def records_to_columns(records: np.ndarray, column_types: List[str],
+                       columns: List[int]) -> List[np.ndarray]:
+    '''
+    Typed arrays of columns of structured records (see record_dtype):
+    int64 for INTEGER (float64, with NaN on the fields that cannot be
+    parsed, if there is any), float64 for FLOAT (same NaN) and unicode
+    text without the padding spaces for CHAR.
+    '''
+    arrays = []
+    for idx in columns:
+        column, column_type = records[f'c{idx}'], column_types[idx]
+        if column_type not in ('INTEGER', 'FLOAT'):
+            arrays.append(np.char.decode(np.char.strip(column, b' '),
+                                         'utf-8', errors='replace')
+                          if len(column) else np.zeros(0, dtype='U1'))
+            continue
+        numbers, valid = column_numbers(column, column_type)
+        if valid.all():
+            arrays.append(numbers.astype(np.int64)
+                          if column_type == 'INTEGER' else numbers)
+        else:
+            numbers[~valid] = np.nan
+            arrays.append(numbers)
+    return arrays
+
+
+def iter_select_records(file_name: str, start: int, amount: int,
+                        column_sizes: List[int], column_idx: int = None,
+                        column_type: str = None, values: List[Any] = (),
+                        all_between: bool = False,
+                        deleted_rows: Iterable[int] = (),
+                        logical_column: int = None, block_registers: int = 1,
+                        blocks: List[int] = None, rows: List[int] = None,
+                        chunk_registers: int = QUERY_CHUNK_REGISTERS) \
+        -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    '''
+    Same as select_records, but the rows and structured records are
+    given about chunk_registers registers (whole blocks) at a time.
+    '''
+    register_size = sum(column_sizes)
+    for first_row, chunk_amount, chunk_deleted, chunk_blocks, chunk_rows in \
+            _chunks(file_name, start, amount, register_size, block_registers,
+                    chunk_registers, deleted_rows, blocks, rows):
+        found, records = select_records(
+            file_name, start + first_row*register_size, chunk_amount,
+            column_sizes, column_idx, column_type, values, all_between,
+            chunk_deleted, logical_column, block_registers=block_registers,
+            blocks=chunk_blocks, rows=chunk_rows)
+        if len(records):
+            yield first_row + found, records
@@ -0,0 +1,203 @@
+import logging
+import os
+import struct
+import zlib
+from typing import BinaryIO, Dict, List, Set, Tuple
+from .configs import WAL_CHECKPOINT_BYTES
+
+# kind, length of the path, position on the file and length of the data
+# of a record, after its checksum and followed by the path and the data
+BODY_FORMAT = '>BHQI'
+RECORD_FORMAT = '>I' + BODY_FORMAT[1:]
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+PAGE, TRUNCATE, COMMIT = 1, 2, 3
+
+# path, position on the file and new bytes of a page
+Page = Tuple[str, int, bytes]
+# path and new size of a file
+Truncation = Tuple[str, int]
+
+
+def _record(kind: int, path: str = '', position: int = 0,
+            data: bytes = b'') -> bytes:
+    path_bytes = path.encode('utf-8')
+    body = struct.pack(BODY_FORMAT, kind, len(path_bytes), position,
+                       len(data)) + path_bytes + data
+    return struct.pack('>I', zlib.crc32(body)) + body
+
+
+def _read_records(f: BinaryIO) -> List[List[Tuple[int, str, int, bytes]]]:
+    '''
+    Records of every committed transaction of the log, in order.
+    Reading stops at the first record that is incomplete or does not
+    match its checksum (a write interrupted by a crash).
+    '''
+    transactions, current = [], []
+    while True:
+        meta = f.read(RECORD_SIZE)
+        if len(meta) < RECORD_SIZE:
+            break
+        checksum, kind, path_length, position, length = \
+            struct.unpack(RECORD_FORMAT, meta)
+        rest = f.read(path_length + length)
+        if len(rest) < path_length + length or \
+                zlib.crc32(meta[4:] + rest) != checksum:
+            break
+        if kind == COMMIT:
+            transactions.append(current)
+            current = []
+        else:
+            current.append((kind, rest[:path_length].decode('utf-8'),
+                            position, rest[path_length:]))
+    return transactions
+
+
+def replay_log(path: str) -> int:
+    '''
+    Writes again every page of the committed transactions of the log at
+    path, left by a table that was not closed, then empties the log.
+    Pages of files that no longer exist are skipped. Returns the amount
+    of transactions replayed.
+    '''
+    with open(file=path, mode='rb') as f:
+        transactions = _read_records(f)
+    handles: Dict[str, BinaryIO] = {}
+    try:
+        for records in transactions:
+            for kind, file_path, position, data in records:
+                if file_path not in handles:
+                    if not os.path.exists(file_path):
+                        continue
+                    handles[file_path] = open(file=file_path, mode='r+b')
+                f = handles[file_path]
+                if kind == PAGE:
+                    f.seek(position)
+                    f.write(data)
+                else:
+                    f.truncate(position)
+        for f in handles.values():
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        for f in handles.values():
+            f.close()
+    with open(file=path, mode='wb') as f:
+        os.fsync(f.fileno())
+    if transactions:
+        logging.info(f'Recovered {len(transactions)} operations '
+                     f'from the log {path}.')
+    return len(transactions)
+
+
+class WriteAheadLog:
+    '''
+    Append only redo log of the pages written by the operations of a
+    table (see buffer_pool.BufferPool). The pages changed by an operation
+    are one transaction: their new bytes, followed by a commit record,
+    are appended to the log and synced before any of them is written in
+    place, so after a crash replay_log gives every operation either
+    completely or not at all. Only the log is synced on each commit, the
+    files written are synced by the checkpoints, and the many inserts of
+    a bulk operation are a single commit.
+    Once the log holds WAL_CHECKPOINT_BYTES, the files written are
+    synced and the log starts over (see checkpoint).
+    The log belongs to the table, not to the process: every process
+    writing the table appends to the same file, and any of them may
+    replay or empty it while holding the lock of the table exclusively.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.f = open(file=path, mode='a+b')
+
+    def append_page(self, path: str, position: int, data: bytes) -> int:
+        '''
+        Appends the bytes of a page of a transaction not committed yet.
+        Returns where the bytes are on the log (see read).
+        '''
+        self.f.seek(0, 2)
+        start = self.f.tell()
+        record = _record(PAGE, path, position, data)
+        self.f.write(record)
+        return start + len(record) - len(data)
+
+    def end(self) -> int:
+        return self.f.seek(0, 2)
+
+    def discard(self, position: int) -> None:
+        '''
+        Drops everything appended from position on, the pages of a
+        transaction that will never be committed.
+        '''
+        self.f.truncate(position)
+
+    def read(self, position: int, length: int) -> bytes:
+        self.f.flush()
+        self.f.seek(position)
+        return self.f.read(length)
+
+    def commit(self, pages: List[Page],
+               truncations: List[Truncation] = ()) -> None:
+        '''
+        Appends the pages and truncations of a transaction (after any
+        page appended already by append_page) and its commit record,
+        and syncs the log, so the pages can be written in place.
+        '''
+        records = [_record(PAGE, path, position, data)
+                   for path, position, data in pages]
+        records += [_record(TRUNCATE, path, size)
+                    for path, size in truncations]
+        records.append(_record(COMMIT))
+        self.f.write(b''.join(records))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def is_full(self) -> bool:
+        return self.end() >= WAL_CHECKPOINT_BYTES
+
+    def _logged_paths(self) -> Set[str]:
+        '''
+        Files with pages on the log, appended by any process.
+        '''
+        self.f.flush()
+        self.f.seek(0)
+        paths = set()
+        while True:
+            meta = self.f.read(RECORD_SIZE)
+            if len(meta) < RECORD_SIZE:
+                break
+            _, kind, path_length, _, length = \
+                struct.unpack(RECORD_FORMAT, meta)
+            if kind != COMMIT:
+                # a record cut by a crash gives a path that does not exist
+                paths.add(self.f.read(path_length).decode('utf-8', 'replace'))
+            self.f.seek(length, 1)
+        return paths
+
+    def has_pages(self, path: str) -> bool:
+        return self.end() > 0 and path in self._logged_paths()
+
+    def checkpoint(self) -> None:
+        '''
+        Syncs the files with pages on the log, all written in place
+        already, and empties the log.
+        Must not be called in the middle of a transaction.
+        '''
+        for path in self._logged_paths():
+            if os.path.exists(path):
+                with open(file=path, mode='rb') as f:
+                    os.fsync(f.fileno())
+        self.f.truncate(0)
+        os.fsync(self.f.fileno())
+
+    def release(self, path: str) -> None:
+        '''
+        Called before path is replaced, removed or changed without the
+        log, so its pages are never written again by replay_log, whoever
+        logged them.
+        '''
+        if self.has_pages(path):
+            self.checkpoint()
+
+    def close(self) -> None:
+        self.f.close()
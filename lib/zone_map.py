@@ -0,0 +1,274 @@
+import hashlib
+import struct
+from typing import BinaryIO, Dict, Iterable, List, Tuple, Union
+import numpy as np
+from .configs import ZONE_MAP_BLOOM_BITS_PER_KEY, ZONE_MAP_BLOOM_HASHES
+from .helpers import iter_registers
+from .keys import encode_key, key_length
+
+MAGIC = b'ZMAP'
+# magic, registers per block, amount of blocks, amount of columns,
+# hashes of the Bloom filters
+META_FORMAT = '>4sIIHB'
+# key length and bytes of the Bloom filter (0 if none) of each column
+COLUMN_FORMAT = '>HI'
+KEY_LENGTH_FORMAT = '>H'
+KEY_LENGTH_SIZE = struct.calcsize(KEY_LENGTH_FORMAT)
+
+# lowest key, highest key and Bloom filter (if any) of each column
+Zone = List[Tuple[bytes, bytes, Union[bytearray, None]]]
+# lowest and highest key searched
+Range = Tuple[bytes, bytes]
+
+
+def bloom_size(block_registers: int) -> int:
+    '''
+    Bytes of the Bloom filter of one column of a block.
+    '''
+    return -(-block_registers*ZONE_MAP_BLOOM_BITS_PER_KEY // 8)
+
+
+def bloom_positions(key: bytes, bits: int, hashes: int) -> List[int]:
+    # double hashing, with a stable hash so the filters can be persisted
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    first, second = struct.unpack('>II', digest)
+    second |= 1
+    return [(first + idx*second) % bits for idx in range(hashes)]
+
+
+def register_keys(register: bytes, column_sizes: List[int],
+                  column_types: List[str]) -> List[bytes]:
+    '''
+    Key (see keys.encode_key) of every column of a register.
+    '''
+    keys, position = [], 0
+    for size, column_type in zip(column_sizes, column_types):
+        field = register[position:position + size]
+        if column_type in ('INTEGER', 'FLOAT'):
+            keys.append(encode_key(field.decode('utf-8', errors='replace'),
+                                   column_type))
+        else:
+            # same as encode_key, without decoding the text
+            keys.append(field.strip(b' '))
+        position += size
+    return keys
+
+
+class ZoneMap:
+    '''
+    Summary of every block of registers of a data file, kept in a sidecar
+    file: the lowest and highest key of each column and, for some columns,
+    a Bloom filter of the keys. Block n holds the registers n*block_registers
+    to (n + 1)*block_registers - 1 of the record area of the file.
+    Scans only read the blocks that may hold the values searched (see
+    candidate_blocks). Zones only grow: deleted registers are kept on
+    them until the zone map is built again.
+    '''
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        self._read_meta()
+
+    @staticmethod
+    def create(f: BinaryIO, block_registers: int, key_lengths: List[int],
+               bloom_columns: List[int] = ()) -> 'ZoneMap':
+        zone_map = ZoneMap.__new__(ZoneMap)
+        zone_map.f = f
+        zone_map.block_registers = block_registers
+        zone_map.blocks = 0
+        zone_map.hashes = ZONE_MAP_BLOOM_HASHES
+        zone_map.key_lengths = list(key_lengths)
+        zone_map.bloom_sizes = [
+            bloom_size(block_registers) if idx in bloom_columns else 0
+            for idx in range(len(key_lengths))]
+        zone_map._set_layout()
+        zone_map._write_meta()
+        return zone_map
+
+    def _set_layout(self) -> None:
+        self.meta_size = struct.calcsize(META_FORMAT) + \
+            len(self.key_lengths)*struct.calcsize(COLUMN_FORMAT)
+        # an entry starts with one byte telling if the block holds registers
+        self._offsets = []
+        position = 1
+        for key_length, bloom_bytes in zip(self.key_lengths, self.bloom_sizes):
+            self._offsets.append(position)
+            position += 2*(KEY_LENGTH_SIZE + key_length) + bloom_bytes
+        self.entry_size = position
+
+    def _read_meta(self) -> None:
+        self.f.seek(0)
+        magic, self.block_registers, self.blocks, columns, self.hashes = \
+            struct.unpack(META_FORMAT, self.f.read(struct.calcsize(META_FORMAT)))
+        if magic != MAGIC:
+            raise ValueError('The file is not a zone map.')
+        size = struct.calcsize(COLUMN_FORMAT)
+        data = self.f.read(columns*size)
+        self.key_lengths, self.bloom_sizes = [], []
+        for idx in range(columns):
+            key_length, bloom_bytes = struct.unpack(
+                COLUMN_FORMAT, data[idx*size:(idx + 1)*size])
+            self.key_lengths.append(key_length)
+            self.bloom_sizes.append(bloom_bytes)
+        self._set_layout()
+
+    def _write_meta(self) -> None:
+        self.f.seek(0)
+        self.f.write(struct.pack(META_FORMAT, MAGIC, self.block_registers,
+                                 self.blocks, len(self.key_lengths),
+                                 self.hashes))
+        self.f.write(b''.join(struct.pack(COLUMN_FORMAT, key_length, bloom_bytes)
+                              for key_length, bloom_bytes
+                              in zip(self.key_lengths, self.bloom_sizes)))
+
+    def bloom_columns(self) -> List[int]:
+        return [idx for idx, size in enumerate(self.bloom_sizes) if size]
+
+    def _unpack_key(self, data: bytes, position: int) -> bytes:
+        length, = struct.unpack_from(KEY_LENGTH_FORMAT, data, position)
+        return bytes(data[position + KEY_LENGTH_SIZE:
+                          position + KEY_LENGTH_SIZE + length])
+
+    def _pack_key(self, key: bytes, key_length: int) -> bytes:
+        return struct.pack(KEY_LENGTH_FORMAT, len(key)) + \
+            key + b'\x00'*(key_length - len(key))
+
+    def _read_zone(self, block: int) -> Union[Zone, None]:
+        if block >= self.blocks:
+            return None
+        self.f.seek(self.meta_size + block*self.entry_size)
+        data = self.f.read(self.entry_size)
+        if not data[0]:
+            return None
+        zone = []
+        for position, key_length, bloom_bytes in zip(
+                self._offsets, self.key_lengths, self.bloom_sizes):
+            high_position = position + KEY_LENGTH_SIZE + key_length
+            bloom_position = high_position + KEY_LENGTH_SIZE + key_length
+            zone.append((self._unpack_key(data, position),
+                         self._unpack_key(data, high_position),
+                         bytearray(data[bloom_position:
+                                        bloom_position + bloom_bytes])
+                         if bloom_bytes else None))
+        return zone
+
+    def _write_zone(self, block: int, zone: Zone) -> None:
+        data = [b'\x01']
+        for (low, high, bloom), key_length in zip(zone, self.key_lengths):
+            data += [self._pack_key(low, key_length),
+                     self._pack_key(high, key_length), bloom or b'']
+        self.f.seek(self.meta_size + block*self.entry_size)
+        self.f.write(b''.join(data))
+
+    def add(self, registers: Iterable[Tuple[int, List[bytes]]]) -> None:
+        '''
+        Widens the zones of the blocks receiving registers, given as
+        the number of the register on the record area and the key of
+        every column (see register_keys).
+        '''
+        rows: Dict[int, List[List[bytes]]] = {}
+        for row, keys in registers:
+            rows.setdefault(row // self.block_registers, []).append(keys)
+        zones: Dict[int, Zone] = {}
+        for block, block_keys in rows.items():
+            zone = self._read_zone(block)
+            zones[block] = []
+            for idx, keys in enumerate(zip(*block_keys)):
+                low, high = min(keys), max(keys)
+                bloom = None
+                if zone is not None:
+                    low, high = min(low, zone[idx][0]), max(high, zone[idx][1])
+                    bloom = zone[idx][2]
+                elif self.bloom_sizes[idx]:
+                    bloom = bytearray(self.bloom_sizes[idx])
+                if max(map(len, keys)) > self.key_lengths[idx]:
+                    # does not fit on the zone, which then holds any key
+                    low, high = b'', b'\xff'
+                if bloom is not None:
+                    for key in keys:
+                        for bit in bloom_positions(key, len(bloom)*8,
+                                                   self.hashes):
+                            bloom[bit // 8] |= 1 << (bit % 8)
+                zones[block].append((low, high, bloom))
+        blocks = self.blocks
+        for block in sorted(zones):
+            if block >= self.blocks:
+                # blocks in between never held registers
+                self.f.seek(self.meta_size + self.blocks*self.entry_size)
+                self.f.write(b'\x00'*self.entry_size*(block - self.blocks))
+                self.blocks = block + 1
+            self._write_zone(block, zones[block])
+        if self.blocks != blocks:
+            self._write_meta()
+
+    def candidate_blocks(self, column: int, ranges: List[Range],
+                         total_blocks: int) -> List[int]:
+        '''
+        Blocks (of the first total_blocks of the file) that may hold a key
+        of column inside one of ranges. Ranges of a single key are also
+        checked on the Bloom filter of the column, if there is one.
+        Blocks after the last summarized one are always candidates.
+        '''
+        key_length = self.key_lengths[column]
+        bloom_bytes = self.bloom_sizes[column]
+        position = self._offsets[column]
+        high_position = position + KEY_LENGTH_SIZE + key_length
+        # only the used byte and the zone of column are read from each entry
+        names, formats, offsets = ['used', 'low', 'high'], \
+            ['u1', f'S{key_length}', f'S{key_length}'], \
+            [0, position + KEY_LENGTH_SIZE, high_position + KEY_LENGTH_SIZE]
+        if bloom_bytes:
+            names.append('bloom')
+            formats.append(('u1', (bloom_bytes,)))
+            offsets.append(high_position + KEY_LENGTH_SIZE + key_length)
+        summarized = min(self.blocks, total_blocks)
+        self.f.seek(self.meta_size)
+        # keys are padded with zeros, which numpy ignores when comparing
+        zones = np.frombuffer(
+            self.f.read(summarized*self.entry_size), count=summarized,
+            dtype=np.dtype({'names': names, 'formats': formats,
+                            'offsets': offsets, 'itemsize': self.entry_size}))
+        found = np.zeros(summarized, dtype=bool)
+        for low, high in ranges:
+            mask = (zones['low'] <= high) & (zones['high'] >= low)
+            if bloom_bytes and low == high:
+                for bit in bloom_positions(low, bloom_bytes*8, self.hashes):
+                    mask &= (zones['bloom'][:, bit // 8] & (1 << (bit % 8))) > 0
+            found |= mask
+        # blocks that never held a register are ruled out as well
+        found &= zones['used'] > 0
+        return np.flatnonzero(found).tolist() + \
+            list(range(summarized, total_blocks))
+
+
+def build_zone_map(f: BinaryIO, file_name: str, start: int, amount: int,
+                   column_sizes: List[int], column_types: List[str],
+                   block_registers: int, bloom_columns: List[int] = (),
+                   deleted_rows: Iterable[int] = (),
+                   logical_column: int = None) -> ZoneMap:
+    '''
+    Creates on f the zone map of the amount registers that start at byte
+    start of file_name, skipping the ones on deleted_rows or whose
+    logical_column is not 'Y'. The file is read with its own handle, so
+    it must not have pending writes.
+    '''
+    key_lengths = [key_length(column_type, size)
+                   for size, column_type in zip(column_sizes, column_types)]
+    zone_map = ZoneMap.create(f, block_registers, key_lengths, bloom_columns)
+    deleted_rows = set(deleted_rows)
+    logical_start = sum(column_sizes[:logical_column]) \
+        if logical_column is not None else None
+    register_size = sum(column_sizes)
+
+    def live_registers():
+        with open(file=file_name, mode='rb') as data:
+            for row, register in enumerate(
+                    iter_registers(data, start, amount, register_size)):
+                if row in deleted_rows or (
+                        logical_start is not None and
+                        register[logical_start:logical_start + 1] != b'Y'):
+                    continue
+                yield row, register_keys(register, column_sizes, column_types)
+
+    zone_map.add(live_registers())
+    return zone_map